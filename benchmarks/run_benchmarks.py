@@ -0,0 +1,288 @@
+"""
+Benchmarks for the view pipeline, run against the seeded synthetic data provider
+so results can be compared between commits.
+
+    python benchmarks/run_benchmarks.py --output before.json
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import logging
+import argparse
+import platform
+import statistics
+import tempfile
+import subprocess
+import tracemalloc
+from queue import Queue
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# configure logging before bucephalus does, as it logs every view and query at debug level
+logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.WARNING)
+
+from bucephalus import datahandler
+from bucephalus.viewtools import to_json, template_recurse, compile_template, render_template
+from bucephalus.viewtools import dict_merge, dict_merge_shared
+from bucephalus.viewbuilder import ViewBuilder, build_dependency_graph
+from bucephalus.synthetic import SyntheticDataProvider
+
+
+def make_provider(points, latency=0.0, seed=0):
+    config = {'SYNTHETIC_SEED': seed,
+              'SYNTHETIC_LENGTH': points,
+              'SYNTHETIC_SERIES': 100,
+              'SYNTHETIC_LATENCY': latency}
+    return SyntheticDataProvider(config)
+
+
+def make_page(provider, n_views, series_per_view=2):
+    """
+    A page of timeseries views, where views further down the page share series with those above
+    """
+    names = provider.query_names()
+    views = []
+    for i in range(n_views):
+        series = [{'label': 'Series {}'.format(j), 'query': names[(i + j) % len(names)]}
+                  for j in range(series_per_view)]
+        views.append({'viewtype': 'basic_timeseries', 'renderer': 'highstock', 'series': series, 'row': i + 1})
+    return views
+
+
+def time_func(func, repeat):
+    """
+    Runs func enough times per sample to get a measurable time, and returns per-call stats in seconds
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    samples = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {'min': min(samples), 'median': statistics.median(samples),
+            'mean': statistics.mean(samples), 'calls': number * repeat}
+
+
+def run_page(builder, token, views):
+    """
+    Builds a page, returning the time to the first message, the first graph, and the end of the stream
+    """
+    result_queue = Queue()
+    t0 = time.perf_counter()
+    builder.build_views(token, views, result_queue)
+
+    first = first_graph = None
+    while True:
+        msg = result_queue.get()
+        now = time.perf_counter() - t0
+        if first is None:
+            first = now
+        if msg is None:
+            return first, first_graph, now
+        if first_graph is None and msg['category'] == 'graph':
+            first_graph = now
+
+
+def bench_dependency_graph(provider, n_views, repeat):
+    views = make_page(provider, n_views)
+    return time_func(lambda: build_dependency_graph(views, provider), repeat)
+
+
+def bench_build_views(builder, n_views, repeat):
+    """
+    Cold page builds - the plan and query caches are cleared before each one
+    """
+    provider = builder.data_provider
+    token = provider.get_tokens()[0]
+    views = make_page(provider, n_views)
+
+    def cold_run():
+        builder.plan_cache.clear()
+        if provider.query_cache is not None:
+            provider.query_cache.clear()
+        return run_page(builder, token, views)
+
+    runs = [cold_run() for _ in range(repeat)]
+
+    # measured separately, as tracing slows everything else down
+    tracemalloc.start()
+    cold_run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'first_message': statistics.median(r[0] for r in runs),
+            'first_graph': statistics.median(r[1] for r in runs if r[1] is not None),
+            'total': statistics.median(r[2] for r in runs),
+            'peak_memory': peak}
+
+
+def bench_to_json(provider, repeat):
+    data = provider.get_single_query_data('synthetic.0')
+    msg = {'id': 0, 'category': 'data', 'series': ('synthetic.0', 'Series 0'), 'data': data}
+    # to_json replaces the data in the message it's given
+    return time_func(lambda: to_json(dict(msg)), repeat)
+
+
+def bench_templates(builder, repeat):
+    view = builder.view_providers[0].views_cache['accumulated']
+    tmpl = dict_merge([view.view_def, {'title': {'text': '{{name}} in {{region}}'},
+                                       'yAxis': {'title': {'text': '{{units}}'}}}])
+    tags = {'{{name}}': 'Synthetic', '{{region}}': 'Europe', '{{units}}': 'USD'}
+    slots = compile_template(tmpl)
+
+    chain = [builder.view_providers[0].views_cache[n].raw_def
+             for n in ('basic_line', 'basic_timeseries', 'accumulated')]
+
+    return {'template_recurse': time_func(lambda: template_recurse(tmpl, tags), repeat),
+            'render_template': time_func(lambda: render_template(tmpl, slots, tags), repeat),
+            'dict_merge': time_func(lambda: dict_merge(chain), repeat),
+            'dict_merge_shared': time_func(lambda: dict_merge_shared(chain), repeat)}
+
+
+# Handler pipelines benchmarked alongside the registered handlers
+PIPELINES = ['accumulate|rolling_vol:20|resample:W']
+
+
+def bench_handler(provider, handler, n_series, repeat):
+    results = [((q, q), provider.get_single_query_data(q)) for q in provider.query_names(n_series)]
+    return time_func(lambda: handler.process_queries(results), repeat)
+
+
+# Imports and creates the app in a fresh interpreter, and prints how long that took along with its own startup steps
+STARTUP_SCRIPT = '''
+import sys, time, json, logging
+logging.disable(logging.CRITICAL)
+sys.path.insert(0, sys.argv[1])
+t0 = time.perf_counter()
+import bucephalus
+bucephalus.create_app()
+print(json.dumps({'total': time.perf_counter() - t0, 'steps': bucephalus.startup.steps,
+                  'modules': [m for m in ('matplotlib', 'seaborn', 'scipy', 'networkx') if m in sys.modules]}))
+'''
+
+
+def bench_startup(repeat):
+    """
+    Times importing the app in a new process, as a worker does when it starts.
+    The first run builds the view catalog, so it isn't counted
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    samples = {}
+    modules = set()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        for i in range(repeat + 1):
+            out = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, root], cwd=cwd)
+            result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+            if not i:
+                continue
+            samples.setdefault('import_bucephalus', []).append(result['total'])
+            for step, seconds in result['steps']:
+                samples.setdefault(step, []).append(seconds)
+            modules.update(result['modules'])
+
+    ret = {name: {'min': min(s), 'median': statistics.median(s), 'mean': statistics.mean(s), 'calls': len(s)}
+           for name, s in samples.items()}
+    # heavy libraries should only be imported when they're first used
+    ret['import_bucephalus']['modules'] = sorted(modules)
+    return ret
+
+
+def run_suite(view_counts, point_counts, repeat):
+    ret = {}
+
+    for points in point_counts:
+        provider = make_provider(points)
+        builder = ViewBuilder(provider, {'VIEW_RELOAD': False})
+
+        for n_views in view_counts:
+            params = 'views={},points={}'.format(n_views, points)
+            logging.warning('Running page benchmarks with %s', params)
+            ret['build_dependency_graph[{}]'.format(params)] = bench_dependency_graph(provider, n_views, repeat)
+            ret['build_views[{}]'.format(params)] = bench_build_views(builder, n_views, repeat)
+
+        ret['to_json[points={}]'.format(points)] = bench_to_json(provider, repeat)
+
+        handlers = sorted(datahandler.handlers.items())
+        handlers += [(spec, datahandler.get_handler(spec)) for spec in PIPELINES]
+        for name, handler in handlers:
+            for n_series in (1, 10):
+                key = 'handler.{}[series={},points={}]'.format(name, n_series, points)
+                try:
+                    ret[key] = bench_handler(provider, handler, n_series, repeat)
+                except Exception as ex:
+                    ret[key] = {'error': '{}: {}'.format(type(ex).__name__, ex)}
+
+        provider.shutdown()
+
+    for name, stats in bench_templates(builder, repeat).items():
+        ret['templates.{}'.format(name)] = stats
+
+    for name, stats in bench_startup(repeat).items():
+        ret['startup.{}'.format(name)] = stats
+
+    return ret
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def headline(stats):
+    """
+    The number to compare between runs - the median time, or the total for page builds
+    """
+    if 'total' in stats:
+        return stats['total']
+    return stats.get('median')
+
+
+def compare(old, new, threshold):
+    print('{:<60} {:>12} {:>12} {:>8}'.format('benchmark', 'before', 'after', 'change'))
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        before, after = headline(old['results'][name]), headline(new['results'][name])
+        if not before or not after:
+            continue
+        change = after / before - 1
+        flag = ' <--' if change > threshold else ''
+        print('{:<60} {:>10.3f}ms {:>10.3f}ms {:>+7.1%}{}'.format(name, before*1000, after*1000, change, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bucephalus view pipeline benchmarks',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--output', type=str, default='benchmark_results.json',
+        help="File to save the results to")
+    parser.add_argument('--views', type=int, nargs='+', default=[1, 10, 50],
+        help="Views per page")
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 10000],
+        help="Points per series")
+    parser.add_argument('--repeat', type=int, default=5,
+        help="Samples per benchmark")
+    parser.add_argument('--compare', type=str, default=None,
+        help="Earlier results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help="Slowdown to flag when comparing")
+    params = parser.parse_args()
+
+    results = {'commit': git_commit(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'params': {'views': params.views, 'points': params.points, 'repeat': params.repeat},
+               'results': run_suite(params.views, params.points, params.repeat)}
+
+    with open(params.output, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+    print('Saved results to {}'.format(params.output))
+
+    if params.compare is not None:
+        with open(params.compare) as fh:
+            compare(json.load(fh), results, params.threshold)
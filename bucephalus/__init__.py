@@ -1,22 +1,144 @@
+import time
+import_started = time.perf_counter()
+
+import gc
 import os
-import ujson
+import hmac
+import json
 import logging
 from queue import Queue
 
-from flask import Flask, request, send_from_directory, jsonify
+from flask import Flask, request, send_from_directory, abort
 
 from .viewbuilder import ViewBuilder
-from .viewdata import ViewDataProvider
-from .navdata import build_pages
-from .viewtools import to_json, build_json_msg, build_error, build_error_message
+from .dataprovider import load_provider
+from .navdata import NavCache
+from .invalidation import Invalidations
+from .pagecache import make_ref
+from .compression import StreamCompressor, compress_stream, get_encodings
+from .metrics import Timings, StartupTimings, registry
+from .scheduler import SchedulerFull, priorities, INTERACTIVE
+from .pages import find_page, iter_pages, page_extensions
+from .viewtools import stream_encoders, build_error, build_error_message, get_cache_dir
+from .viewtools import BINARY_MIMETYPE
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Time each step of starting up, so slow worker starts show up in the metrics
+startup = StartupTimings()
+startup.observe('imports', time.perf_counter() - import_started)
+
 app = Flask(__name__)
-app.config.from_json('../app.config')
 
-data_provider = ViewDataProvider(app.config)
-view_defs = ViewBuilder(data_provider)
+# Created by create_app
+data_provider = None
+view_defs = None
+nav_cache = None
+invalidations = None
+
+
+def create_app(config_file='../app.config', preload=False):
+    """
+    Loads the config and creates the data provider, view builder and nav cache the routes use.
+    With preload, everything that would otherwise wait for the first request is loaded too,
+    for a server that forks its workers afterwards (see wsgi.py), so they share one copy of it.
+    The worker processes must then call post_fork
+    """
+    global data_provider, view_defs, nav_cache, invalidations
+
+    if view_defs is not None:
+        return app
+
+    with startup.time('config'):
+        app.config.from_json(config_file)
+
+    with startup.time('data_provider'):
+        data_provider = load_provider(app.config)
+
+    with startup.time('view_builder'):
+        view_defs = ViewBuilder(data_provider, app.config, watch=not preload)
+
+    nav_cache = NavCache(data_provider, app.config.get('TOKEN_CACHE_TTL', 60))
+    invalidations = Invalidations(os.path.join(get_cache_dir(app.config), 'invalidated'),
+                                  app.config.get('INVALIDATION_CHECK_INTERVAL', 1.0))
+
+    registry.add_collector(collect_stats)
+    registry.add_collector(startup.collect)
+
+    if preload:
+        with startup.time('preload'):
+            preload_state()
+
+    logging.info('Started in %.3fs', startup.total())
+    return app
+
+
+def preload_state():
+    """
+    Loads the view providers, nav data, execution plans for the nav file's pages, and the provider's
+    reference data, then moves everything created so far out of the garbage collector's way,
+    so collections in the workers don't touch (and so copy) the pages they share
+    """
+    data_provider.preload()
+
+    body, _ = nav_cache.get_file_entry()
+    view_defs.preload([page['views'] for _, page in iter_pages(json.loads(body.decode('utf-8')))])
+
+    gc.collect()
+    gc.freeze()
+
+
+def post_fork():
+    """
+    Called in each worker process forked from a preloaded app, to start what doesn't survive a fork
+    """
+    data_provider.after_fork()
+    view_defs.after_fork()
+    invalidations.after_fork()
+
+
+def worker_exit():
+    """
+    Called as a worker process exits, to close its connections and unlink the series it shared
+    """
+    data_provider.shutdown()
+    if data_provider.shared_series is not None:
+        data_provider.shared_series.close()
+
+
+def collect_stats():
+    """
+    Gauges for the stats the scheduler, query cache, page cache and shared series already keep
+    """
+    scheduler = view_defs.scheduler.stats()
+    yield 'bucephalus_scheduler_waiting', 'Page builds waiting for a worker', [({}, scheduler['waiting'])]
+
+    if data_provider.query_cache is not None:
+        cache = data_provider.query_cache.stats()
+        yield 'bucephalus_query_cache', 'Query cache entries, size and counters', \
+            [({'stat': k}, v) for k, v in sorted(cache.items())]
+
+    if view_defs.page_cache is not None:
+        cache = view_defs.page_cache.stats()
+        yield 'bucephalus_page_cache', 'Page cache entries, size and counters', \
+            [({'stat': k}, v) for k, v in sorted(cache.items())]
+
+    if data_provider.shared_series is not None:
+        shared = data_provider.shared_series.stats()
+        yield 'bucephalus_shared_series', 'Series shared with other worker processes, size and counters', \
+            [({'stat': k}, v) for k, v in sorted(shared.items())]
+
+
+def cached_json_response(entry):
+    """
+    Responds with a cached json body, or 304 if the client already has it.
+    Clients must revalidate every time, so changes are picked up straight away
+    """
+    body, etag = entry
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 
 @app.route('/get_tokens', methods=['GET'])
@@ -24,8 +146,7 @@ def get_tokens():
     """
     Returns a list of data source connection tokens
     """
-    result = (ujson.dumps(data_provider.get_tokens()), )
-    return app.response_class(result, mimetype='application/json')
+    return cached_json_response(nav_cache.get_tokens())
 
 
 # return a json response upon request
@@ -34,43 +155,250 @@ def get_nav_data(token):
     """
     Returns data for building the nav pane contents
     """
-    data = build_pages(data_provider, token)
-    return jsonify(data)
+    return cached_json_response(nav_cache.get_pages(token))
+
+
+def get_series_encoding():
+    """
+    Works out how to encode the /views stream.
+    Binary framing is used if the client asks for it with the encoding flag (binary or binary32)
+    or by accepting the binary mimetype, otherwise we send ;-delimited json.
+    Returns the name of one of the stream_encoders
+    """
+    encoding = request.args.get('encoding')
+    if encoding is None:
+        best = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE])
+        encoding = 'binary' if best == BINARY_MIMETYPE else 'json'
+
+    return encoding if encoding in stream_encoders else 'json'
+
+
+def stream_response(chunks, mimetype, timings=None):
+    """
+    Streams the chunks back, compressed if the client accepts it.
+    The stages timed before the response starts are sent in a Server-Timing header
+    """
+    # Stop nginx buffering the stream, which would hold back views that are ready
+    headers = {'X-Accel-Buffering': 'no', 'Vary': 'Accept-Encoding'}
+
+    if timings is not None:
+        headers['Server-Timing'] = timings.server_timing(['parse', 'plan'])
+
+    encoding = None
+    if app.config.get('STREAM_COMPRESSION', True):
+        encoding = request.accept_encodings.best_match(get_encodings())
+
+    if encoding is not None:
+        compressor = StreamCompressor(encoding,
+                                      app.config.get('STREAM_COMPRESSION_LEVEL', 6),
+                                      app.config.get('STREAM_BROTLI_QUALITY', 5))
+        chunks = compress_stream(chunks, compressor)
+        headers['Content-Encoding'] = encoding
+
+    return app.response_class(chunks, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+
+def get_priority():
+    """
+    The priority of a page build. Prefetches are shed before interactive requests when we're busy
+    """
+    priority_name = request.headers.get('X-Bucephalus-Priority', request.args.get('priority', 'interactive'))
+    return priority_name, priorities.get(priority_name, INTERACTIVE)
 
 
 @app.route('/views/<token>', methods=['POST'])
 def views(token):
 
+    encoding = get_series_encoding()
+    timings = Timings()
+
+    # The client can post the views on their own, or along with the hashes of the series it already holds
+    with timings.time('parse'):
+        body = request.json
+    if isinstance(body, dict):
+        viewlist, have = body['views'], body.get('have')
+    else:
+        viewlist, have = body, None
+
+    return build_page_response(token, viewlist, have, encoding, timings)
+
+
+@app.route('/pages/<token>/<path:path>', methods=['GET'])
+def page_stream(token, path):
+    """
+    A page stream, by the page's path in the nav tree, e.g. /pages/<token>/Parent1/Child1.json.
+    nginx serves pages written by precompute.py straight from PRECOMPUTE_DIR, so we only get here
+    for ones that haven't been precomputed, and build them as /views would
+    """
+    page_path, ext = os.path.splitext(path)
+    encodings = {v: k for k, v in page_extensions.items()}
+    if ext not in encodings:
+        abort(404)
+
+    # Serve precomputed pages ourselves when there's no nginx in front of us
+    precompute_dir = os.path.abspath(app.config.get('PRECOMPUTE_DIR', 'pages'))
+    token_dir = os.path.join(precompute_dir, token)
+    if os.path.dirname(os.path.abspath(token_dir)) == precompute_dir and os.path.isfile(os.path.join(token_dir, path)):
+        response = send_from_directory(token_dir, path, mimetype=stream_encoders[encodings[ext]][1])
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    page = find_page(json.loads(nav_cache.get_pages(token)[0]), page_path)
+    if page is None:
+        abort(404)
+
+    return build_page_response(token, page['views'], None, encodings[ext], Timings())
+
+
+def replay_page(messages, have, encode, timings):
+    """
+    Replays a cached page, sending references in place of any data the client already holds
+    """
+    client_hashes = set(have or ())
+
+    with timings.time('replay'):
+        chunks = [encode(dict(ref)) if ref is not None and ref['hash'] in client_hashes else chunk
+                  for chunk, ref in messages]
+    return chunks
+
+
+def build_page_response(token, viewlist, have, encoding, timings):
+    """
+    Starts building a page, and streams back the messages as they're ready.
+    Pages that can be cached whole are replayed from the page cache if they're in it,
+    and otherwise added to it once they've been built without errors
+    """
+    encode, mimetype = stream_encoders[encoding]
+    priority_name, priority = get_priority()
+    page_cache = view_defs.page_cache
+
+    # another worker may have been told the token's data has changed
+    if invalidations.changed(token):
+        logging.info('Token %s was invalidated by another worker', token)
+        clear_caches(token)
+
     try:
+        page_key = view_defs.get_page_key(token, encoding, viewlist)
+        if page_key is not None:
+            messages = page_cache.get(page_key)
+            if messages is not None:
+                chunks = replay_page(messages, have, encode, timings)
+                chunks.append(encode({'id': 0, 'category': 'status', 'cached': True, 'timings': timings.summary()}))
+                return stream_response(chunks, mimetype, timings)
+
+            # The cached page has to hold all its data, whatever this client already has
+            build_have = None
+        else:
+            build_have = have
+
         result_queue = Queue()
 
         # This function does not block until the results are all back
-        worker_thread = view_defs.build_views(token, request.json, result_queue)
+        build_job = view_defs.build_views(token, viewlist, result_queue, priority, build_have, timings)
+
+    except SchedulerFull as ex:
+        logging.warning('Rejected %s page build: %s', priority_name, ex)
+        result = (encode(build_error('The server is busy, please try again shortly')), )
+        response = app.response_class(result, status=503, mimetype=mimetype)
+        response.headers['Retry-After'] = str(app.config.get('SCHEDULER_RETRY_AFTER', 1))
+        return response
 
     except Exception:
         msg = build_error_message('There was an error building the page views:')
         logging.error(msg)
-        result = (build_json_msg(build_error(msg)), )
-        return app.response_class(result, mimetype='application/json', direct_passthrough=True)
+        result = (encode(build_error(msg)), )
+        return stream_response(result, mimetype)
 
     # Flask can send results back piecemeal, but it needs a generator to do this.
     # We block on the callback here by waiting on the result_queue.
+    # If the client goes away, Flask closes the generator part way through,
+    # in which case we cancel the rest of the build.
+    # The last message is a summary of the time spent in each stage.
+    # Pages being cached are built with all their data, which we then swap
+    # for references to any the client already has.
     def result_generator():
-        while True:
-            result = result_queue.get(block=True)
+        finished = False
+        client_hashes = set(have or ())
+        messages = [] if page_key is not None else None
+        try:
+            while True:
+                result = result_queue.get(block=True)
+
+                # finished the queue
+                if result is None:
+                    break
+
+                ref = make_ref(result) if page_key is not None else None
+                if result.get('category') == 'error':
+                    messages = None
 
-            # finished the queue
-            if result is None:
-                break
+                t0 = time.perf_counter()
+                chunk = encode(result)
+                timings.observe('serialize', time.perf_counter() - t0)
 
-            partial_result = to_json(result)+';'
-            yield(partial_result.encode('utf-8'))
+                if messages is not None:
+                    messages.append((chunk, ref))
+                if ref is not None and ref['hash'] in client_hashes:
+                    chunk = encode(ref)
+                yield chunk
 
-        logging.debug('Waiting for worker thread')
-        worker_thread.join()
+            yield encode({'id': 0, 'category': 'status', 'timings': timings.summary()})
+            finished = True
+
+            if messages is not None:
+                page_cache.put(page_key, messages)
+        finally:
+            if not finished:
+                logging.info('Client went away, cancelling page build')
+                build_job.cancel()
+
+        logging.debug('Waiting for page build')
+        build_job.join()
         logging.debug('Call completed')
 
-    return app.response_class(result_generator(), mimetype='application/json', direct_passthrough=True)
+    return stream_response(result_generator(), mimetype, timings)
+
+
+def clear_caches(token):
+    """
+    Drops this process's cached pages and query results for a token, returning how many there were
+    """
+    ret = {'pages': 0, 'queries': 0}
+    if view_defs.page_cache is not None:
+        ret['pages'] = view_defs.page_cache.invalidate(token)
+    if data_provider.query_cache is not None:
+        ret['queries'] = data_provider.query_cache.invalidate(token)
+    return ret
+
+
+@app.route('/invalidate/<token>', methods=['POST'])
+def invalidate(token):
+    """
+    Drops the cached pages, query results and shared series for a token, for when its data has changed.
+    The other worker processes drop their caches for it when they next build one of its pages,
+    once they see the stamp this leaves (see Invalidations).
+    Callers must send the ADMIN_SECRET from the config as a bearer token, and without one it's disabled
+    """
+    secret = app.config.get('ADMIN_SECRET')
+    auth = request.headers.get('Authorization', '')
+    if not secret or not hmac.compare_digest(auth.encode('utf-8'), 'Bearer {}'.format(secret).encode('utf-8')):
+        abort(403)
+
+    invalidations.invalidate(token)
+    ret = clear_caches(token)
+    ret['shared'] = 0
+    if data_provider.shared_series is not None:
+        ret['shared'] = data_provider.shared_series.invalidate(token)
+    return app.response_class(json.dumps(ret), mimetype='application/json')
+
+
+# Not called metrics, which would replace the bucephalus.metrics module as an attribute of this package
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Page build metrics, in the Prometheus text format
+    """
+    return app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
 
 
 ###################################
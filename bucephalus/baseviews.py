@@ -1,8 +1,24 @@
+import threading
+
 
 class BaseViewBuilder(object):
     """
-    Base view class, providing a common interface
+    Base view class, providing a common interface.
+    Providers that set lazy are only created when one of their views is first built,
+    so they must be able to list their views from catalog without being created
     """
+    lazy = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    @classmethod
+    def catalog(cls, config):
+        """
+        The names of the views a provider would have, without creating it
+        """
+        raise NotImplementedError
 
     def list_views(self):
         return sorted(self.views_cache.keys())
@@ -10,3 +26,32 @@ class BaseViewBuilder(object):
     def has_view(self, typ):
         return typ in self.views_cache
 
+
+class LazyViewProvider(BaseViewBuilder):
+    """
+    Stands in for a lazy view provider, creating it the first time one of its views is built
+    """
+    def __init__(self, cls, config):
+        self.cls = cls
+        self.config = config
+        self.views = sorted(cls.catalog(config))
+        self.provider = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<LazyViewProvider {}>'.format(self.cls.__name__)
+
+    def get_provider(self):
+        with self.lock:
+            if self.provider is None:
+                self.provider = self.cls.from_config(self.config)
+            return self.provider
+
+    def list_views(self):
+        return self.views
+
+    def has_view(self, typ):
+        return typ in self.views
+
+    def build_view(self, viewname, tags, data, extra):
+        return self.get_provider().build_view(viewname, tags, data, extra)
@@ -0,0 +1,98 @@
+import time
+import zlib
+import logging
+
+from bucephalus.metrics import registry
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Upper bounds of the compression ratio buckets, uncompressed over compressed size
+RATIO_BUCKETS = (1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0, 16.0, 24.0, 32.0, 64.0)
+
+compression_ratio = registry.histogram('bucephalus_compression_ratio',
+                                       'Uncompressed over compressed size of each response stream, by encoding',
+                                       RATIO_BUCKETS)
+compression_cpu_seconds = registry.histogram('bucephalus_compression_cpu_seconds',
+                                             'CPU time spent compressing each response stream, by encoding')
+
+
+def get_encodings():
+    """
+    The content encodings we can produce, in order of preference
+    """
+    if brotli is not None:
+        return ['br', 'gzip', 'deflate']
+    return ['gzip', 'deflate']
+
+
+class StreamCompressor(object):
+    """
+    Incrementally compresses a response stream.
+    Each message is flushed as it is compressed, so the browser can decode it straight away
+    """
+    def __init__(self, encoding, level=6, brotli_quality=5):
+        self.encoding = encoding
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=brotli_quality)
+        elif encoding == 'gzip':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+        else:
+            raise RuntimeError('Unknown content encoding {}'.format(encoding))
+
+    def compress(self, data):
+        t0 = time.thread_time()
+
+        if self.encoding == 'br':
+            ret = self.compressor.process(data) + self.compressor.flush()
+        else:
+            ret = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.cpu_time += time.thread_time() - t0
+        self.bytes_in += len(data)
+        self.bytes_out += len(ret)
+        return ret
+
+    def finish(self):
+        t0 = time.thread_time()
+
+        if self.encoding == 'br':
+            ret = self.compressor.finish()
+        else:
+            ret = self.compressor.flush(zlib.Z_FINISH)
+
+        self.cpu_time += time.thread_time() - t0
+        self.bytes_out += len(ret)
+        return ret
+
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+
+
+def compress_stream(chunks, compressor):
+    """
+    Wraps a generator of message chunks, compressing each one as it is produced.
+    Closing this generator closes the one it wraps.
+    """
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+
+        compression_ratio.observe(compressor.ratio(), encoding=compressor.encoding)
+        compression_cpu_seconds.observe(compressor.cpu_time, encoding=compressor.encoding)
+        logging.debug('Compressed stream with %s: %d -> %d bytes (%.1fx) in %.1fms CPU',
+                     compressor.encoding, compressor.bytes_in, compressor.bytes_out,
+                     compressor.ratio(), compressor.cpu_time * 1000)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,162 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection becomes free in time
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A pool of up to max_size connections to one data source.
+    Connections are made with connect(), and handed out most recently used first so the pool
+    stays warm, while connections left idle for more than idle_timeout seconds are closed.
+    Connections idle for more than check_after seconds are health checked with check(conn)
+    before being handed out, and replaced if they fail.
+    """
+    def __init__(self, connect, max_size=4, idle_timeout=300, check=None, check_after=30,
+                 close=None, acquire_timeout=None):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check = check
+        self.check_after = check_after
+        self.close_connection = close or (lambda conn: conn.close())
+        self.acquire_timeout = acquire_timeout
+
+        self.idle = []  # (conn, last used), most recently used last
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.created = 0
+        self.evicted = 0
+        self.failed_checks = 0
+
+    def acquire(self):
+        deadline = time.time() + self.acquire_timeout if self.acquire_timeout else None
+
+        while True:
+            self.evict_idle()
+
+            with self.cond:
+                while not self.idle and self.size >= self.max_size:
+                    if self.closed:
+                        raise RuntimeError('Connection pool is closed')
+                    wait = deadline - time.time() if deadline is not None else None
+                    if wait is not None and wait <= 0:
+                        raise PoolTimeout('No connection free after {}s'.format(self.acquire_timeout))
+                    self.cond.wait(wait)
+
+                if self.closed:
+                    raise RuntimeError('Connection pool is closed')
+
+                new = not self.idle
+                if new:
+                    # reserve the slot, and connect outside the lock
+                    self.size += 1
+                else:
+                    conn, last_used = self.idle.pop()
+
+            if new:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    self.discard()
+                    raise
+                with self.cond:
+                    self.created += 1
+                return conn
+
+            if self.check is None or time.time() - last_used < self.check_after or self.is_healthy(conn):
+                return conn
+
+            logging.warning('Replacing connection that failed its health check')
+            with self.cond:
+                self.failed_checks += 1
+            self.discard(conn)
+
+    def is_healthy(self, conn):
+        try:
+            return bool(self.check(conn))
+        except Exception:
+            return False
+
+    def release(self, conn):
+        with self.cond:
+            if not self.closed:
+                self.idle.append((conn, time.time()))
+                self.cond.notify()
+                return
+            self.size -= 1
+        self.close_quietly(conn)
+
+    def discard(self, *conn):
+        """
+        Drops a broken connection, if given, freeing its slot
+        """
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+        for c in conn:
+            self.close_quietly(c)
+
+    def close_quietly(self, conn):
+        try:
+            self.close_connection(conn)
+        except Exception:
+            logging.exception('Error closing connection')
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def evict_idle(self):
+        """
+        Closes connections that have been idle too long
+        """
+        if not self.idle_timeout:
+            return
+
+        cutoff = time.time() - self.idle_timeout
+        with self.cond:
+            # the idle list is in order of last use, so the stale ones are at the front
+            n = 0
+            while n < len(self.idle) and self.idle[n][1] < cutoff:
+                n += 1
+            stale, self.idle = self.idle[:n], self.idle[n:]
+            self.size -= n
+            self.evicted += n
+            if n:
+                self.cond.notify_all()
+
+        for conn, _ in stale:
+            self.close_quietly(conn)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.cond.notify_all()
+
+        for conn, _ in idle:
+            self.close_quietly(conn)
+
+    def stats(self):
+        with self.cond:
+            return {'size': self.size,
+                    'idle': len(self.idle),
+                    'max_size': self.max_size,
+                    'created': self.created,
+                    'evicted': self.evicted,
+                    'failed_checks': self.failed_checks}
@@ -1,8 +1,12 @@
 import logging
+from functools import lru_cache
 
 import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 handlers = {}
+kernels = {}
 
 
 def register(cls):
@@ -10,12 +14,44 @@ def register(cls):
     return cls
 
 
+def register_kernel(name):
+    """
+    Registers a pipeline stage. Kernels are called as kernel(dates, values, mask, *params),
+    on a panel of the series aligned by align_panel, which they're free to change in place,
+    and return the new (dates, values, mask)
+    """
+    def decorator(func):
+        kernels[name] = func
+        return func
+    return decorator
+
+
 def get_handler(hdlr):
-    return handlers[hdlr]
+    """
+    Returns a handler by name, or a pipeline of kernels, e.g. accumulate|rolling_vol:20|resample:W
+    """
+    if hdlr in handlers:
+        return handlers[hdlr]
+    return get_pipeline(hdlr)
+
+
+def handler_label(hdlr):
+    """
+    The label a handler is timed under in the metrics: its name if it's registered, the kernel of
+    a single stage pipeline, or just pipeline, as pipeline specs carry parameters from the client
+    """
+    if hdlr in handlers:
+        return hdlr
+    names = [stage.strip().partition(':')[0] for stage in hdlr.split('|')]
+    if not all(name in kernels for name in names):
+        return 'other'
+    return names[0] if len(names) == 1 else 'pipeline'
 
 
 class BaseHandler(object):
-    pass
+    # Handlers that transform each series on its own, whatever else is in the view,
+    # are run once per query in the dependency graph, and shared by every view using them
+    per_series = False
 
 
 @register
@@ -30,9 +66,155 @@ class RawHandler(BaseHandler):
         return results
 
 
+def split_data(data):
+    """
+    Splits query data into its dates and values, without copying.
+    Timeseries come as a frame of [date, value] rows, other data as a plain series, whose index stands in for the dates
+    """
+    if isinstance(data, pd.DataFrame):
+        dates = data.iloc[:, 0].values
+        if np.issubdtype(dates.dtype, np.datetime64):
+            dates = dates.astype('datetime64[ms]').astype(np.int64)
+        return dates, data.iloc[:, 1].values
+
+    data = pd.Series(data)
+    return data.index.values, data.values
+
+
+def align_panel(results):
+    """
+    Stacks the data for the (key, data) pairs into one 2-D float array, with a column per series,
+    aligned on the union of their dates. Returns the dates, the values, and a mask of where each
+    series has data, which is everywhere but missing dates and NaNs.
+    Series that share their dates, which is the usual case, are stacked without reindexing
+    """
+    columns = [split_data(v) for _, v in results]
+
+    first = columns[0][0]
+    if all(len(d) == len(first) and np.array_equal(d, first) for d, _ in columns[1:]):
+        dates = first
+        values = np.column_stack([np.asarray(v, dtype=np.float64) for _, v in columns])
+    else:
+        dates = np.unique(np.concatenate([d for d, _ in columns]))
+        values = np.full((len(dates), len(columns)), np.nan)
+        for i, (d, v) in enumerate(columns):
+            values[np.searchsorted(dates, d), i] = v
+
+    return dates, values, ~np.isnan(values)
+
+
+def unstack_panel(results, dates, values, mask, suffix):
+    """
+    Splits a panel back into a (key, data) pair per column, in the form the data came in.
+    Timeseries keep only the dates where they have data, but plain series keep every row,
+    with NaN where they have none, so they still line up with their categories
+    """
+    ret = []
+    for i, (k, v) in enumerate(results):
+        if isinstance(v, pd.DataFrame):
+            rows = mask[:, i]
+            data = pd.DataFrame({0: dates[rows], 1: values[rows, i]})
+        else:
+            data = pd.Series(values[:, i], index=dates)
+        ret.append((k+(suffix,), data))
+    return ret
+
+
+@register_kernel('accumulate')
+def accumulate(dates, values, mask):
+    """
+    Cumulative sum of each series, skipping missing values
+    """
+    values[~mask] = 0
+    np.cumsum(values, axis=0, out=values)
+    values[~mask] = np.nan
+    return dates, values, mask
+
+
+@register_kernel('rolling_vol')
+def rolling_vol(dates, values, mask, window):
+    """
+    Standard deviation of each series over a rolling window of its last N values
+    """
+    window = int(window)
+    if window < 2:
+        raise RuntimeError('rolling_vol needs a window of at least 2, not {}'.format(window))
+
+    ret = np.full(values.shape, np.nan)
+    if mask.all():
+        if len(values) >= window:
+            ret[window-1:] = sliding_window_view(values, window, axis=0).std(axis=-1, ddof=1)
+        return dates, ret, mask & ~np.isnan(ret)
+
+    # series with gaps are windowed over their own values
+    for i in range(values.shape[1]):
+        rows = np.flatnonzero(mask[:, i])
+        if len(rows) >= window:
+            ret[rows[window-1:], i] = sliding_window_view(values[rows, i], window).std(axis=-1, ddof=1)
+    return dates, ret, ~np.isnan(ret)
+
+
+@register_kernel('resample')
+def resample(dates, values, mask, freq):
+    """
+    Resamples each series to the last value in each period, as query windows do
+    """
+    if not np.issubdtype(dates.dtype, np.integer):
+        raise RuntimeError('Only timeseries can be resampled')
+
+    values[~mask] = np.nan
+    index = pd.to_datetime(dates, unit='ms')
+    resampled = pd.DataFrame(values, index=index, copy=False).resample(freq).last()
+    values = resampled.values
+    return resampled.index.values.astype('datetime64[ms]').astype(np.int64), values, ~np.isnan(values)
+
+
+def parse_pipeline(spec):
+    """
+    Parses a pipeline spec of |-separated stages, each a kernel name with any parameters after a colon,
+    separated by commas, e.g. accumulate|rolling_vol:20|resample:W
+    """
+    stages = []
+    for stage in spec.split('|'):
+        name, _, params = stage.strip().partition(':')
+        if name not in kernels:
+            msg = 'Unknown handler "{}" - valid options are: {}'
+            raise RuntimeError(msg.format(name, sorted(set(handlers) | set(kernels))))
+        stages.append((kernels[name], tuple(params.split(',')) if params else ()))
+    return stages
+
+
+class PipelineHandler(BaseHandler):
+    """
+    Runs a pipeline of kernels over all of a view's series at once, stacked into an aligned panel.
+    The panel is the only copy made of the data, and the kernels work on it in place where they can
+    """
+    per_series = True
+
+    def __init__(self, spec):
+        self.name = spec
+        self.stages = parse_pipeline(spec)
+
+    def process_queries(self, results):
+        if not results:
+            return results
+
+        dates, values, mask = align_panel(results)
+        for kernel, params in self.stages:
+            dates, values, mask = kernel(dates, values, mask, *params)
+
+        return unstack_panel(results, dates, values, mask, self.name)
+
+
+@lru_cache(maxsize=256)
+def get_pipeline(spec):
+    return PipelineHandler(spec)
+
+
 @register
 class AccumulateHandler(RawHandler):
     name = 'accumulate'
+    per_series = True
 
     @classmethod
     def process_queries(cls, results):
@@ -40,13 +222,33 @@ class AccumulateHandler(RawHandler):
         Results contains an single array of arrays, 1st column is date, 2nd column is return
         Calculate cumulative sum for returns
         """
-        ret = []
-        for k, v in results:
-            values = v.copy() # don't modify the original data
-            values.values[:, 1] = values.values[:, 1].cumsum(axis=0)
-            ret.append((k+(cls.name,), values))
+        return get_pipeline(cls.name).process_queries(results)
+
+
+def nan_correlation(values, min_periods=2):
+    """
+    Pairwise correlation matrix of the columns of a 2-D array,
+    using only the rows where both columns have data.
+    Pairs with fewer than min_periods overlapping rows get a correlation of 0
+    """
+    mask = ~np.isnan(values)
+    weights = mask.astype(np.float64)
+
+    # Centre the columns first to keep the sums well conditioned
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centred = np.where(mask, values - np.nanmean(values, axis=0), 0.0)
+
+        counts = weights.T @ weights
+        sums = centred.T @ weights
+        sq_sums = (centred * centred).T @ weights
+        cross = centred.T @ centred
+
+        cov = cross - sums * sums.T / counts
+        var = sq_sums - sums * sums / counts
+        correl = cov / np.sqrt(var * var.T)
 
-        return ret
+    correl[(counts < min_periods) | ~np.isfinite(correl)] = 0
+    return np.clip(correl, -1, 1, out=correl)
 
 
 @register
@@ -56,21 +258,14 @@ class CorrelationHandler(BaseHandler):
     @classmethod
     def process_queries(cls, results):
         """
-        Loop through results to calculate the correlation between any two assets
+        Aligns all the series on their dates and calculates the correlation between every pair of them at once.
+        Returns a single dense matrix, in the order the series were given.
         """
-        keys = sorted(list(results.keys()), key=lambda q: q.name)
-        correl = []
-        for i1, first in enumerate(keys):
-            for i2, second in enumerate(keys):
-                if results[first] is not None and results[second] is not None:
-                    logging.debug('Processing correlation between %s and %s', first, second)
-                    min_length = min(len(results[first]), len(results[second]))
-                    firstData = list(list(zip(*results[first][-min_length:]))[1])
-                    secondData = list(list(zip(*results[second][-min_length:]))[1])
-                    correl.append([i1, i2, np.corrcoef(firstData, secondData)[0, 1]])
-                else:
-                    # If no data for either instrument, return correlation of 0
-                    correl.append([i1, i2, 0])
-        return correl
+        keys = [k for k, _ in results]
+        logging.debug('Processing correlation between %d series', len(keys))
 
+        _, values, _ = align_panel(results)
+        correl = nan_correlation(values)
 
+        key = ('|'.join(k[0] for k in keys), 'Correlation', cls.name)
+        return [(key, pd.DataFrame(correl))]
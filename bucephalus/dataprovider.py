@@ -0,0 +1,390 @@
+import time
+import logging
+import importlib
+import threading
+from functools import partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from bucephalus.querycache import QueryCache
+from bucephalus.connectionpool import ConnectionPool
+from bucephalus.querywindow import parse_query, apply_window
+
+
+class QueryError(Exception):
+    """
+    Passed to the run_queries callback in place of the data for a query that failed
+    """
+    pass
+
+
+class QueryTimeout(QueryError):
+    """
+    Passed to the run_queries callback in place of the data for a query that took too long
+    """
+    pass
+
+
+def load_provider(config):
+    """
+    Creates the data provider named by its import path in the config
+    """
+    path = config.get('DATA_PROVIDER', 'bucephalus.viewdata.ViewDataProvider')
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        cls = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as ex:
+        raise RuntimeError('Could not load data provider {}: {}'.format(path, ex))
+
+    if not issubclass(cls, BaseDataProvider):
+        raise RuntimeError('Data provider {} is not a BaseDataProvider'.format(path))
+
+    logging.info('Using data provider %s', path)
+    return cls(config)
+
+
+class BaseDataProvider(object):
+    """
+    Common interface for data providers, which map from queries to datasets.
+
+    Each token names a data source, e.g. a db schema/instance or computation output.
+    Backends implement get_tokens and run_query, and connect if they need connections,
+    which are pooled per token.
+    run_queries is the batch entry point used to build pages. By default it runs each query
+    on the token's worker pool, through the shared query cache, but backends that can fetch
+    many queries at once can override it.
+
+    Queries can carry a date window, as name?start=&end=&last=&freq= (see querywindow).
+    Backends that can apply it at the source set supports_windows and are given the whole query,
+    otherwise they're only asked for the name and the window is cut from the cached result.
+    """
+    supports_windows = False
+
+    def __init__(self, config):
+        self.pool_type = config.get('QUERY_POOL_TYPE', 'thread')
+        self.pool_size = config.get('QUERY_POOL_SIZE', 4)
+        self.max_in_flight = config.get('QUERY_MAX_IN_FLIGHT', 8)
+        self.query_timeout = config.get('QUERY_TIMEOUT')
+
+        if self.pool_type not in ('thread', 'process'):
+            raise RuntimeError('Unknown query pool type {}'.format(self.pool_type))
+
+        self.connection_pool_size = config.get('CONNECTION_POOL_SIZE', self.pool_size)
+        self.connection_idle_timeout = config.get('CONNECTION_IDLE_TIMEOUT', 300)
+        self.connection_check_after = config.get('CONNECTION_CHECK_AFTER', 30)
+        self.connection_timeout = config.get('CONNECTION_TIMEOUT')
+
+        # Worker and connection pools are created lazily, one per token.
+        # With the process pool type, the token threads hand the query itself over to a shared process pool
+        self._pools = {}
+        self._connection_pools = {}
+        self._process_pool = None
+        self._pool_lock = threading.Lock()
+
+        cache_bytes = config.get('QUERY_CACHE_BYTES', 256*1024*1024)
+        if cache_bytes:
+            self.query_cache = QueryCache(cache_bytes, config.get('QUERY_CACHE_TTL'))
+        else:
+            self.query_cache = None
+
+        # Results shared with the other worker processes, checked after our own query cache,
+        # so they expire along with it
+        shared_bytes = config.get('SHARED_SERIES_BYTES', 0)
+        if shared_bytes:
+            from bucephalus.sharedseries import SharedSeries
+            self.shared_series = SharedSeries(shared_bytes, config.get('SHARED_SERIES_PREFIX'),
+                                              ttl=config.get('QUERY_CACHE_TTL'))
+        else:
+            self.shared_series = None
+
+    def __getstate__(self):
+        # Pools and locks stay in this process when we're sent to a query worker process
+        state = self.__dict__.copy()
+        del state['_pools']
+        del state['_connection_pools']
+        del state['_process_pool']
+        del state['_pool_lock']
+        del state['query_cache']
+        del state['shared_series']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pools = {}
+        self._connection_pools = {}
+        self._process_pool = None
+        self._pool_lock = threading.Lock()
+        self.query_cache = None
+        self.shared_series = None
+
+    def after_fork(self):
+        """
+        Called in a worker process forked from the one that created us.
+        Pools don't survive a fork, so they're dropped (without closing the parent's connections)
+        and created again when they're first used
+        """
+        self._pools = {}
+        self._connection_pools = {}
+        self._process_pool = None
+        self._pool_lock = threading.Lock()
+        if self.shared_series is not None:
+            self.shared_series.after_fork()
+
+    def preload(self):
+        """
+        Loads any reference data every worker will need, so a server that forks
+        workers can do it once beforehand and have them share it
+        """
+        pass
+
+    def get_tokens(self):
+        """
+        Return the list of valid tokens
+        """
+        raise NotImplementedError
+
+    def get_version(self):
+        """
+        Anything that changes when the provider's tokens or nav trees do, so cached ones are rebuilt
+        """
+        return None
+
+    def build_nav(self, token):
+        """
+        Returns the nav tree for a token, or None to use navdata.json
+        """
+        return None
+
+    def is_deterministic(self, query):
+        """
+        Whether a query always gives the same result for a token.
+        Pages with any queries that don't are never cached whole
+        """
+        return True
+
+    def connect(self, token):
+        """
+        Returns a new connection to the token's data source, or None if the backend doesn't need one
+        """
+        return None
+
+    def check_connection(self, conn):
+        """
+        Returns whether a connection that has been sitting idle still works
+        """
+        return True
+
+    def close_connection(self, conn):
+        if conn is not None:
+            conn.close()
+
+    def run_query(self, conn, token, query):
+        """
+        Returns the data for a single query, using a connection from the token's pool
+        """
+        raise NotImplementedError
+
+    def get_connection_pool(self, token):
+        """
+        Returns the token's connection pool, creating it if necessary
+        """
+        with self._pool_lock:
+            pool = self._connection_pools.get(token)
+            if pool is None:
+                pool = self._connection_pools[token] = ConnectionPool(partial(self.connect, token),
+                                                                      self.connection_pool_size,
+                                                                      self.connection_idle_timeout,
+                                                                      self.check_connection,
+                                                                      self.connection_check_after,
+                                                                      self.close_connection,
+                                                                      self.connection_timeout)
+            others = [p for t, p in self._connection_pools.items() if t != token]
+
+        # tokens that have gone out of use shouldn't hold on to their connections
+        for other in others:
+            other.evict_idle()
+
+        return pool
+
+    def get_pool(self, token):
+        """
+        Returns the query worker pool for a token, creating it if necessary
+        """
+        with self._pool_lock:
+            pool = self._pools.get(token)
+            if pool is None:
+                pool = self._pools[token] = ThreadPoolExecutor(max_workers=self.pool_size)
+            if self.pool_type == 'process' and self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.pool_size)
+            return pool
+
+    def shutdown(self):
+        """
+        Stops all the query worker pools, and closes all the connections
+        """
+        with self._pool_lock:
+            pools, self._pools = list(self._pools.values()), {}
+            connection_pools, self._connection_pools = list(self._connection_pools.values()), {}
+            if self._process_pool is not None:
+                pools.append(self._process_pool)
+                self._process_pool = None
+        for pool in pools:
+            pool.shutdown(wait=False)
+        for pool in connection_pools:
+            pool.close()
+
+    def run_pooled_query(self, token, query):
+        """
+        Runs a query with a connection from the token's pool
+        """
+        with self.get_connection_pool(token).connection() as conn:
+            return self.run_query(conn, token, query)
+
+    def run_single_query(self, token, query):
+        """
+        Runs a query, in a worker process if so configured.
+        Worker processes make their own connections, as they can't share ours
+        """
+        if self._process_pool is not None:
+            return self._process_pool.submit(self.run_pooled_query, token, query).result()
+        return self.run_pooled_query(token, query)
+
+    def get_query_data(self, token, query):
+        """
+        Returns the data for a query, from the shared query cache where possible
+        """
+        if not self.supports_windows:
+            base, window = parse_query(query)
+            if window is not None:
+                return apply_window(self.get_query_data(token, base), window)
+
+        if self.query_cache is None:
+            return self.fetch_query(token, query)
+        return self.query_cache.get((token, query), partial(self.fetch_query, token, query))
+
+    def fetch_query(self, token, query):
+        """
+        Runs a query, unless another worker process has already shared its result.
+        Results we run are shared in turn, and what we return is then a view onto the shared copy
+        """
+        if self.shared_series is None or not self.is_deterministic(query):
+            return self.run_single_query(token, query)
+
+        data = self.shared_series.get(token, query)
+        if data is not None:
+            return data
+
+        data = self.run_single_query(token, query)
+        shared = self.shared_series.put(token, query, data)
+        return data if shared is None else shared
+
+    def run_queries(self, token, queries, callback, cancel=None, timeouts=None, timings=None):
+        """
+        Loads multiple queries from the data source, calling callback(name, series) for each one
+        Queries run concurrently on the token's worker pool, with at most max_in_flight outstanding.
+        :param queries: a list of queries to load
+        :param callback: a function that will be called as callback(name, series, i, n) once for each series,
+                         in the order the results arrive, possibly from several threads at once.
+                         Failed queries are passed a QueryError in place of the series
+        :param cancel: an optional threading.Event - once it's set no more queries are started,
+                       no more callbacks are made, and we return without waiting for queries in flight
+        :param timeouts: an optional map from query to the seconds it may take before it's
+                         reported as a QueryTimeout, otherwise the configured default is used
+        :param timings: an optional metrics.Timings, to record how long each query took
+        :return: None
+        """
+        n_queries = len(queries)
+        logging.debug('Getting data for {} queries.'.format(n_queries))
+        timeouts = timeouts or {}
+
+        pool = self.get_pool(token)
+        cond = threading.Condition()
+        pending = deque(queries)
+        outstanding = {}  # query -> (future, deadline, timeout)
+        started = {}
+        running = [0]  # results that have been taken, but not yet passed to the callback
+        completed = [0]
+
+        def cancelled():
+            return cancel is not None and cancel.is_set()
+
+        def report(query, data):
+            try:
+                with cond:
+                    completed[0] += 1
+                    index = completed[0]
+                if not cancelled():
+                    callback(query, data, index, n_queries)
+            finally:
+                with cond:
+                    running[0] -= 1
+                    cond.notify_all()
+
+        def run_one(query):
+            # Runs on the pool, and reports from there too. A done callback added to a future that
+            # had already finished would report from the loop below, holding cond while views are built
+            try:
+                data = self.get_query_data(token, query)
+            except Exception as ex:
+                logging.exception('Error running query %s', query)
+                data = QueryError('{}: {}'.format(type(ex).__name__, ex))
+
+            with cond:
+                # we may have given up on it already
+                if outstanding.pop(query, None) is None:
+                    return
+                running[0] += 1
+
+            if timings is not None:
+                timings.observe('provider', time.perf_counter() - started[query])
+
+            try:
+                report(query, data)
+            except Exception:
+                logging.exception('Error reporting query %s', query)
+
+        while True:
+            expired = []
+
+            with cond:
+                if cancelled():
+                    for future, _, _ in outstanding.values():
+                        future.cancel()
+                    outstanding.clear()
+                    logging.debug('Page build cancelled with %d queries not started', len(pending))
+                    return
+
+                if not (pending or outstanding or running[0]):
+                    return
+
+                while pending and len(outstanding) < self.max_in_flight:
+                    query = pending.popleft()
+                    timeout = timeouts.get(query, self.query_timeout)
+                    deadline = time.time() + timeout if timeout else None
+                    started[query] = time.perf_counter()
+                    outstanding[query] = (pool.submit(run_one, query), deadline, timeout)
+
+                now = time.time()
+                for query, (future, deadline, timeout) in list(outstanding.items()):
+                    if deadline is not None and deadline <= now:
+                        del outstanding[query]
+                        running[0] += 1
+                        expired.append((query, timeout))
+
+                if not expired and (outstanding or running[0]):
+                    # wake up for the next deadline, and poll for cancellation
+                    deadlines = [d for _, d, _ in outstanding.values() if d is not None]
+                    wait = min(deadlines) - now if deadlines else None
+                    if cancel is not None:
+                        wait = min(wait, 0.25) if wait is not None else 0.25
+                    cond.wait(wait)
+
+            for query, timeout in expired:
+                logging.warning('Query %s exceeded its deadline of %ss', query, timeout)
+                report(query, QueryTimeout('Query {} exceeded its deadline of {}s'.format(query, timeout)))
+
+    def get_view_data(self, token, query_list, callback, cancel=None, timeouts=None, timings=None):
+        """
+        The old name for run_queries
+        """
+        return self.run_queries(token, query_list, callback, cancel, timeouts, timings)
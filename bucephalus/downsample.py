@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-triangle-three-buckets downsampling.
+    Returns the indices of the n_out points that best keep the shape of the series.
+    Each bucket depends on the point picked in the one before, so we loop over buckets,
+    but the work within a bucket is vectorised.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # The first and last points are always kept, the rest are split into n_out-2 buckets
+    edges = np.linspace(1, n-1, n_out-1).astype(np.intp)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:n-1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:n-1], edges[:-1]) / counts
+
+    # The third vertex of each triangle is the average of the next bucket
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    ret = np.empty(n_out, dtype=np.intp)
+    ret[0] = 0
+    ret[-1] = n - 1
+
+    a = 0
+    for b in range(n_out - 2):
+        lo, hi = edges[b], edges[b+1]
+        area = np.abs((x[a] - next_x[b]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[b] - y[a]))
+        a = lo + np.argmax(area)
+        ret[b+1] = a
+
+    return ret
+
+
+def minmax(x, y, n_out):
+    """
+    Keeps the minimum and maximum of each of n_out/2 buckets.
+    Returns the indices of the kept points in order.
+    """
+    n = len(y)
+    n_buckets = max(n_out // 2, 1)
+    if n_out >= n:
+        return np.arange(n)
+
+    # Pad the buckets out into the rows of a 2-D array, so they're all reduced at once
+    edges = np.linspace(0, n, n_buckets+1).astype(np.intp)
+    size = np.diff(edges).max()
+    idx = edges[:-1, None] + np.arange(size)
+    values = np.where(idx < edges[1:, None], y[np.minimum(idx, n-1)], np.nan)
+
+    rows = np.arange(n_buckets)
+    lows = idx[rows, np.nanargmin(values, axis=1)]
+    highs = idx[rows, np.nanargmax(values, axis=1)]
+
+    return np.unique(np.concatenate([lows, highs]))
+
+
+methods = {'lttb': lttb, 'minmax': minmax}
+
+# View options that control downsampling, rather than the view itself
+options = ('maxPoints', 'pixelWidth', 'downsample')
+
+# lttb always keeps the first and last points, and needs at least one bucket between them
+MIN_POINTS = 3
+
+
+def get_max_points(view_options):
+    """
+    Works out the number of points to keep from the view options, or None if we keep them all.
+    Given a pixel width, lttb keeps a point per pixel, and minmax a min and max per pixel.
+    Anything under MIN_POINTS is raised to it
+    """
+    method = view_options.get('downsample', 'lttb')
+    if method not in methods:
+        raise RuntimeError('Unknown downsampling method {} - valid options are: {}'.format(method, sorted(methods)))
+
+    if 'maxPoints' in view_options:
+        ret = int(view_options['maxPoints'])
+        if ret <= 0:
+            raise RuntimeError('maxPoints must be positive, not {}'.format(ret))
+    elif 'pixelWidth' in view_options:
+        width = int(view_options['pixelWidth'])
+        if width <= 0:
+            raise RuntimeError('pixelWidth must be positive, not {}'.format(width))
+        ret = width * 2 if method == 'minmax' else width
+    else:
+        return None
+
+    return max(ret, MIN_POINTS)
+
+
+def downsample(data, max_points, method='lttb'):
+    """
+    Downsamples a [date, value] timeseries to at most max_points.
+    Rows without a value are dropped first.
+    Returns the new data, and a description of what was done, or None if nothing was
+    """
+    if not isinstance(data, pd.DataFrame) or data.shape[1] != 2 or len(data) <= max_points:
+        return data, None
+
+    x = data.iloc[:, 0].values.astype(np.float64)
+    y = data.iloc[:, 1].values.astype(np.float64)
+
+    finite = np.isfinite(x) & np.isfinite(y)
+    if finite.all():
+        idx = methods[method](x, y, max_points)
+    else:
+        rows = np.flatnonzero(finite)
+        idx = rows[methods[method](x[rows], y[rows], max_points)]
+
+    if len(idx) == len(data):
+        return data, None
+
+    info = {'method': method, 'points': len(idx), 'original': len(data)}
+    return data.iloc[idx], info
+
+
+def downsample_series(data_series, view_options):
+    """
+    Applies the view's downsampling options to the (key, data) pairs from its handler.
+    Returns (key, data, info) triples, with the method and size added to the key of any series
+    that was downsampled, so it doesn't clash with the full series sent for other views
+    """
+    max_points = get_max_points(view_options)
+    if max_points is None:
+        return [(k, v, None) for k, v in data_series]
+
+    method = view_options.get('downsample', 'lttb')
+    ret = []
+    for k, v in data_series:
+        v, info = downsample(v, max_points, method)
+        if info is not None:
+            k = k + ('{}:{}'.format(method, max_points),)
+        ret.append((k, v, info))
+
+    return ret
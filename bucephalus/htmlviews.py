@@ -4,6 +4,12 @@ class HTMLViewBuilder(BaseViewBuilder):
     """
     HTML views
     """
+    lazy = True
+
+    @classmethod
+    def catalog(cls, config):
+        return ['explanation']
+
     def __init__(self):
         self.views_cache = {'explanation': self.explanation}
 
@@ -0,0 +1,69 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+
+
+class Invalidations(object):
+    """
+    Token invalidations shared between worker processes, as a stamp file per token in a directory
+    they all use, which is rewritten whenever the token is invalidated.
+    Each process reads a token's stamp at most once every check_interval seconds, so the others
+    drop what they have cached for it within that long of an invalidation.
+    Only processes sharing the directory see each other's invalidations.
+    """
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.seen = {}  # token -> the stamp we last acted on
+        self.checked = {}  # token -> when we last read its stamp
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+
+    def stamp_path(self, token):
+        return os.path.join(self.path, hashlib.sha1(token.encode('utf-8')).hexdigest())
+
+    def read_stamp(self, token):
+        try:
+            with open(self.stamp_path(token), 'r') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return None
+
+    def invalidate(self, token):
+        """
+        Writes a new stamp for a token, for the other processes to find
+        """
+        path = self.stamp_path(token)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        stamp = uuid.uuid4().hex
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(tmp_path, 'w') as fh:
+            fh.write(stamp)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.seen[token] = stamp
+            self.checked[token] = time.monotonic()
+
+    def changed(self, token):
+        """
+        Whether another process has invalidated a token since we last looked.
+        The first look at a token only notes its stamp, as we can't have cached anything for it before then
+        """
+        now = time.monotonic()
+        with self.lock:
+            if token in self.checked and now - self.checked[token] < self.check_interval:
+                return False
+            self.checked[token] = now
+
+        stamp = self.read_stamp(token)
+
+        with self.lock:
+            changed = token in self.seen and self.seen[token] != stamp
+            self.seen[token] = stamp
+        return changed
@@ -1,12 +1,78 @@
 import os
-import copy
+import json
 import logging
+import threading
 
-import yaml
 import ujson
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 from bucephalus.baseviews import BaseViewBuilder
-from bucephalus.viewtools import dict_merge, template_recurse
+from bucephalus.viewtools import dict_merge, dict_merge_shared, compile_template, render_template, freeze_tags
+from bucephalus.viewtools import get_cache_dir
+
+
+CATALOG_VERSION = 1
+
+
+def get_views_path():
+    return os.path.join(os.path.dirname(__file__), 'views')
+
+
+def get_catalog_path(config):
+    """
+    Where VIEW_CATALOG points, with relative paths taken from the cache directory,
+    rather than wherever the app happens to be started from
+    """
+    path = config.get('VIEW_CATALOG')
+    if path is None:
+        return None
+    return os.path.join(get_cache_dir(config), path)
+
+
+def load_catalog(path):
+    """
+    Reads the view catalog written by save_catalog, returning {view name: entry},
+    or nothing if there isn't a usable one
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, 'r') as fh:
+            catalog = json.load(fh)
+    except Exception:
+        logging.exception('Error reading the view catalog %s', path)
+        return {}
+
+    if catalog.get('version') != CATALOG_VERSION:
+        return {}
+    return catalog['views']
+
+
+def save_catalog(path, views):
+    """
+    Writes the parsed view files to a catalog, along with their modification times,
+    so they can be loaded without parsing them again while the files are unchanged
+    """
+    entries = {name: {'path': v.path, 'mtime': v.mtime, 'typ': v.typ,
+                      'raw_def': v.raw_def, 'prototypes': v.prototypes}
+               for name, v in views.items()}
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as fh:
+            json.dump({'version': CATALOG_VERSION, 'views': entries}, fh)
+        os.replace(tmp_path, path)
+    except Exception:
+        logging.exception('Error writing the view catalog %s', path)
+        # the catalog already there is left as it was
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 class JSONView(object):
@@ -15,16 +81,26 @@ class JSONView(object):
     provides functionality for recursively building from prototypes
     and applying tags as template arguments
     """
-    def __init__(self, name, mtime, path, typ, builder):
+    def __init__(self, name, mtime, path, typ, builder, raw_def=None, prototypes=None):
         self.name = name
         self.mtime = mtime
         self.path = path
         self.typ = typ
         self.builder = builder
         self.compiled = False
+        self.raw_def = raw_def
         self.view_def = None
-        self.prototypes = []
-        self.read_view()
+        self.prototypes = prototypes or []
+        self.slots = None
+        self.rendered = {}
+        self.max_rendered = 256
+
+        if raw_def is None:
+            self.read_view()
+        else:
+            self.view_def = raw_def
+            if not self.prototypes:
+                self.compile_template()
 
     def read_view(self):
         """
@@ -37,65 +113,126 @@ class JSONView(object):
             if self.typ == 'json':
                 result = ujson.load(fh)
             if self.typ == 'yaml':
+                import yaml
                 result = yaml.load(fh)
 
         # raw
         if 'viewDefinition' not in result:
-            self.view_def = result
-            self.compiled = True
+            self.raw_def = self.view_def = result
+            self.compile_template()
             return
 
         # enclosed
-        self.view_def = result['viewDefinition']
+        self.raw_def = self.view_def = result['viewDefinition']
         if 'prototypes' in result and result['prototypes']:
             self.prototypes = result['prototypes'].split(',')
         else:
-            self.compiled = True
+            self.compile_template()
 
-    def build(self, force=False):
+    def copy(self):
+        """
+        Returns an unbuilt copy of this view, without re-reading the file
+        """
+        return JSONView(self.name, self.mtime, self.path, self.typ, self.builder, self.raw_def, self.prototypes)
+
+    def build(self, views=None, force=False):
         """
         Makes sure all prototypes have been built then derives from them
         """
         if self.compiled and not force:
             return
 
+        if views is None:
+            views = self.builder.views_cache
+
         for p in self.prototypes:
-            self.builder.views_cache[p].build(force)
+            if p not in views:
+                raise KeyError('Prototype {} of view {} not found'.format(p, self.name))
+            views[p].build(views, force)
+
+        to_merge = [views[n].view_def for n in self.prototypes]
+        self.view_def = dict_merge(to_merge+[self.raw_def])
+        self.compile_template()
 
-        to_merge = [self.builder.get_view(n).view_def for n in self.prototypes]
-        self.view_def = dict_merge(to_merge+[self.view_def])
+    def compile_template(self):
+        """
+        Records where the tag placeholders are, so rendering only has to touch those
+        """
+        self.slots = compile_template(self.view_def)
+        self.rendered = {}
         self.compiled = True
 
     def render_tags(self, tags):
         """
-        Recursively apply given tags as template arguments
+        Apply given tags as template arguments.
+        The result shares any untouched parts of the view definition, and is memoized
+        per set of tags, so it must be treated as read-only
         """
+        try:
+            key = freeze_tags(tags)
+        except TypeError:
+            # unhashable tag values can't be memoized
+            key = None
+
+        if key is not None:
+            ret = self.rendered.get(key)
+            if ret is not None:
+                return ret
+
         tmpl_tags = {'{{'+k+'}}': v for k, v in tags.items()}
-        tmpl = copy.deepcopy(self.view_def)
-        return template_recurse(tmpl, tmpl_tags)
+        ret = render_template(self.view_def, self.slots, tmpl_tags)
+
+        if key is not None:
+            if len(self.rendered) >= self.max_rendered:
+                self.rendered.clear()
+            self.rendered[key] = ret
+
+        return ret
+
+
+def get_dependents(views, names):
+    """
+    Returns the views that inherit from any of the given views, directly or through other prototypes
+    """
+    ret = set()
+    pending = set(names)
+    while pending:
+        pending = {n for n, v in views.items() if n not in ret and pending.intersection(v.prototypes)}
+        ret |= pending
+    return ret
 
 
 class JSONViewBuilder(BaseViewBuilder):
     """
     class for building and providing view definitions
     can do things like auto-rebuild when files change
+    If a catalog path is given, parsed views are kept there, and unchanged files are loaded from it
     """
 
-    def __init__(self, loc):
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('VIEWS_DIR') or get_views_path(), get_catalog_path(config))
+
+    def __init__(self, loc, catalog_path=None):
         self.location = loc
+        self.catalog_path = catalog_path
+        self.catalog = load_catalog(catalog_path)
         self.views_cache = {}
         self.allowed_types = ['json', 'yaml']
+        self.listeners = []
+        self.failed = {}  # file path -> modification time, for files that couldn't be loaded
+        self.unbuilt = set()  # views that failed to build, e.g. because a prototype was removed
+        self.reload_lock = threading.Lock()
+        self.watcher = None
 
-        self.read_views()
-        self.build_views()
+        self.reload_views()
 
-    def read_views(self):
+    def scan_views(self):
         """
-        Reads views from file.
-        Keeps track of modification time so we can reload
-        only those that have changed.
+        Finds the view files, returning {view name: (path, modification time, type)}
         """
-        logging.debug('Loading views from %s', os.path.abspath(self.location))
+        logging.debug('Scanning views in %s', os.path.abspath(self.location))
+        ret = {}
         for r, _, files in os.walk(self.location):
             for file_name in files:
 
@@ -106,34 +243,161 @@ class JSONViewBuilder(BaseViewBuilder):
                 if typ not in self.allowed_types:
                     continue
 
-                mtime = os.stat(file_path).st_mtime
+                # check this isn't a duplicate
+                if view_name in ret:
+                    msg = 'View {}, in {} is duplicated in {}'
+                    raise RuntimeError(msg.format(view_name, ret[view_name][0], file_path))
+
+                ret[view_name] = (file_path, os.stat(file_path).st_mtime, typ)
+
+        return ret
+
+    def reload_views(self):
+        """
+        Reads views from file.
+        Keeps track of modification time so we only re-read those that have changed,
+        then rebuilds the views that inherit from them through their prototypes.
+        The new definitions are swapped in all at once, so requests using
+        the old ones keep a consistent set.
+        Returns the names of the views that were changed.
+        """
+        with self.reload_lock:
+            current = self.views_cache
+            found = self.scan_views()
+
+            changed = set()
+            for view_name, (file_path, mtime, typ) in found.items():
+                # don't keep retrying a broken file until it changes again
+                if self.failed.get(file_path) == mtime:
+                    continue
+
+                cached = current.get(view_name)
+                if cached is None or cached.path != file_path or mtime > cached.mtime:
+                    changed.add(view_name)
 
-                # check if we have a cached version
-                if view_name in self.views_cache:
-                    cached = self.views_cache[view_name]
+            removed = set(current) - set(found)
+            if not changed and not removed:
+                return set()
 
-                    # check this isn't a duplicate
-                    if r != cached['path']:
-                        msg = 'View {}, in {} is duplicated in {}'
-                        raise RuntimeError(msg.format(view_name, cached['path'], r))
+            # a new or changed view might be the prototype a view that failed to build was missing
+            self.unbuilt -= changed
+            if changed:
+                retry = {n for n in self.unbuilt if n in found and self.failed.get(found[n][0]) == found[n][1]}
+                changed |= retry
+                self.unbuilt -= retry
 
-                    # check this is newer than the cached copy
-                    if mtime <= cached.mtime:
-                        continue
+            views = {n: v for n, v in current.items() if n not in removed}
+            parsed = False
+            for view_name in changed:
+                file_path, mtime, typ = found[view_name]
+
+                entry = self.catalog.get(view_name)
+                if entry is not None and (entry['path'], entry['mtime'], entry['typ']) == (file_path, mtime, typ):
+                    views[view_name] = JSONView(view_name, mtime, file_path, typ, self,
+                                                entry['raw_def'], entry['prototypes'])
+                    logging.debug('Loaded view %s from the catalog', view_name)
+                    continue
 
-                # read the view
-                v = JSONView(view_name, mtime, file_path, typ, self)
+                try:
+                    views[view_name] = JSONView(view_name, mtime, file_path, typ, self)
+                except Exception:
+                    self.failed[file_path] = mtime
+                    raise
+                parsed = True
                 logging.debug('Loaded view %s', view_name)
-                self.views_cache[view_name] = v
+
+            dependents = get_dependents(views, changed | removed) - changed
+            for view_name in dependents:
+                views[view_name] = views[view_name].copy()
+
+            unbuilt = set()
+            for view_name in changed | dependents:
+                try:
+                    views[view_name].build(views)
+                except Exception:
+                    logging.exception('Error building view %s', view_name)
+                    unbuilt.add(view_name)
+
+            # left out until their file changes, or another view does
+            for view_name in unbuilt:
+                self.failed[views[view_name].path] = views[view_name].mtime
+                del views[view_name]
+            self.unbuilt |= unbuilt
+
+            self.views_cache = views
+
+            if self.catalog_path is not None and (parsed or removed):
+                save_catalog(self.catalog_path, views)
+                self.catalog = load_catalog(self.catalog_path)
+
+        for listener in self.listeners:
+            listener()
+
+        return changed | dependents | removed
+
+    def start_watcher(self, interval):
+        """
+        Starts reloading views in the background when their files change
+        """
+        if self.watcher is None:
+            self.watcher = ViewWatcher(self, interval)
+            self.watcher.start()
+        return self.watcher
 
     def get_view(self, name):
         if name not in self.views_cache:
             raise KeyError('View {} not found'.format(name))
         return self.views_cache[name]
 
-    def build_views(self):
-        for v in self.views_cache.values():
-            v.build()
+
+class ViewWatcher(threading.Thread):
+    """
+    Background thread that reloads views when their files change.
+    Uses inotify where it's available, otherwise polls the file modification times.
+    """
+    def __init__(self, builder, interval):
+        super(ViewWatcher, self).__init__(name='view-watcher')
+        self.daemon = True
+        self.builder = builder
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def reload(self):
+        try:
+            changed = self.builder.reload_views()
+            if changed:
+                logging.info('Reloaded views %s', sorted(changed))
+        except Exception:
+            logging.exception('Error reloading views from %s', self.builder.location)
+
+    def run(self):
+        if inotify_simple is None:
+            self.poll()
+        else:
+            self.watch()
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            self.reload()
+
+    def watch(self):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+        watched = set()
+
+        with inotify_simple.INotify() as inotify:
+            while not self.stopped.is_set():
+                # pick up any new sub-directories
+                for r, _, _ in os.walk(self.builder.location):
+                    if r not in watched:
+                        inotify.add_watch(r, mask)
+                        watched.add(r)
+
+                if inotify.read(timeout=int(self.interval*1000), read_delay=50):
+                    self.reload()
 
 
 class HighChartsViewBuilder(JSONViewBuilder):
@@ -146,8 +410,10 @@ class HighChartsViewBuilder(JSONViewBuilder):
     def build_view(self, view_name, tags, data, extra):
         logging.debug('build_view(%s, %s)', view_name, tags)
 
+        # one lookup, so a reload part way through can't mix old and new definitions
         view = self.views_cache[view_name]
         ret = view.render_tags(tags)
-        ret['series'] = [v[0] for v in data]
+        series = {'series': [v[0] for v in data]}
 
-        return dict_merge([extra, ret])
+        # render_tags output is shared, so merge without modifying it
+        return dict_merge_shared([extra, ret, series])
@@ -0,0 +1,173 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+# Upper bounds, in seconds, of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    values = ('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+              for k, v in pairs)
+    return '{' + ','.join(values) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    """
+    A Prometheus style histogram, with a set of buckets for each distinct set of labels.
+    Observing is a bisect and a few additions under a lock, so it's cheap enough to leave on.
+    """
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # labels -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted((k, v) for k, v in labels.items() if v is not None))
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+
+        with self.lock:
+            series = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.series.items())
+
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels, [('le', format_value(bound))]),
+                                                     cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(labels), count))
+
+        return lines
+
+
+class Registry(object):
+    """
+    The metrics exposed on /metrics.
+    Collectors are functions returning the current value of some gauges
+    as (name, description, [(labels dict, value)]), for stats that are already kept elsewhere.
+    """
+    def __init__(self):
+        self.histograms = []
+        self.collectors = []
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        ret = Histogram(name, description, buckets)
+        self.histograms.append(ret)
+        return ret
+
+    def add_collector(self, func):
+        self.collectors.append(func)
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+
+        for collector in self.collectors:
+            for name, description, samples in collector():
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} gauge'.format(name))
+                for labels, value in samples:
+                    lines.append('{}{} {}'.format(name, format_labels(sorted(labels.items())), format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram('bucephalus_stage_seconds',
+                                   'Time spent in each stage of building a page, by view type and handler')
+
+
+class StartupTimings(object):
+    """
+    How long each step of starting the app took, reported as a gauge
+    """
+    def __init__(self):
+        self.steps = []
+
+    def observe(self, step, seconds):
+        self.steps.append((step, seconds))
+
+    @contextmanager
+    def time(self, step):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(step, time.perf_counter() - t0)
+
+    def total(self):
+        return sum(seconds for _, seconds in self.steps)
+
+    def collect(self):
+        yield 'bucephalus_startup_seconds', 'Time taken by each step of starting the app', \
+            [({'step': step}, seconds) for step, seconds in self.steps]
+
+
+class Timings(object):
+    """
+    Times the stages of a single page build.
+    Each stage is recorded in the process-wide histograms as well as the totals for this page,
+    which are sent back to the client when the page is finished.
+    """
+    def __init__(self):
+        self.totals = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, **labels):
+        stage_seconds.observe(seconds, stage=stage, **labels)
+        with self.lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    @contextmanager
+    def time(self, stage, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0, **labels)
+
+    def summary(self):
+        """
+        Total milliseconds and number of observations for each stage
+        """
+        with self.lock:
+            return {stage: {'ms': round(total * 1000, 3), 'count': self.counts[stage]}
+                    for stage, total in self.totals.items()}
+
+    def server_timing(self, stages):
+        """
+        A Server-Timing header value for the given stages, for those done before the response starts
+        """
+        with self.lock:
+            return ', '.join('{};dur={:.3f}'.format(stage, self.totals[stage] * 1000)
+                             for stage in stages if stage in self.totals)
@@ -1,51 +1,216 @@
 import os
-import uuid
+import time
+import hashlib
 import logging
-import matplotlib as mpl
-mpl.use('agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
-plt.ioff()
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import ujson
 
 from bucephalus.baseviews import BaseViewBuilder
+from bucephalus.viewtools import hash_series
+
+
+_worker_ready = False
+
+
+def render(func, path, data):
+    """
+    Entry point for the render processes.
+    Each process only ever renders one figure at a time, so setting global styles is safe here
+    """
+    global _worker_ready
+    if not _worker_ready:
+        import matplotlib as mpl
+        mpl.use('agg')
+        import seaborn as sns
+        sns.set(style="white", palette="muted", color_codes=True)
+        _worker_ready = True
+
+    return func(path, data)
+
+
+def get_mp_context():
+    """
+    Render processes are started by a fork server rather than forked from the app process,
+    which runs other threads (and gevent's hub) whose locks a forked child could inherit held.
+    Where there's no fork server they're spawned
+    """
+    try:
+        return multiprocessing.get_context('forkserver')
+    except ValueError:
+        return multiprocessing.get_context('spawn')
+
+
+def new_figure(*args, **kwargs):
+    """
+    Creates a figure without going through pyplot and its global state
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(*args, **kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def save_figure(fig, path):
+    # write to a temporary file first so nobody is served a half-written image
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    fig.savefig(tmp_path, format='png')
+    os.replace(tmp_path, path)
+
+
+def overview_distribution(path, data):
+    """
+    This really needs the image size as an input
+    """
+    import seaborn as sns
+
+    key, values = data[0]
+
+    fig = new_figure(figsize=(20, 5))
+    axes = fig.subplots(1, 4)
+    sns.despine(fig=fig, left=True)
+    sns.distplot(values, kde=False, color="b", ax=axes[0])
+    sns.distplot(values, hist=False, rug=True, color="r", ax=axes[1])
+    sns.distplot(values, hist=False, color="g", kde_kws={"shade": True}, ax=axes[2])
+    sns.distplot(values, color="m", ax=axes[3])
+    save_figure(fig, path)
+    return path
+
+
+# matplotlib and seaborn are only imported by the render processes, when they draw one of these
+mpl_views = {
+    'overview_distribution': overview_distribution,
+}
+
+
+class ImageCache(object):
+    """
+    Keeps the image directory within a size and age limit,
+    deleting the least recently used images first
+    """
+    def __init__(self, image_dir, max_bytes, max_age, sweep_interval=60):
+        self.image_dir = image_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.lock = threading.Lock()
+
+    def touch(self, path):
+        """
+        Marks an image as used, returning False if it doesn't exist
+        """
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    def sweep(self, force=False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_sweep < self.sweep_interval:
+                return
+            self.last_sweep = now
+
+        images = []
+        for name in os.listdir(self.image_dir):
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(self.image_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            images.append((st.st_mtime, st.st_size, path))
+
+        # newest first, so we keep those
+        images.sort(reverse=True)
+        total = 0
+        for mtime, size, path in images:
+            total += size
+            if total > self.max_bytes or (self.max_age and now - mtime > self.max_age):
+                logging.debug('Evicting image %s', path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
 
 class MPLViewBuilder(BaseViewBuilder):
     """
     Matplotlib/seaborn views
+    Images are rendered in a pool of worker processes, and named by a hash of
+    everything that goes into them, so identical requests reuse the existing image.
     """
-    def __init__(self):
+    lazy = True
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config)
+
+    @classmethod
+    def catalog(cls, config):
+        return list(mpl_views)
+
+    def __init__(self, config=None):
+        config = config or {}
         self.image_dir = 'img'
 
         if not os.path.exists(self.image_dir):
             os.mkdir(self.image_dir)
 
-        self.views_cache = {
-            'overview_distribution': self.overview_distribution
-        }
+        self.views_cache = dict(mpl_views)
+
+        self.pool_size = config.get('MPL_POOL_SIZE', 2)
+        self.image_cache = ImageCache(self.image_dir,
+                                      config.get('IMAGE_CACHE_BYTES', 512*1024*1024),
+                                      config.get('IMAGE_CACHE_MAX_AGE', 24*60*60))
+
+        # The pool is created on first use, and identical renders in progress are shared
+        self._pool = None
+        self._in_flight = {}
+        self._lock = threading.Lock()
 
     def list_views(self):
         return sorted(self.views_cache.keys())
 
+    def get_pool(self):
+        # only called with self._lock held
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.pool_size, mp_context=get_mp_context())
+        return self._pool
+
+    def image_key(self, viewname, tags, data, extra):
+        h = hashlib.sha1(ujson.dumps([viewname, tags, extra], sort_keys=True).encode('utf-8'))
+        for key, values in data:
+            h.update(ujson.dumps(key).encode('utf-8'))
+            h.update(hash_series(values).encode('ascii'))
+        return h.hexdigest()
+
     def build_view(self, viewname, tags, data, extra):
         func = self.views_cache[viewname]
-        return {'result': func(data)}
+        ret = '/'.join([self.image_dir, self.image_key(viewname, tags, data, extra)+'.png'])
 
-    def overview_distribution(self, data):
-        """
-        This really needs the image size as an input
-        """
-        name = str(uuid.uuid1()).replace('-','')
-        ret = '/'.join([self.image_dir, name+'.png'])
+        if self.image_cache.touch(ret):
+            logging.debug('Reusing image %s', ret)
+            return {'result': ret}
 
-        key, values = data[0]
+        with self._lock:
+            future = self._in_flight.get(ret)
+            if future is None:
+                future = self._in_flight[ret] = self.get_pool().submit(render, func, ret, data)
+
+        try:
+            future.result()
+        finally:
+            with self._lock:
+                self._in_flight.pop(ret, None)
 
-        sns.set(style="white", palette="muted", color_codes=True)
-        f, axes = plt.subplots(1, 4, figsize=(20, 5))
-        sns.despine(left=True)
-        sns.distplot(values, kde=False, color="b", ax=axes[0])
-        sns.distplot(values, hist=False, rug=True, color="r", ax=axes[1])
-        sns.distplot(values, hist=False, color="g", kde_kws={"shade": True}, ax=axes[2])
-        sns.distplot(values, color="m")
-        f.savefig(ret)
         logging.debug('Saved image %s', ret)
-        return ret
+        self.image_cache.sweep()
+        return {'result': ret}
@@ -1,20 +1,109 @@
 import os
 import json
+import time
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
 
 
+def get_nav_path():
+    modpath = os.path.dirname(__file__)
+    return os.path.join(modpath, 'static', 'json', 'navdata.json')
+
+
 def build_pages(data_provider, token):
     """
     Build JSON pages for the entire website
     """
+    ret = data_provider.build_nav(token)
+    if ret is not None:
+        return ret
 
-    modpath = os.path.dirname(__file__)
-    datapath = os.path.join(modpath, 'static', 'json', 'navdata.json')
-    return json.load(open(datapath, 'r'))
+    with open(get_nav_path(), 'r') as fh:
+        return json.load(fh)
+
+
+def make_entry(data):
+    """
+    The serialised response for some data, with its strong ETag
+    """
+    body = json.dumps(data).encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()
+
+
+class NavCache(object):
+    """
+    Caches the serialised nav trees and token list, along with their ETags.
+    The nav file is re-read when its mtime changes, nav trees built by the provider are kept
+    per token while the provider's version stays the same, and the token list is refreshed
+    every token_ttl seconds, or when the provider's version changes.
+    """
+    def __init__(self, data_provider, token_ttl=60, max_tokens=64):
+        self.data_provider = data_provider
+        self.token_ttl = token_ttl
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+
+        self.file_entry = None  # (file stamp, entry)
+        self.token_navs = OrderedDict()  # token -> (provider version, entry)
+        self.tokens = None  # (provider version, expiry, entry)
+
+    def get_file_entry(self):
+        path = get_nav_path()
+        st = os.stat(path)
+        stamp = st.st_mtime_ns, st.st_size
+
+        with self.lock:
+            if self.file_entry is not None and self.file_entry[0] == stamp:
+                return self.file_entry[1]
+
+        logging.debug('Reading nav data from %s', path)
+        with open(path, 'r') as fh:
+            entry = make_entry(json.load(fh))
+
+        with self.lock:
+            self.file_entry = stamp, entry
+        return entry
+
+    def get_pages(self, token):
+        """
+        Returns the serialised nav tree for a token, and its ETag
+        """
+        version = self.data_provider.get_version()
+
+        with self.lock:
+            cached = self.token_navs.get(token)
+            if cached is not None and cached[0] == version:
+                self.token_navs.move_to_end(token)
+                return cached[1]
 
+        nav = self.data_provider.build_nav(token)
+        if nav is None:
+            return self.get_file_entry()
 
+        entry = make_entry(nav)
+        with self.lock:
+            self.token_navs[token] = version, entry
+            while len(self.token_navs) > self.max_tokens:
+                self.token_navs.popitem(last=False)
+        return entry
 
+    def get_tokens(self):
+        """
+        Returns the serialised token list, and its ETag
+        """
+        version = self.data_provider.get_version()
 
+        with self.lock:
+            if self.tokens is not None:
+                cached_version, expiry, entry = self.tokens
+                if cached_version == version and expiry > time.time():
+                    return entry
 
+        entry = make_entry(self.data_provider.get_tokens())
+        with self.lock:
+            self.tokens = version, time.time() + self.token_ttl, entry
+        return entry
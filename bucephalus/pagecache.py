@@ -0,0 +1,182 @@
+import os
+import time
+import pickle
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+def entry_nbytes(messages):
+    return sum(len(chunk) for chunk, _ in messages)
+
+
+def make_ref(msg):
+    """
+    The reference that can stand in for a data message, when the client already holds its data
+    """
+    if msg.get('category') != 'data' or msg.get('hash') is None:
+        return None
+    return {'id': msg['id'], 'category': 'ref', 'series': msg['series'], 'hash': msg['hash']}
+
+
+class PageCache(object):
+    """
+    Cache of whole /views streams, keyed by (token, encoding, viewlist hash).
+    An entry is the list of encoded messages for a page, each with the reference that
+    can replace it if it's a data message, so it can be replayed to clients holding some of the data.
+    Entries are evicted least recently used first, once the total size exceeds max_bytes.
+    Evicted entries are spilled to spill_dir, if given, and read back from there on the next hit.
+    An optional ttl (in seconds) applies to entries in memory and on disk alike.
+    """
+    def __init__(self, max_bytes, spill_dir=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.ttl = ttl
+
+        self.entries = OrderedDict()  # key -> (messages, nbytes, expiry)
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_spill_path(self, key):
+        # tokens come from the url, so they're hashed rather than used as file names
+        token = hashlib.sha1(key[0].encode('utf-8')).hexdigest()
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, token, name + '.pickle')
+
+    def get(self, key):
+        """
+        Returns the cached messages for a page, or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                messages, nbytes, expiry = entry
+                if expiry is None or expiry > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return messages
+                self._remove(key)
+
+        messages, expiry = self.read_spill(key)
+        with self.lock:
+            if messages is None:
+                self.misses += 1
+                return None
+            self.spill_hits += 1
+            evicted = self._store(key, messages, expiry)
+
+        self.spill(evicted)
+        return messages
+
+    def put(self, key, messages):
+        expiry = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            evicted = self._store(key, messages, expiry)
+        self.spill(evicted)
+
+    def _store(self, key, messages, expiry):
+        # returns the entries evicted to make room, which are spilled once the lock is released
+        nbytes = entry_nbytes(messages)
+        if nbytes > self.max_bytes:
+            logging.debug('Page %s is too large to cache (%d bytes)', key, nbytes)
+            return [(key, messages, expiry)]
+
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (messages, nbytes, expiry)
+        self.current_bytes += nbytes
+
+        evicted = []
+        while self.current_bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            oldest_messages, _, oldest_expiry = self.entries[oldest]
+            self._remove(oldest)
+            self.evictions += 1
+            evicted.append((oldest, oldest_messages, oldest_expiry))
+        return evicted
+
+    def _remove(self, key):
+        _, nbytes, _ = self.entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def spill(self, evicted):
+        """
+        Writes evicted pages to disk, if we have somewhere to put them
+        """
+        if self.spill_dir is None:
+            return
+
+        for key, messages, expiry in evicted:
+            path = self.get_spill_path(key)
+            tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(tmp_path, 'wb') as fh:
+                    pickle.dump((expiry, messages), fh, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            except OSError:
+                logging.exception('Error spilling page %s to disk', key)
+
+    def read_spill(self, key):
+        """
+        Takes a page back from disk, returning its messages and expiry, or (None, None)
+        """
+        if self.spill_dir is None:
+            return None, None
+
+        path = self.get_spill_path(key)
+        try:
+            with open(path, 'rb') as fh:
+                expiry, messages = pickle.load(fh)
+            os.remove(path)
+        except FileNotFoundError:
+            return None, None
+        except Exception:
+            logging.exception('Error reading spilled page %s', key)
+            return None, None
+
+        if expiry is not None and expiry <= time.time():
+            return None, None
+        return messages, expiry
+
+    def invalidate(self, token):
+        """
+        Drops every cached page for a token, returning how many there were in memory
+        """
+        with self.lock:
+            keys = [key for key in self.entries if key[0] == token]
+            for key in keys:
+                self._remove(key)
+
+        if self.spill_dir is not None:
+            token_dir = os.path.dirname(self.get_spill_path((token,)))
+            shutil.rmtree(token_dir, ignore_errors=True)
+
+        logging.info('Invalidated %d cached pages for %s', len(keys), token)
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+        if self.spill_dir is not None and os.path.isdir(self.spill_dir):
+            for name in os.listdir(self.spill_dir):
+                shutil.rmtree(os.path.join(self.spill_dir, name), ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'spill_hits': self.spill_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -0,0 +1,155 @@
+import os
+import gzip
+import shutil
+import logging
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+from bucephalus import metrics
+from bucephalus.scheduler import INTERACTIVE
+from bucephalus.viewtools import stream_encoders
+
+
+# File extension of each precomputed stream encoding, which is also how clients ask for one
+page_extensions = {'json': '.json', 'binary': '.bin'}
+
+
+def iter_pages(nav, parents=()):
+    """
+    Yields every page in a nav tree that has views, along with its path,
+    the nav text of the page and its parents joined with /
+    """
+    for page in nav:
+        levels = parents + (page['text'],)
+        if page.get('views'):
+            yield '/'.join(levels), page
+        for ret in iter_pages(page.get('nodes', []), levels):
+            yield ret
+
+
+def find_page(nav, path):
+    """
+    Returns the page at a path in the nav tree, or None
+    """
+    for page_path, page in iter_pages(nav):
+        if page_path == path:
+            return page
+    return None
+
+
+def is_safe_path(path):
+    """
+    Whether a page path can be used as a file path, without pointing outside the token's directory
+    """
+    return all(level not in ('', '.', '..') and os.sep not in level for level in path.split('/'))
+
+
+def collect_page(view_defs, token, viewlist, priority=INTERACTIVE):
+    """
+    Builds a page, returning the messages that /views would stream for it
+    """
+    timings = metrics.Timings()
+    result_queue = Queue()
+
+    build_job = view_defs.build_views(token, viewlist, result_queue, priority, timings=timings)
+
+    messages = []
+    while True:
+        result = result_queue.get(block=True)
+        if result is None:
+            break
+        messages.append(result)
+    build_job.join()
+
+    messages.append({'id': 0, 'category': 'status', 'timings': timings.summary()})
+    return messages
+
+
+def write_file(path, body):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as fh:
+        fh.write(body)
+    os.replace(tmp_path, path)
+
+
+def write_page(path, messages, encodings, level=9):
+    """
+    Writes a page's messages as a stream file for each encoding, along with a gzipped copy
+    for nginx's gzip_static to send to clients that accept it
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+
+    for encoding in encodings:
+        encode, _ = stream_encoders[encoding]
+        # encoding replaces the data in a message, so each one gets a copy
+        body = b''.join(encode(dict(msg)) for msg in messages)
+        filename = path + page_extensions[encoding]
+        write_file(filename, body)
+        write_file(filename + '.gz', gzip.compress(body, compresslevel=level, mtime=0))
+
+
+def precompute_page(view_defs, token, page_path, page, out_dir, encodings, level=9):
+    """
+    Builds one page and writes out its streams, unless any of its views failed,
+    in which case it's left for the app to build on request.
+    Pages with queries that aren't deterministic are left to the app as well,
+    as static files would freeze one result of them for good.
+    Returns whether the page was written
+    """
+    try:
+        if not view_defs.is_deterministic(page['views']):
+            logging.warning('Not precomputing page %s, which has queries that aren\'t deterministic', page_path)
+            return False
+
+        messages = collect_page(view_defs, token, page['views'])
+    except Exception:
+        logging.exception('Error building page %s', page_path)
+        return False
+
+    errors = [msg for msg in messages if msg.get('category') == 'error']
+    if errors:
+        logging.warning('Not precomputing page %s, which has %d errors: %s',
+                        page_path, len(errors), errors[0].get('message'))
+        return False
+
+    write_page(os.path.join(out_dir, *page_path.split('/')), messages, encodings, level)
+    logging.info('Precomputed page %s', page_path)
+    return True
+
+
+def precompute_token(view_defs, nav, token, out_dir, encodings=('json', 'binary'), workers=4, level=9):
+    """
+    Precomputes every page in a token's nav tree to out_dir/<token>/<page path>.<ext>, several pages at a time.
+    The pages are written to a temporary directory that then replaces the token's,
+    so the files served are always from one run, and pages that have gone from the nav go with them.
+    Returns the number of pages written, and the number that failed
+    """
+    token_dir = os.path.join(out_dir, token)
+    if os.path.dirname(os.path.abspath(token_dir)) != os.path.abspath(out_dir):
+        raise RuntimeError('Invalid token {}'.format(token))
+
+    pages = []
+    for page_path, page in iter_pages(nav):
+        if is_safe_path(page_path):
+            pages.append((page_path, page))
+        else:
+            logging.warning('Skipping page %s, as its path can\'t be used as a file name', page_path)
+
+    tmp_dir = '{}.{}.tmp'.format(token_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(precompute_page, view_defs, token, page_path, page, tmp_dir, encodings, level)
+                       for page_path, page in pages]
+            written = sum(future.result() for future in futures)
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+
+    if os.path.exists(token_dir):
+        shutil.rmtree(token_dir)
+    os.rename(tmp_dir, token_dir)
+
+    return written, len(pages) - written
@@ -0,0 +1,148 @@
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+def result_nbytes(result):
+    """
+    Approximate in-memory size of a query result
+    """
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+
+    if isinstance(result, pd.Series):
+        return int(result.memory_usage(index=True, deep=True))
+
+    if isinstance(result, np.ndarray):
+        return result.nbytes
+
+    return sys.getsizeof(result)
+
+
+class _Fetch(object):
+    """
+    A fetch in progress, which other requests for the same key can wait on
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QueryCache(object):
+    """
+    Process-wide cache of query results, keyed by (token, query).
+    Tokens are immutable data snapshots, so results never go stale,
+    but an optional ttl (in seconds) can be given for providers where they might.
+    Entries are evicted least recently used first, once the total size exceeds max_bytes.
+    Concurrent requests for the same key wait on the fetch already in flight.
+    """
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.entries = OrderedDict()  # key -> (result, nbytes, expiry)
+        self.in_flight = {}
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+
+    def get(self, key, fetch):
+        """
+        Returns the cached result for key, calling fetch() to get it if necessary
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                result, nbytes, expiry = entry
+                if expiry is None or expiry > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                self._remove(key)
+
+            pending = self.in_flight.get(key)
+            if pending is not None:
+                self.waits += 1
+                owner = False
+            else:
+                pending = self.in_flight[key] = _Fetch()
+                self.misses += 1
+                owner = True
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.result
+
+        try:
+            pending.result = fetch()
+        except Exception as ex:
+            pending.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if pending.error is None:
+                    self._store(key, pending.result)
+            pending.event.set()
+
+        return pending.result
+
+    def _store(self, key, result):
+        # Failed queries are retried next time rather than cached
+        if result is None:
+            return
+
+        nbytes = result_nbytes(result)
+        if nbytes > self.max_bytes:
+            logging.debug('Query result %s is too large to cache (%d bytes)', key, nbytes)
+            return
+
+        expiry = time.time() + self.ttl if self.ttl else None
+        self.entries[key] = (result, nbytes, expiry)
+        self.current_bytes += nbytes
+
+        while self.current_bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, nbytes, _ = self.entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def invalidate(self, token):
+        """
+        Drops every cached result for a token, returning how many there were
+        """
+        with self.lock:
+            keys = [key for key in self.entries if key[0] == token]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'waits': self.waits,
+                    'evictions': self.evictions}
@@ -0,0 +1,175 @@
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlencode
+
+import numpy as np
+import pandas as pd
+
+
+# start and end are epoch milliseconds, inclusive. last keeps the last N points,
+# after the data is resampled to freq, a pandas frequency string, if given
+QueryWindow = namedtuple('QueryWindow', ['start', 'end', 'last', 'freq'])
+
+window_keys = QueryWindow._fields
+
+
+def to_timestamp(date):
+    """
+    Converts a date, or epoch milliseconds, to epoch milliseconds
+    """
+    if date is None or isinstance(date, (int, np.integer)):
+        return date
+    return pd.Timestamp(date).value // 1000000
+
+
+def format_timestamp(ts):
+    ret = pd.Timestamp(ts, unit='ms')
+    return ret.strftime('%Y-%m-%d') if ret == ret.normalize() else ret.isoformat()
+
+
+def make_window(params):
+    """
+    Builds a window from a dict of window parameters, or returns None if there aren't any
+    """
+    unknown = set(params) - set(window_keys)
+    if unknown:
+        raise RuntimeError('Unknown query parameters {} - valid options are: {}'.format(sorted(unknown), window_keys))
+
+    if not any(params.get(k) is not None for k in window_keys):
+        return None
+
+    last = params.get('last')
+    if last is not None:
+        last = int(last)
+        if last <= 0:
+            raise RuntimeError('last must be positive, not {}'.format(last))
+
+    return QueryWindow(to_timestamp(params.get('start')), to_timestamp(params.get('end')), last, params.get('freq'))
+
+
+def parse_query(query):
+    """
+    Splits a query of the form name?start=&end=&last=&freq= into its name and window
+    """
+    if not query or '?' not in query:
+        return query, None
+
+    base, params = query.split('?', 1)
+    return base, make_window(dict(parse_qsl(params, strict_parsing=True)))
+
+
+def format_query(base, window):
+    """
+    The canonical form of a query, so the same window is always written the same way
+    """
+    if window is None:
+        return base
+
+    params = []
+    for k, v in zip(window_keys, window):
+        if v is None:
+            continue
+        if k in ('start', 'end'):
+            v = format_timestamp(v)
+        params.append((k, v))
+
+    return '{}?{}'.format(base, urlencode(params))
+
+
+def series_query(series):
+    """
+    The query for a series definition, which may give the window in its own keys as well as in the query
+    """
+    base, window = parse_query(series['query'])
+
+    params = {k: series[k] for k in window_keys if series.get(k) is not None}
+    if not params:
+        return format_query(base, window)
+
+    if window is not None:
+        params = dict(window._asdict(), **params)
+    return format_query(base, make_window(params))
+
+
+def merge_key(window):
+    """
+    Windows with the same merge key can be fetched as one query for their union, and each cut from
+    the result exactly as if it had been fetched on its own.
+    Date ranges can be cut from any wider range, but resampling and then cutting dates doesn't give
+    the same periods at the ends as cutting and then resampling, so resampled windows are only merged
+    with ones over the same dates. Last-N windows are only merged when they end at the same point,
+    so they keep their pushdown rather than fetching the whole history
+    """
+    if window is None:
+        return ('range',)
+    if window.freq is not None:
+        return ('freq', window.freq, window.start, window.end)
+    if window.start is None and window.last is not None:
+        return ('last', window.end)
+    return ('range',)
+
+
+def cut_window(window, union):
+    """
+    The window to cut from the result of fetching union, which has the same merge key, or None for all of it
+    """
+    if window == union:
+        return None
+    if window is not None and window.freq is not None:
+        # the union is already resampled, over the same dates
+        return QueryWindow(None, None, window.last, None)
+    return window
+
+
+def union_window(windows):
+    """
+    The smallest window covering all of the given ones, which must share a merge key.
+    None stands for the whole history.
+    """
+    if any(w is None for w in windows):
+        return None
+
+    freq = windows[0].freq
+    ends = [w.end for w in windows]
+    end = None if None in ends else max(ends)
+
+    # last-N windows ending at the same point just need the longest of them
+    if all(w.last is not None and w.start is None for w in windows) and len(set(ends)) == 1:
+        return QueryWindow(None, end, max(w.last for w in windows), freq)
+
+    # otherwise a last-N window could start anywhere, so we need everything before the end
+    starts = [w.start for w in windows]
+    start = None if None in starts else min(starts)
+
+    if start is None and end is None and freq is None:
+        return None
+    return QueryWindow(start, end, None, freq)
+
+
+def apply_window(data, window):
+    """
+    Cuts a [date, value] timeseries, sorted by date, down to a window.
+    Dates are filtered first, then the data is resampled to the last value in each period, then
+    the last N points are kept. The date slice is a binary search, and makes no copies
+    """
+    if window is None:
+        return data
+
+    if not isinstance(data, pd.DataFrame) or data.shape[1] != 2:
+        raise RuntimeError('Query windows only apply to [date, value] timeseries')
+
+    if window.start is not None or window.end is not None:
+        dates = data.iloc[:, 0].values
+        lo = 0 if window.start is None else np.searchsorted(dates, window.start, side='left')
+        hi = len(dates) if window.end is None else np.searchsorted(dates, window.end, side='right')
+        data = data.iloc[lo:hi]
+
+    if window.freq is not None:
+        index = pd.to_datetime(data.iloc[:, 0].values, unit='ms')
+        resampled = pd.Series(data.iloc[:, 1].values, index=index).resample(window.freq).last().dropna()
+        data = pd.DataFrame({0: resampled.index.values.astype('datetime64[ms]').astype(np.int64),
+                             1: resampled.values})
+
+    if window.last is not None:
+        data = data.iloc[-window.last:]
+
+    return data
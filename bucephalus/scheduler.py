@@ -0,0 +1,130 @@
+import logging
+import itertools
+import threading
+from queue import PriorityQueue
+
+INTERACTIVE = 0
+PREFETCH = 1
+
+priorities = {'interactive': INTERACTIVE, 'prefetch': PREFETCH}
+
+
+class SchedulerFull(Exception):
+    """
+    Raised when a page build can't be admitted because the queue is full
+    """
+    pass
+
+
+def gevent_patched():
+    """
+    Whether gevent has monkey patched threading, as it does under gunicorn's gevent workers
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+def spawn(func):
+    """
+    Starts func in the background - as a greenlet under gevent, so it cooperates with the
+    hub rather than running as a real thread next to it, and as a daemon thread otherwise
+    """
+    if gevent_patched():
+        import gevent
+        return gevent.spawn(func)
+
+    thread = threading.Thread(target=func)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class BuildJob(object):
+    """
+    A page build waiting for, or running on, a scheduler worker
+    """
+    def __init__(self, func, priority, cancelled=None):
+        self.func = func
+        self.priority = priority
+        self.cancelled = cancelled or threading.Event()
+        self.finished = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        try:
+            # don't start builds that nobody is waiting for any more
+            if not self.cancelled.is_set():
+                self.func()
+        except Exception:
+            logging.exception('Error running page build')
+        finally:
+            self.finished.set()
+
+    def join(self, timeout=None):
+        return self.finished.wait(timeout)
+
+
+class BuildScheduler(object):
+    """
+    Runs page builds on a fixed number of workers shared by all requests.
+    Interactive builds are started ahead of prefetches.
+    At most max_queue builds can wait for a worker, and prefetches are only
+    admitted while the queue is less than prefetch_share full, so they're shed first.
+    """
+    def __init__(self, workers, max_queue, prefetch_share=0.5):
+        self.n_workers = workers
+        self.max_queue = max_queue
+        self.max_prefetch = int(max_queue * prefetch_share)
+
+        self.reset()
+
+    def reset(self):
+        self.queue = PriorityQueue()
+        self.order = itertools.count()
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+        # Workers are started on first use, so they're created in the process that uses them
+        self.workers = []
+
+    def after_fork(self):
+        """
+        Called in a forked worker process, where none of the parent's workers are running
+        """
+        self.reset()
+
+    def submit(self, func, priority=INTERACTIVE, cancelled=None):
+        """
+        Queues func to run on a worker, returning its BuildJob.
+        func should watch the cancelled event, if given, to stop early.
+        Raises SchedulerFull if it can't be admitted
+        """
+        limit = self.max_queue if priority == INTERACTIVE else self.max_prefetch
+
+        with self.lock:
+            if not self.workers:
+                self.workers = [spawn(self.worker) for _ in range(self.n_workers)]
+
+            if self.waiting >= limit:
+                raise SchedulerFull('{} page builds are already waiting'.format(self.waiting))
+            self.waiting += 1
+
+        job = BuildJob(func, priority, cancelled)
+        self.queue.put((priority, next(self.order), job))
+        return job
+
+    def worker(self):
+        while True:
+            _, _, job = self.queue.get()
+            with self.lock:
+                self.waiting -= 1
+            job.run()
+
+    def stats(self):
+        with self.lock:
+            return {'workers': self.n_workers, 'waiting': self.waiting, 'max_queue': self.max_queue}
@@ -0,0 +1,246 @@
+import os
+import json
+import shutil
+import logging
+import argparse
+import threading
+
+import numpy as np
+import pandas as pd
+
+from bucephalus.dataprovider import BaseDataProvider, load_provider
+from bucephalus.querywindow import parse_query, apply_window, to_timestamp
+
+
+INDEX_FILE = 'index.json'
+TIMESTAMPS_FILE = 'ts.bin'
+VALUES_FILE = 'values.bin'
+
+
+def split_series(data):
+    """
+    Splits [date, value] query data into int64 epoch milliseconds and float64 values
+    """
+    if not isinstance(data, pd.DataFrame) or data.shape[1] != 2:
+        raise RuntimeError('Only [date, value] timeseries can be stored')
+
+    dates = data.iloc[:, 0].values
+    if np.issubdtype(dates.dtype, np.datetime64):
+        dates = dates.astype('datetime64[ms]').astype(np.int64)
+    else:
+        dates = dates.astype(np.int64)
+
+    return dates, data.iloc[:, 1].values.astype(np.float64)
+
+
+class SeriesStore(object):
+    """
+    Read-only, memory mapped store of the series for one token.
+    Every series is a contiguous run of int64 timestamps in ts.bin, and float64 values in values.bin,
+    found through a small json index of offsets, so reads are views onto the mapped files.
+    As the files are mapped read-only, every process reading them shares the one copy in the page cache.
+    """
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, INDEX_FILE), 'r') as fh:
+            self.index = json.load(fh)['series']
+
+        # np.memmap can't map empty files
+        if self.index:
+            self.timestamps = np.memmap(os.path.join(path, TIMESTAMPS_FILE), dtype=np.int64, mode='r')
+            self.values = np.memmap(os.path.join(path, VALUES_FILE), dtype=np.float64, mode='r')
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def names(self):
+        return sorted(self.index)
+
+    def get_arrays(self, name, start=None, end=None, last=None):
+        """
+        Returns the timestamps and values of a series, between the start and end dates inclusive,
+        and only the last N of those if given.
+        Both are views onto the mapped files, found by binary search
+        """
+        if name not in self.index:
+            raise KeyError('No series {} in store {}'.format(name, self.path))
+
+        offset, length = self.index[name]
+        timestamps = self.timestamps[offset:offset+length]
+
+        lo = 0 if start is None else np.searchsorted(timestamps, to_timestamp(start), side='left')
+        hi = length if end is None else np.searchsorted(timestamps, to_timestamp(end), side='right')
+        if last is not None:
+            lo = max(lo, hi - last)
+
+        # views as plain arrays, so nothing downstream treats them as files
+        return (timestamps[lo:hi].view(np.ndarray),
+                self.values[offset+lo:offset+hi].view(np.ndarray))
+
+    def get(self, name, start=None, end=None, last=None):
+        """
+        Returns a series as a [date, value] frame, without copying it
+        """
+        timestamps, values = self.get_arrays(name, start, end, last)
+        return pd.DataFrame({0: timestamps, 1: values}, copy=False)
+
+
+class SeriesStoreWriter(object):
+    """
+    Builds the store for one token.
+    It's written to a temporary directory that replaces any existing store when closed,
+    so readers never see a half-written one
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = '{}.{}.tmp'.format(path.rstrip(os.sep), os.getpid())
+        os.makedirs(self.tmp_path)
+
+        self.index = {}
+        self.offset = 0
+        self.ts_fh = open(os.path.join(self.tmp_path, TIMESTAMPS_FILE), 'wb')
+        self.values_fh = open(os.path.join(self.tmp_path, VALUES_FILE), 'wb')
+
+    def add(self, name, timestamps, values):
+        if name in self.index:
+            raise RuntimeError('Series {} has already been written'.format(name))
+
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        if len(timestamps) != len(values):
+            raise RuntimeError('Series {} has {} timestamps but {} values'.format(name, len(timestamps), len(values)))
+
+        # slicing by date relies on the timestamps being sorted
+        if len(timestamps) and np.any(np.diff(timestamps) < 0):
+            order = np.argsort(timestamps, kind='mergesort')
+            timestamps, values = timestamps[order], values[order]
+
+        self.ts_fh.write(timestamps.tobytes())
+        self.values_fh.write(values.tobytes())
+        self.index[name] = [self.offset, len(timestamps)]
+        self.offset += len(timestamps)
+
+    def close(self):
+        self.ts_fh.close()
+        self.values_fh.close()
+
+        with open(os.path.join(self.tmp_path, INDEX_FILE), 'w') as fh:
+            json.dump({'version': 1, 'series': self.index}, fh)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+class SeriesStoreProvider(BaseDataProvider):
+    """
+    Serves tokens from series stores, each one a directory of SERIES_STORE_DIR.
+    A query is the name of a series in the token's store, and any date window is sliced
+    straight out of the mapped files.
+    Tokens are immutable, so each store is opened once and shared by all requests.
+    """
+    supports_windows = True
+
+    def __init__(self, config):
+        self.store_dir = config.get('SERIES_STORE_DIR', 'stores')
+        self.stores = {}
+        self.stores_lock = threading.Lock()
+        super(SeriesStoreProvider, self).__init__(config)
+
+    def __getstate__(self):
+        state = super(SeriesStoreProvider, self).__getstate__()
+        del state['stores']
+        del state['stores_lock']
+        return state
+
+    def __setstate__(self, state):
+        super(SeriesStoreProvider, self).__setstate__(state)
+        self.stores = {}
+        self.stores_lock = threading.Lock()
+
+    def after_fork(self):
+        super(SeriesStoreProvider, self).after_fork()
+        self.stores_lock = threading.Lock()
+
+    def preload(self):
+        # the stores are mapped read-only, so workers forked after this share the one set of mappings
+        for token in self.get_tokens():
+            self.get_store(token)
+
+    def get_tokens(self):
+        if not os.path.isdir(self.store_dir):
+            return []
+        return sorted(name for name in os.listdir(self.store_dir)
+                      if os.path.exists(os.path.join(self.store_dir, name, INDEX_FILE)))
+
+    def get_store(self, token):
+        with self.stores_lock:
+            store = self.stores.get(token)
+            if store is None:
+                if token not in self.get_tokens():
+                    raise RuntimeError('Unknown token {}'.format(token))
+                store = self.stores[token] = SeriesStore(os.path.join(self.store_dir, token))
+            return store
+
+    def run_query(self, conn, token, query):
+        if not query:
+            return
+
+        name, window = parse_query(query)
+        store = self.get_store(token)
+        if window is None:
+            return store.get(name)
+
+        if window.freq is None:
+            return store.get(name, window.start, window.end, window.last)
+        return apply_window(store.get(name, window.start, window.end), window._replace(start=None, end=None))
+
+    def get_query_data(self, token, query):
+        # Reads are views onto the mapped files, so there's nothing to gain by caching them
+        return self.run_single_query(token, query)
+
+
+def build_store(provider, token, queries, path):
+    """
+    Writes the results of the given queries on a provider to a series store
+    """
+    writer = SeriesStoreWriter(path)
+    try:
+        for query in queries:
+            timestamps, values = split_series(provider.get_query_data(token, query))
+            writer.add(query, timestamps, values)
+            logging.info('Stored %s: %d points', query, len(values))
+    except Exception:
+        writer.ts_fh.close()
+        writer.values_fh.close()
+        shutil.rmtree(writer.tmp_path)
+        raise
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds a series store for a token from any data provider',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', type=str, default='app.config',
+        help="Config file giving the provider to read from")
+    parser.add_argument('--provider', type=str, default=None,
+        help="Import path of the provider, if not the one in the config")
+    parser.add_argument('--token', type=str, required=True,
+        help="Token to read, and to name the store")
+    parser.add_argument('--out', type=str, default='stores',
+        help="Directory to write the store to")
+    parser.add_argument('queries', type=str, nargs='+',
+        help="Queries to store")
+    params = parser.parse_args()
+
+    with open(params.config, 'r') as fh:
+        config = json.load(fh)
+    if params.provider is not None:
+        config['DATA_PROVIDER'] = params.provider
+
+    provider = load_provider(config)
+    try:
+        build_store(provider, params.token, params.queries, os.path.join(params.out, params.token))
+    finally:
+        provider.shutdown()
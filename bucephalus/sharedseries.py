@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import atexit
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8
+    shared_memory = resource_tracker = None
+
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+
+
+
+# magic, sha1 of the (token, query) key, when it was created, number of points, the dtypes of the two columns,
+# the length of their json encoded names, which follow, and whether it's been written yet
+HEADER = struct.Struct('<8s20sdQ16s16sIB')
+READY_OFFSET = HEADER.size - 1
+MAGIC = b'BUCSER03'
+
+# Where linux lists the segments, so a name prefix can be swept
+SHM_DIR = '/dev/shm'
+
+
+def token_hash(token):
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()
+
+
+def get_columns(data):
+    """
+    Returns the dates, values and encoded column names of a [date, value] frame that can be shared
+    and read back exactly as it was, or None for anything else.
+    The dates must be datetime64 or integers, the values numbers, and the index the default one
+    """
+    if not isinstance(data, pd.DataFrame) or data.shape[1] != 2:
+        return None
+
+    if not data.index.equals(pd.RangeIndex(len(data))) or data.columns.name is not None:
+        return None
+
+    date_dtype, value_dtype = data.dtypes.iloc[0], data.dtypes.iloc[1]
+    if not isinstance(date_dtype, np.dtype) or date_dtype.kind not in 'Miu':
+        return None
+    if not isinstance(value_dtype, np.dtype) or value_dtype.kind not in 'iuf':
+        return None
+
+    # the names have to come back from json as they went in
+    names = list(data.columns)
+    try:
+        encoded = json.dumps(names).encode('utf-8')
+    except TypeError:
+        return None
+    if len(set(names)) != 2 or [(type(n), n) for n in json.loads(encoded)] != [(type(n), n) for n in names]:
+        return None
+
+    return data.iloc[:, 0].to_numpy(), data.iloc[:, 1].to_numpy(), encoded
+
+
+def get_layout(n, date_dtype, value_dtype, names_len):
+    """
+    Offsets of the dates and values in a segment, and its size
+    """
+    date_offset = (HEADER.size + names_len + 7) // 8 * 8
+    value_offset = (date_offset + n * date_dtype.itemsize + 7) // 8 * 8
+    return date_offset, value_offset, max(value_offset + n * value_dtype.itemsize, 1)
+
+
+def open_segment(name, create=False, size=0):
+    """
+    Opens a segment, keeping it away from the resource tracker, which would unlink it when this
+    process exits and take it from every other worker. The tracker is also shared with the process
+    we were forked from, so its registrations aren't ours to rely on, and we unlink segments ourselves.
+    Before python 3.13 it can't be kept away, so it's taken back off straight away
+    """
+    try:
+        return shared_memory.SharedMemory(name, create, size, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name, create, size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def unlink_segment(shm):
+    # before python 3.13 unlink also takes the segment off the resource tracker, which it isn't on
+    if getattr(shm, '_track', True) and _posixshmem is not None:
+        _posixshmem.shm_unlink(shm._name)
+    else:
+        shm.unlink()
+
+
+def sweep(prefix):
+    """
+    Unlinks every segment whose name starts with prefix, returning how many there were.
+    Only linux lists them, elsewhere there's nothing to do
+    """
+    if not os.path.isdir(SHM_DIR):
+        return 0
+
+    count = 0
+    for name in os.listdir(SHM_DIR):
+        if name.startswith(prefix):
+            try:
+                os.unlink(os.path.join(SHM_DIR, name))
+                count += 1
+            except OSError:
+                pass
+    return count
+
+
+class SharedSeries(object):
+    """
+    Query results shared between worker processes, in named shared memory segments.
+    A [date, value] frame is stored as its dates followed by its values, with their dtypes and
+    column names, in a segment named after its (token, query), so any worker can find it,
+    and reads are views onto the segment rather than copies.
+    Results of any other shape aren't shared, and stay with the process that fetched them.
+    Each process keeps the segments it created under max_bytes, unlinking the least recently
+    used past that, and unlinks the rest when it exits. Workers already attached to an unlinked
+    segment keep reading it until they close it, which they do once they have more than max_attached open.
+    Names start with prefix, which is the creating process id by default, so a gunicorn master
+    that creates this before forking can sweep up after workers that didn't exit cleanly.
+    An optional ttl (in seconds) applies from when a segment was created, after which any
+    process that finds it unlinks it.
+    """
+    def __init__(self, max_bytes, prefix=None, max_attached=1024, ttl=None):
+        if shared_memory is None:
+            raise RuntimeError('Shared series need multiprocessing.shared_memory, from python 3.8')
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prefix = prefix or 'bcp{}_'.format(os.getpid())
+        self.max_attached = max_attached
+        self.reset()
+
+        atexit.register(self.close)
+
+    def reset(self):
+        self.created = OrderedDict()  # name -> (SharedMemory, nbytes)
+        self.current_bytes = 0
+        self.attached = OrderedDict()  # name -> SharedMemory
+        self.closing = []  # attached segments that still had arrays using them when we tried to close them
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def after_fork(self):
+        """
+        Forgets the parent's segments, which are still the parent's to unlink
+        """
+        self.reset()
+
+    def segment_name(self, token, query):
+        key_hash = hashlib.sha1(repr((token, query)).encode('utf-8')).digest()
+        return self.prefix + token_hash(token)[:6] + key_hash.hex()[:12], key_hash
+
+    def get_arrays(self, shm):
+        """
+        The dates and values held in a segment, as views onto it, and their column names
+        """
+        _, _, _, n, date_dtype, value_dtype, names_len, _ = HEADER.unpack_from(shm.buf)
+        date_dtype = np.dtype(date_dtype.rstrip(b'\0').decode('ascii'))
+        value_dtype = np.dtype(value_dtype.rstrip(b'\0').decode('ascii'))
+        date_offset, value_offset, _ = get_layout(n, date_dtype, value_dtype, names_len)
+
+        names = json.loads(bytes(shm.buf[HEADER.size:HEADER.size + names_len]).decode('utf-8'))
+        return (np.ndarray((n,), dtype=date_dtype, buffer=shm.buf, offset=date_offset),
+                np.ndarray((n,), dtype=value_dtype, buffer=shm.buf, offset=value_offset),
+                names)
+
+    def read(self, shm):
+        """
+        The [date, value] frame held in a segment, as views onto it
+        """
+        dates, values, names = self.get_arrays(shm)
+        # other processes are reading the same memory
+        dates.flags.writeable = False
+        values.flags.writeable = False
+        return pd.DataFrame({names[0]: dates, names[1]: values}, columns=names, copy=False)
+
+    def get(self, token, query):
+        """
+        Returns the shared result of a query, or None if no process has stored it yet
+        """
+        name, key_hash = self.segment_name(token, query)
+
+        with self.lock:
+            shm = self.attached.get(name)
+            if shm is not None and not self.expired(shm):
+                self.attached.move_to_end(name)
+                self.hits += 1
+                return self.read(shm)
+
+        if shm is None:
+            try:
+                shm = open_segment(name)
+            except FileNotFoundError:
+                with self.lock:
+                    self.misses += 1
+                return None
+
+        magic, digest, _, _, _, _, _, ready = HEADER.unpack_from(shm.buf)
+        if magic != MAGIC or digest != key_hash or not ready:
+            # still being written, or a different key with the same name
+            shm.close()
+            with self.lock:
+                self.misses += 1
+            return None
+
+        if self.expired(shm):
+            self.remove(name, shm)
+            return None
+
+        with self.lock:
+            self.hits += 1
+            to_close = self._attach(name, shm)
+        self.close_segments(to_close)
+        return self.read(shm)
+
+    def expired(self, shm):
+        return self.ttl is not None and HEADER.unpack_from(shm.buf)[2] + self.ttl <= time.time()
+
+    def remove(self, name, shm):
+        """
+        Unlinks an expired segment, whichever process created it, so the next put can replace it
+        """
+        with self.lock:
+            self.misses += 1
+            self.attached.pop(name, None)
+            created = self.created.pop(name, None)
+            if created is not None:
+                self.current_bytes -= created[1]
+
+        self.unlink_segments([shm])
+        self.close_segments([shm])
+
+    def put(self, token, query, data):
+        """
+        Stores a query result for the other processes, returning it as views onto the shared copy,
+        or None if it can't be shared, so the caller keeps its own
+        """
+        columns = get_columns(data)
+        if columns is None:
+            return None
+
+        dates, values, names = columns
+        n = len(dates)
+        date_offset, value_offset, nbytes = get_layout(n, dates.dtype, values.dtype, len(names))
+        if nbytes > self.max_bytes:
+            logging.debug('Query result %s is too large to share (%d bytes)', query, nbytes)
+            return None
+
+        name, key_hash = self.segment_name(token, query)
+        try:
+            shm = open_segment(name, create=True, size=nbytes)
+        except FileExistsError:
+            # another worker got there first
+            return self.get(token, query)
+
+        HEADER.pack_into(shm.buf, 0, MAGIC, key_hash, time.time(), n, dates.dtype.str.encode('ascii'),
+                         values.dtype.str.encode('ascii'), len(names), 0)
+        shm.buf[HEADER.size:HEADER.size + len(names)] = names
+        np.ndarray((n,), dtype=dates.dtype, buffer=shm.buf, offset=date_offset)[:] = dates
+        np.ndarray((n,), dtype=values.dtype, buffer=shm.buf, offset=value_offset)[:] = values
+        # readers ignore the segment until this is set
+        shm.buf[READY_OFFSET] = 1
+
+        with self.lock:
+            self.stores += 1
+            self.created[name] = shm, nbytes
+            self.current_bytes += nbytes
+            to_close = self._attach(name, shm)
+
+            to_unlink = []
+            while self.current_bytes > self.max_bytes:
+                _, (oldest, oldest_nbytes) = self.created.popitem(last=False)
+                self.current_bytes -= oldest_nbytes
+                self.evictions += 1
+                to_unlink.append(oldest)
+
+        self.unlink_segments(to_unlink)
+        self.close_segments(to_close)
+        return self.read(shm)
+
+    def _attach(self, name, shm):
+        # returns the segments to close, to keep under max_attached
+        self.attached[name] = shm
+        to_close = []
+        while len(self.attached) > self.max_attached:
+            to_close.append(self.attached.popitem(last=False)[1])
+        return to_close
+
+    def close_segments(self, segments):
+        with self.lock:
+            segments = self.closing + segments
+            self.closing = []
+
+        still_open = []
+        for shm in segments:
+            try:
+                shm.close()
+            except BufferError:
+                # a page build still has a view of it, try again next time
+                still_open.append(shm)
+
+        if still_open:
+            with self.lock:
+                self.closing.extend(still_open)
+
+    def unlink_segments(self, segments):
+        for shm in segments:
+            try:
+                unlink_segment(shm)
+            except FileNotFoundError:
+                # already swept by another process
+                pass
+            except OSError:
+                logging.exception('Error unlinking shared series %s', shm.name)
+
+    def invalidate(self, token):
+        """
+        Unlinks every shared result for a token, whichever process created it, returning how many there were.
+        Other processes that have them attached keep them until they're closed
+        """
+        token_prefix = self.prefix + token_hash(token)[:6]
+
+        with self.lock:
+            to_unlink = []
+            for name in [name for name in self.created if name.startswith(token_prefix)]:
+                shm, nbytes = self.created.pop(name)
+                self.current_bytes -= nbytes
+                to_unlink.append(shm)
+            to_close = [self.attached.pop(name) for name in list(self.attached) if name.startswith(token_prefix)]
+
+        self.unlink_segments(to_unlink)
+        self.close_segments(to_close)
+        return len(to_unlink) + sweep(token_prefix)
+
+    def close(self):
+        """
+        Unlinks the segments this process created, and closes the ones it attached to
+        """
+        with self.lock:
+            to_unlink = [shm for shm, _ in self.created.values()]
+            self.created = OrderedDict()
+            self.current_bytes = 0
+            to_close, self.attached = list(self.attached.values()), OrderedDict()
+
+        self.unlink_segments(to_unlink)
+        self.close_segments(to_close)
+
+    def stats(self):
+        with self.lock:
+            return {'created': len(self.created),
+                    'attached': len(self.attached),
+                    'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'stores': self.stores,
+                    'evictions': self.evictions}
@@ -0,0 +1,126 @@
+import os
+import glob
+import sqlite3
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from bucephalus.dataprovider import BaseDataProvider
+from bucephalus.querywindow import parse_query, apply_window
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series (
+    name TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    value REAL,
+    PRIMARY KEY (name, date)
+) WITHOUT ROWID
+'''
+
+SELECT_SERIES = 'SELECT date, value FROM series WHERE name = ? AND date BETWEEN ? AND ? ORDER BY date'
+
+SELECT_LAST = ('SELECT date, value FROM series WHERE name = ? AND date BETWEEN ? AND ? '
+               'ORDER BY date DESC LIMIT ?')
+
+MIN_DATE, MAX_DATE = -2**63, 2**63 - 1
+
+
+class SQLiteDataProvider(BaseDataProvider):
+    """
+    Reference backend, reading series from SQLite databases.
+    Each token is a database file in the SQLITE_DIR directory, named <token>.db,
+    holding a single series table of (name, date, value) rows, with dates in epoch milliseconds.
+    A query is the name of a series, and is always run as one of the same parameterised statements,
+    so sqlite3 prepares them once per connection and reuses them from its statement cache.
+    Date windows are applied in the query, and only resampling is left to do afterwards.
+    """
+    supports_windows = True
+
+    def __init__(self, config):
+        self.db_dir = config.get('SQLITE_DIR', 'data')
+        super(SQLiteDataProvider, self).__init__(config)
+
+    def get_tokens(self):
+        paths = glob.glob(os.path.join(self.db_dir, '*.db'))
+        return sorted(os.path.splitext(os.path.basename(p))[0] for p in paths)
+
+    def get_path(self, token):
+        path = os.path.join(self.db_dir, token + '.db')
+        # tokens come from the url, so make sure they can't point outside the data directory
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.db_dir) or not os.path.exists(path):
+            raise RuntimeError('Unknown token {}'.format(token))
+        return path
+
+    def connect(self, token):
+        path = self.get_path(token)
+        logging.debug('Connecting to %s', path)
+        # read only, and shared between worker threads - the pool hands it to one at a time
+        return sqlite3.connect('file:{}?mode=ro'.format(path), uri=True, check_same_thread=False)
+
+    def check_connection(self, conn):
+        return conn.execute('SELECT 1').fetchone() == (1,)
+
+    def run_query(self, conn, token, query):
+        if not query:
+            return
+
+        name, window = parse_query(query)
+        start = MIN_DATE if window is None or window.start is None else window.start
+        end = MAX_DATE if window is None or window.end is None else window.end
+
+        if window is not None and window.last is not None and window.freq is None:
+            rows = conn.execute(SELECT_LAST, (name, start, end, window.last)).fetchall()[::-1]
+        else:
+            rows = conn.execute(SELECT_SERIES, (name, start, end)).fetchall()
+
+        if not rows:
+            raise RuntimeError('No data found for series {}'.format(query))
+
+        dates, values = zip(*rows)
+        ret = pd.DataFrame({0: np.array(dates, dtype=np.int64),
+                            1: np.array(values, dtype=np.float64)})
+
+        if window is not None and window.freq is not None:
+            ret = apply_window(ret, window._replace(start=None, end=None))
+        return ret
+
+
+def write_series(path, series):
+    """
+    Writes series to a database, creating it if necessary.
+    series maps names to (dates, values), with dates as datetimes or epoch milliseconds
+    """
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            conn.execute(SCHEMA)
+            for name, (dates, values) in series.items():
+                dates = np.asarray(dates)
+                if not np.issubdtype(dates.dtype, np.integer):
+                    dates = pd.DatetimeIndex(dates).values.astype('datetime64[ms]').astype(np.int64)
+                rows = zip([name] * len(values), (int(d) for d in dates), (float(v) for v in values))
+                conn.executemany('INSERT OR REPLACE INTO series VALUES (?, ?, ?)', rows)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Creates a SQLite database of synthetic series',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', type=str,
+        help="Database to create, e.g. data/<token>.db")
+    parser.add_argument('--series', type=int, default=10,
+        help="Number of series")
+    parser.add_argument('--length', type=int, default=2000,
+        help="Points per series")
+    parser.add_argument('--seed', type=int, default=0,
+        help="Random seed")
+    params = parser.parse_args()
+
+    rng = np.random.RandomState(params.seed)
+    dates = pd.bdate_range('2000-01-03', periods=params.length, freq='B')
+    write_series(params.path, {'series.{}'.format(i): (dates, rng.standard_normal(params.length) * 0.01)
+                               for i in range(params.series)})
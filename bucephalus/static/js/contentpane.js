@@ -10,11 +10,28 @@ var buildTagString = function(tags){
 	return ret;
 }
 
+// correlation views are sent as a dense matrix, but heatmaps need [x, y, value] points
+var matrixToPoints = function(matrix) {
+	var ret = [];
+
+	$.each(matrix, function(i, row) {
+		$.each(row, function(j, value) {
+			ret.push([i, j, value]);
+		});
+	});
+
+	return ret;
+}
+
 var renderView = function(target, info, definition, seriesNameToData) {
 	var data = [];
 
 	$.each(definition.series, function(i, series) {
-		data.push({name: series[1], data: seriesNameToData[series]});
+		var values = seriesNameToData[series];
+		if (info.handler == 'correlation') {
+			values = matrixToPoints(values);
+		}
+		data.push({name: series[1], data: values});
 	});
 
 	definition.series = data;
@@ -66,13 +83,150 @@ var getErrorTarget = function(viewdata, viewinfo) {
 
 }
 
-var parseChunk = function(chunk, dataBlocks, viewinfo) {
+// Series data can be sent as packed binary columns rather than json text, which stays the default.
+// Deployments that want binary turn it on here, or it can be asked for with ?encoding=binary in the page url.
+// Either way it's only used where the browser can read the response as a stream of bytes.
+var preferBinarySeries = false;
+
+var canReadBinarySeries = (window.fetch !== undefined && window.ReadableStream !== undefined &&
+	window.TextDecoder !== undefined);
+
+var useBinarySeries = canReadBinarySeries &&
+	(preferBinarySeries || /[?&]encoding=binary(&|$)/.test(window.location.search));
+
+var columnSizes = {'int64': 8, 'float64': 8, 'float32': 4};
+
+var decodeColumn = function(bytes, dtype, rows) {
+	// copy the column out first, so the typed array is aligned
+	var buffer = bytes.slice().buffer;
+	var ret = new Array(rows);
+	var i, values;
+
+	if (dtype == 'int64') {
+		// read as 32-bit halves - dates fit easily in a double
+		values = new Int32Array(buffer);
+		for (i = 0; i < rows; i++) {
+			ret[i] = values[2*i+1] * 4294967296 + (values[2*i] >>> 0);
+		}
+		return ret;
+	}
+
+	values = (dtype == 'float32') ? new Float32Array(buffer) : new Float64Array(buffer);
+	for (i = 0; i < rows; i++) {
+		ret[i] = isNaN(values[i]) ? null : values[i];
+	}
+	return ret;
+}
 
-	var chunkObj = JSON.parse(chunk);
+// rebuilds the [date, value] rows that the json encoding would have sent
+var decodeFrameData = function(header, payload) {
+	var columns = [];
+	var offset = 0;
+
+	$.each(header.columns, function(i, dtype) {
+		var nbytes = header.rows * columnSizes[dtype];
+		columns.push(decodeColumn(payload.subarray(offset, offset + nbytes), dtype, header.rows));
+		offset += nbytes;
+	});
+
+	if (columns.length == 1) {
+		return columns[0];
+	}
+
+	var ret = new Array(header.rows);
+	for (var i = 0; i < header.rows; i++) {
+		var row = [];
+		for (var j = 0; j < columns.length; j++) {
+			row.push(columns[j][i]);
+		}
+		ret[i] = row;
+	}
+	return ret;
+}
+
+// Each frame is the header and payload lengths as little-endian uint32s, the json header, then the payload.
+// Handles every complete frame in the buffer, and returns whatever is left over.
+var parseFrames = function(buffer, handler) {
+	var decoder = new TextDecoder('utf-8');
+	var offset = 0;
+
+	while (buffer.length - offset >= 8) {
+		var lengths = new DataView(buffer.buffer, buffer.byteOffset + offset, 8);
+		var headerEnd = offset + 8 + lengths.getUint32(0, true);
+		var frameEnd = headerEnd + lengths.getUint32(4, true);
+
+		if (frameEnd > buffer.length) {
+			break;
+		}
+
+		var header = JSON.parse(decoder.decode(buffer.subarray(offset + 8, headerEnd)));
+		if (header.columns != undefined) {
+			header.data = decodeFrameData(header, buffer.subarray(headerEnd, frameEnd));
+		}
+		handler(header);
+		offset = frameEnd;
+	}
+
+	return buffer.slice(offset);
+}
+
+var fetchBinaryViews = function(url, body, handler, onBusy) {
+	var pending = new Uint8Array(0);
+
+	// without a body, we're getting a precomputed page, which the browser can revalidate
+	var options = {
+		method: 'GET',
+		headers: {'Accept': 'application/x-bucephalus-binary'},
+		cache: 'no-cache'
+	};
+	if (body != null) {
+		options.method = 'POST';
+		options.body = JSON.stringify(body);
+		options.headers['Content-Type'] = 'application/json; charset=utf-8';
+		options.cache = 'no-store';
+	}
+
+	fetch(url, options).then(function(response) {
+		if (response.status == 503 && onBusy(response.headers.get('Retry-After'))) {
+			return;
+		}
+
+		var reader = response.body.getReader();
+
+		var read = function() {
+			return reader.read().then(function(result) {
+				if (result.done) {
+					return;
+				}
+				var joined = new Uint8Array(pending.length + result.value.length);
+				joined.set(pending);
+				joined.set(result.value, pending.length);
+				pending = parseFrames(joined, handler);
+				return read();
+			});
+		};
+
+		return read();
+	});
+}
+
+var handleMessage = function(chunkObj, dataBlocks, viewinfo, held) {
 
 	// Process the chunk - generate the view
 	if (chunkObj.category == 'data') {
 		dataBlocks[chunkObj.series] = chunkObj.data;
+		if (chunkObj.hash != undefined) {
+			SeriesStore.put(chunkObj.hash, chunkObj.data);
+		}
+	} else if (chunkObj.category == 'ref') {
+		// we already have this data, under another name or from an earlier page
+		var data = held[chunkObj.hash];
+		if (data === undefined) {
+			data = SeriesStore.get(chunkObj.hash);
+		} else {
+			SeriesStore.get(chunkObj.hash);
+		}
+		dataBlocks[chunkObj.series] = data;
 	} else if (chunkObj.category == 'graph') {
 		var target = viewinfo.targets[chunkObj.id];
 		var viewdef = viewinfo.definitions[chunkObj.id];
@@ -83,9 +237,18 @@ var parseChunk = function(chunk, dataBlocks, viewinfo) {
 	}
 }
 
+// Pages can be precomputed as static files (see precompute.py), which are fetched by their path in the nav tree.
+// Deployments that precompute their pages turn this on; pages that haven't been are built on request as usual
+var usePrecomputedPages = false;
+
+var getPageUrl = function(token, path) {
+	var levels = $.map(path.split('/'), encodeURIComponent);
+	return '/pages/' + encodeURIComponent(token) + '/' + levels.join('/') + (useBinarySeries ? '.bin' : '.json');
+}
+
 // figures out the content pane layout
 // and hands off the view rendering to renderView
-var renderContentPane = function(views, tags, title) 
+var renderContentPane = function(views, tags, title, path) 
 {
 	// Create the views up front, then query for their data and initialise them as it arrives
 	var token = $("#sidebar-token-form :selected").text();
@@ -96,6 +259,7 @@ var renderContentPane = function(views, tags, title)
 		viewdata = navData['Root'].views;
 		pagetags = navData['Root'].tags;
 		pagetitle = navData['Root'].title;
+		path = 'Root';
 	} else {
 		viewdata = views;
 		pagetags = tags;
@@ -119,37 +283,88 @@ var renderContentPane = function(views, tags, title)
 	// 1. We will not encounter any graph block until we have received the data it depends on
 	// 2. Graph blocks will be received in order specified
 	// 3. Note that server-side graphs (e.g. matplotlib) would not have associated data blocks
-	var lastProcessedIdx = 0;
+	// 4. Data we already hold is sent as a reference to its hash, rather than sent again
 	var dataBlocks = {};
+	var held = SeriesStore.snapshot();
+	var handler = function(chunkObj) {
+		handleMessage(chunkObj, dataBlocks, viewinfo, held);
+	};
+
+	if (usePrecomputedPages && path != undefined) {
+		requestViews(getPageUrl(token, path), null, handler, 0);
+		return;
+	}
+
+	var body = {'views': viewinfo.definitions, 'have': Object.keys(held)};
+	requestViews('/views/'+token, body, handler, 0);
+};
+
+// When the server is too busy to start building a page it replies 503 with a Retry-After,
+// and we back off exponentially before trying again
+var maxViewRetries = 5;
+
+var getRetryDelay = function(retryAfter, attempt) {
+	var seconds = parseFloat(retryAfter) || 1;
+	return Math.min(seconds * Math.pow(2, attempt), 30) * 1000;
+}
+
+var retryViews = function(url, body, handler, attempt, retryAfter) {
+	if (attempt >= maxViewRetries) {
+		return false;
+	}
+	setTimeout(function() {
+		requestViews(url, body, handler, attempt + 1);
+	}, getRetryDelay(retryAfter, attempt));
+	return true;
+}
+
+var requestViews = function(url, body, handler, attempt) {
+
+	if (useBinarySeries) {
+		fetchBinaryViews(url, body, handler, function(retryAfter) {
+			return retryViews(url, body, handler, attempt, retryAfter);
+		});
+		return;
+	}
+
+	var lastProcessedIdx = 0;
 
 	$.ajax({
-		type: 'POST',
-		url: '/views/'+token,
+		type: body == null ? 'GET' : 'POST',
+		url: url,
 		xhrFields: {
 			onprogress: function(e) {
 				var nextSemicolonIdx, response = e.currentTarget.response;
 
+				if (e.currentTarget.status == 503) {
+					return;
+				}
+
 				while (-1 != (nextSemicolonIdx = response.indexOf(';', lastProcessedIdx))) {
 					var chunk = response.substring(lastProcessedIdx, nextSemicolonIdx);
 					lastProcessedIdx = nextSemicolonIdx+1;
-					parseChunk(chunk, dataBlocks, viewinfo);
+					handler(JSON.parse(chunk));
 				} 
 			}	
 		},	
 		complete: function(a,b,c) {
+			if (a.status == 503 && retryViews(url, body, handler, attempt, a.getResponseHeader('Retry-After'))) {
+				return;
+			}
+
 			// IE11 calls the 'complete' callback when the response is complete, rather than onprogress
 			var nextSemicolonIdx, response = a.responseText;
 
 			while (-1 != (nextSemicolonIdx = response.indexOf(';', lastProcessedIdx))) {
 				var chunk = response.substring(lastProcessedIdx, nextSemicolonIdx);
 				lastProcessedIdx = nextSemicolonIdx+1;
-				parseChunk(chunk, dataBlocks, viewinfo);
+				handler(JSON.parse(chunk));
 			} 
 		},
-		data: JSON.stringify(viewinfo.definitions),
+		data: body == null ? undefined : JSON.stringify(body),
 		contentType: 'application/json; charset=utf-8',
 		dataType: 'json',
-		cache: false,
+		cache: body == null,
 		timeout: 0,
 		json: true
 	});
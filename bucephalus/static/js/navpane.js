@@ -11,7 +11,8 @@ function showTokens() {
 		url: '/get_tokens',
 		contentType: 'application/json; charset=utf-8',
 		dataType: 'json',
-		cache: false,
+		// the server sends ETags, and tells the browser to revalidate every time
+		cache: true,
 		success: function(items) {
 			$.each(items, function (i, item) {
 				target.append($('<option>', {value: item, text : item}))
@@ -96,9 +97,10 @@ var selectNode = function(tgt, levels) {
 
 // gets called when a tree node is selected
 var treeNodeSelect = function(event, node) {
-	renderContentPane(node.views, node.tags, node.title);
-
 	var nodeLocation = getNodeLocation(node);
+	var nodePath = $.map(nodeLocation, function(level) { return level.value; }).join('/');
+	renderContentPane(node.views, node.tags, node.title, nodePath);
+
 	var nodeUrl = "?" + $.param(nodeLocation);
 	window.history.pushState("", "", nodeUrl);
 };
@@ -122,7 +124,8 @@ var renderNavPane = function(token) {
 		url: "/navdata/"+token,
 		contentType: 'application/json; charset=utf-8',
 		dataType: 'json',
-		cache: false,
+		// the server sends ETags, and tells the browser to revalidate every time
+		cache: true,
 		success: function(data) {
 			var tgt = $("#sidebar-nav");
 			tgt.html("");
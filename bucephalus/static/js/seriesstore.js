@@ -0,0 +1,62 @@
+
+// Keeps the series we've been sent, keyed by the hash of their content.
+// We tell the server which hashes we hold, and it sends a reference rather than the data again.
+// Least recently used series are dropped once we hold more than maxPoints values.
+var SeriesStore = {
+
+	maxPoints: 5000000,
+	entries: new Map(),
+	points: 0,
+
+	countPoints: function(data) {
+		if (!Array.isArray(data)) {
+			return 1;
+		}
+		if (data.length > 0 && Array.isArray(data[0])) {
+			return data.length * data[0].length;
+		}
+		return data.length;
+	},
+
+	get: function(hash) {
+		var entry = this.entries.get(hash);
+		if (entry === undefined) {
+			return undefined;
+		}
+		// move it to the back, as the most recently used
+		this.entries.delete(hash);
+		this.entries.set(hash, entry);
+		return entry.data;
+	},
+
+	put: function(hash, data) {
+		if (this.entries.has(hash)) {
+			this.get(hash);
+			return;
+		}
+
+		var points = this.countPoints(data);
+		if (points > this.maxPoints) {
+			return;
+		}
+
+		this.entries.set(hash, {data: data, points: points});
+		this.points += points;
+
+		while (this.points > this.maxPoints) {
+			var oldest = this.entries.keys().next().value;
+			this.points -= this.entries.get(oldest).points;
+			this.entries.delete(oldest);
+		}
+	},
+
+	// Takes hold of everything in the store for the length of a request,
+	// so the series we said we had can't be evicted before their references arrive
+	snapshot: function() {
+		var ret = {};
+		this.entries.forEach(function(entry, hash) {
+			ret[hash] = entry.data;
+		});
+		return ret;
+	}
+};
@@ -0,0 +1,60 @@
+import time
+import zlib
+import logging
+
+import numpy as np
+import pandas as pd
+
+from bucephalus.viewdata import ViewDataProvider
+from bucephalus.viewtools import encode_series
+
+
+class SyntheticDataProvider(ViewDataProvider):
+    """
+    A data provider for benchmarking, which generates the same data on every run.
+    Queries are of the form synthetic.N, for N up to the configured number of series,
+    each giving a timeseries of daily returns of the configured length.
+    Each query has its own seed, so the data doesn't depend on the order queries are run in,
+    and every query sleeps for the configured latency, to stand in for a database.
+    """
+    def __init__(self, config):
+        self.seed = config.get('SYNTHETIC_SEED', 0)
+        self.length = config.get('SYNTHETIC_LENGTH', 2000)
+        self.n_series = config.get('SYNTHETIC_SERIES', 100)
+        self.latency = config.get('SYNTHETIC_LATENCY', 0.0)
+
+        self.dates = pd.bdate_range('2000-01-03', periods=self.length, freq='B')
+
+        super(SyntheticDataProvider, self).__init__(config)
+
+    def get_tokens(self):
+        return ['synthetic-{}'.format(self.seed)]
+
+    def query_names(self, n=None):
+        """
+        Returns the names of the first n series, or all of them
+        """
+        n = self.n_series if n is None else n
+        return ['synthetic.{}'.format(i) for i in range(n)]
+
+    def is_deterministic(self, query):
+        return query.startswith('synthetic.') or super(SyntheticDataProvider, self).is_deterministic(query)
+
+    def get_single_query_data(self, query):
+        if not query:
+            return
+
+        if not query.startswith('synthetic.'):
+            return super(SyntheticDataProvider, self).get_single_query_data(query)
+
+        index = int(query.split('.', 1)[1])
+        if not 0 <= index < self.n_series:
+            raise RuntimeError('No synthetic series {} - there are {}'.format(query, self.n_series))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        rng = np.random.RandomState(zlib.crc32('{}:{}'.format(self.seed, query).encode('utf-8')))
+        data = rng.standard_normal(self.length) * 0.01
+        logging.debug('Generated synthetic series %s', query)
+        return encode_series(self.dates, data)
@@ -4,44 +4,250 @@ import sys
 import time
 import ujson
 import logging
+import hashlib
 import traceback
 import threading
-
-import networkx
+from itertools import groupby
+from collections import deque, namedtuple, OrderedDict
 
 from bucephalus import viewtools
+from bucephalus import metrics
+from bucephalus import downsample
 from bucephalus import datahandler
+from bucephalus import querywindow
+from bucephalus.dataprovider import QueryError
+from bucephalus.pagecache import PageCache
+from bucephalus.scheduler import BuildScheduler, INTERACTIVE
+from bucephalus.baseviews import LazyViewProvider
+from bucephalus.viewregistry import create_providers
+
+
+class DerivedKey(namedtuple('DerivedKey', ['query', 'handler'])):
+    """
+    Graph key of a query's data after a per-series handler.
+    It never compares equal to a plain tuple, so it can't be mistaken for a series key
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(other) is DerivedKey and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
 
-from bucephalus.jsonviews import HighChartsViewBuilder
-from bucephalus.mplviews import MPLViewBuilder
-from bucephalus.htmlviews import HTMLViewBuilder
+    def __hash__(self):
+        return hash(('derived',) + tuple(self))
+
+
+def is_per_series(handler_name):
+    """
+    Whether a view's handler runs on each series separately, so it can be a node of its own in the graph
+    """
+    if handler_name == 'raw':
+        return False
+    try:
+        return datahandler.get_handler(handler_name).per_series
+    except Exception:
+        # unknown handlers are reported when the view is built
+        return False
 
 
 def build_dependency_graph(views, data_provider):
+    """
+    Builds the dependency graph for a list of views and compiles it into an ExecutionPlan.
+    The graph goes like: query --> series --> view
+    or, for views with a per-series handler: query --> derived --> series --> view
+    so each derived series is computed once, however many views use it.
+    Queries are in their canonical form, including any date window given with the series.
+    """
+    # networkx is slow to import, so it's left until the first plan is built
+    import networkx
 
     ret = networkx.DiGraph()
 
     for i, view in enumerate(views):
 
         handler_name = view.get('handler', 'raw')
-        ret.add_node(i, typ='view', done=False, handler=handler_name)
+        per_series = is_per_series(handler_name)
+        ret.add_node(i, typ='view', handler=handler_name, derived=per_series)
 
         if 'series' not in view:
             continue
 
         for series in view['series']:
 
-            series_key = series['query'], series['label']
-
-            ret.add_node(series_key, typ='series', done=False)
-            ret.add_edge(series_key, i)
+            query = querywindow.series_query(series)
 
             # networkx ignores adding the same node twice
             # so we don't need to check if this query is already there
-            ret.add_node(series['query'], typ='query', done=False)
-            ret.add_edge(series['query'], series_key)
+            ret.add_node(query, typ='query')
+
+            if per_series:
+                derived_key = DerivedKey(query, handler_name)
+                ret.add_node(derived_key, typ='derived')
+                ret.add_edge(query, derived_key)
+
+                series_key = query, series['label'], handler_name
+                ret.add_node(series_key, typ='series')
+                ret.add_edge(derived_key, series_key)
+            else:
+                series_key = query, series['label']
+                ret.add_node(series_key, typ='series')
+                ret.add_edge(query, series_key)
+
+            ret.add_edge(series_key, i)
+
+            # a query shared by several series gets the tightest of their deadlines
+            if series.get('timeout'):
+                query_node = ret.nodes[query]
+                query_node['timeout'] = min(series['timeout'], query_node.get('timeout', series['timeout']))
+
+    return ExecutionPlan(ret)
+
+
+def hash_viewlist(views):
+    """
+    Returns a stable hash of a posted viewlist, used as the plan cache key
+    """
+    return hashlib.sha1(ujson.dumps(views, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ExecutionPlan(object):
+    """
+    Immutable, compiled form of the dependency graph.
+    Nodes are given integer ids in topological order, with per-node
+    dependency counts and dependent lists, so completing a query
+    only touches the nodes downstream of it.
+    Queries for windows onto the same data that can be cut from a wider window without changing
+    their result (see querywindow.merge_key) are fetched together as one query for the union
+    of their windows, and each is cut from the result.
+    Derived nodes are handed back as ready, like views, to be computed outside the graph lock.
+    Plans are shared between requests - per-request state lives in PlanState.
+    """
+    def __init__(self, graph):
+        import networkx
+
+        if not networkx.is_directed_acyclic_graph(graph):
+            raise RuntimeError("Circular dependencies found")
+
+        nodes = graph.nodes
+        self.keys = list(networkx.topological_sort(graph))
+        self.node_ids = {k: i for i, k in enumerate(self.keys)}
+        self.types = [nodes[k]['typ'] for k in self.keys]
+        self.predecessors = [tuple(self.node_ids[n] for n in graph.predecessors(k)) for k in self.keys]
+        self.dependents = [tuple(self.node_ids[n] for n in graph.successors(k)) for k in self.keys]
+        self.dep_counts = [len(p) for p in self.predecessors]
+
+        # views whose handler has already been run on their series, by derived nodes
+        self.derived_views = frozenset(i for i, k in enumerate(self.keys)
+                                       if self.types[i] == 'view' and nodes[k]['derived'])
+
+        # views without any data can be built straight away
+        self.roots = [i for i, t in enumerate(self.types) if t == 'view' and not self.dep_counts[i]]
 
-    return ret
+        groups = {}
+        for i, typ in enumerate(self.types):
+            if typ == 'query':
+                base, window = querywindow.parse_query(self.keys[i])
+                groups.setdefault((base, querywindow.merge_key(window)), []).append((i, window))
+
+        # map each query we run to the query nodes it serves, and the window to cut for each,
+        # or None where it's the whole result
+        self.fetches = {}
+        self.timeouts = {}
+        for (base, _), members in groups.items():
+            union = querywindow.union_window([w for _, w in members])
+            fetch = querywindow.format_query(base, union)
+
+            self.fetches.setdefault(fetch, []).extend((i, querywindow.cut_window(w, union)) for i, w in members)
+
+            timeouts = [nodes[self.keys[i]]['timeout'] for i, _ in members if 'timeout' in nodes[self.keys[i]]]
+            if timeouts:
+                self.timeouts[fetch] = min(timeouts)
+
+        self.queries = sorted(self.fetches)
+
+    def start(self):
+        return PlanState(self)
+
+
+class PlanState(object):
+    """
+    Per-request execution state for an ExecutionPlan
+    """
+    def __init__(self, plan):
+        self.plan = plan
+        self.remaining = list(plan.dep_counts)
+        self.data = [None] * len(plan.keys)
+        self.done = [False] * len(plan.keys)
+        self.started = False
+
+    def complete(self, query, result):
+        """
+        Marks a query as done, propagates its data to the series depending on it,
+        and returns the ids of the derived nodes that are now ready to compute,
+        followed by the view nodes that are now ready to build.
+        """
+        plan = self.plan
+        ready = []
+
+        if not self.started:
+            self.started = True
+            ready.extend(plan.roots)
+
+        for node, window in plan.fetches[query]:
+            if self.done[node]:
+                continue
+
+            data = result
+            if window is not None and result is not None and not isinstance(result, Exception):
+                try:
+                    data = querywindow.apply_window(result, window)
+                except Exception as ex:
+                    data = QueryError('{}: {}'.format(type(ex).__name__, ex))
+
+            self.propagate(node, data, ready)
+
+        return self.order(ready)
+
+    def resolve(self, node, data):
+        """
+        Sets the data of a derived node once it's been computed,
+        and returns the nodes that are now ready, as complete does
+        """
+        ready = []
+        self.propagate(node, data, ready)
+        return self.order(ready)
+
+    def order(self, ready):
+        types = self.plan.types
+        derived = [n for n in ready if types[n] == 'derived']
+        views = sorted((n for n in ready if types[n] == 'view'), key=self.plan.keys.__getitem__)
+        return derived + views
+
+    def propagate(self, node, data, ready):
+        plan = self.plan
+        self.done[node] = True
+        self.data[node] = data
+
+        pending = deque([node])
+        while pending:
+            n = pending.popleft()
+            for d in plan.dependents[n]:
+                self.remaining[d] -= 1
+                if self.remaining[d]:
+                    continue
+
+                if plan.types[d] == 'derived':
+                    ready.append(d)
+                    continue
+
+                self.done[d] = True
+                if plan.types[d] == 'series':
+                    self.data[d] = self.data[n]
+                    pending.append(d)
+                else:
+                    ready.append(d)
 
 
 class ViewBuilder(object):
@@ -49,19 +255,87 @@ class ViewBuilder(object):
     class for building and providing view definitions
     can do things like auto-rebuild when files change
     """
-    def __init__(self, data_provider):
-        modpath = os.path.dirname(__file__)
-        jsonpath = os.path.join(modpath,'views')
+    def __init__(self, data_provider, config=None, watch=True):
+        config = config or {}
 
-        self.view_providers = [HighChartsViewBuilder(jsonpath),
-                               MPLViewBuilder(),
-                               HTMLViewBuilder()]
+        # providers that are slow to start are only created once one of their views is built
+        self.view_providers = create_providers(config)
 
         self.data_provider = data_provider
 
+        self.plan_cache = OrderedDict()
+        self.plan_cache_size = 256
+        self.plan_lock = threading.Lock()
+
+        page_cache_bytes = config.get('PAGE_CACHE_BYTES', 64*1024*1024)
+        if page_cache_bytes:
+            self.page_cache = PageCache(page_cache_bytes, config.get('PAGE_CACHE_DIR'), config.get('PAGE_CACHE_TTL'))
+        else:
+            self.page_cache = None
+
+        self.scheduler = BuildScheduler(config.get('SCHEDULER_WORKERS', 8),
+                                        config.get('SCHEDULER_QUEUE_DEPTH', 32))
+
         self.check_views()
         self.prepare_views()
 
+        self.reload_interval = config.get('VIEW_RELOAD_INTERVAL', 2.0) if config.get('VIEW_RELOAD', False) else None
+        for vp in self.view_providers:
+            if hasattr(vp, 'start_watcher'):
+                vp.listeners.append(self.views_changed)
+
+        # a server that forks workers starts them in each worker instead (see after_fork)
+        if watch:
+            self.start_watchers()
+
+    def start_watchers(self):
+        """
+        Starts reloading the view definitions when their files change, if so configured
+        """
+        if self.reload_interval is None:
+            return
+        for vp in self.view_providers:
+            if hasattr(vp, 'start_watcher'):
+                vp.start_watcher(self.reload_interval)
+
+    def preload(self, viewlists=()):
+        """
+        Creates the lazy view providers, and compiles the execution plans for the given viewlists,
+        so a server that forks workers can do it once beforehand and have them share the result
+        """
+        for vp in self.view_providers:
+            if isinstance(vp, LazyViewProvider):
+                vp.get_provider()
+
+        for viewlist in viewlists:
+            try:
+                self.get_plan(viewlist)
+            except Exception:
+                logging.exception('Error compiling the plan for %s', viewlist)
+
+    def after_fork(self):
+        """
+        Called in a worker process forked from the one that created us,
+        where none of the parent's threads are running
+        """
+        self.plan_lock = threading.Lock()
+        self.scheduler.after_fork()
+        self.start_watchers()
+
+    def views_changed(self):
+        """
+        Called when view definitions are reloaded, in case views were added or removed
+        """
+        try:
+            self.check_views()
+        except RuntimeError:
+            logging.exception('Error checking reloaded views')
+        self.prepare_views()
+
+        # cached pages were built with the old definitions
+        if self.page_cache is not None:
+            self.page_cache.clear()
+
     def check_views(self):
         viewsets = [set(vp.list_views()) for vp in self.view_providers]
         extra_views = set.intersection(*viewsets)
@@ -70,11 +344,12 @@ class ViewBuilder(object):
             raise RuntimeError('Found duplicated views: {}'.format(msg))
 
     def prepare_views(self):
-        self.views = {}
+        views = {}
         for vp in self.view_providers:
             for v in vp.list_views():
                 logging.debug('View provider [%s] -> %s', v, vp)
-                self.views[v] = vp
+                views[v] = vp
+        self.views = views
 
     def get_view(self, viewtype):
 
@@ -84,105 +359,219 @@ class ViewBuilder(object):
 
         return self.views[viewtype]
 
-    def build_views(self, token, viewlist, result_queue):
+    def get_plan(self, viewlist):
         """
-        Extract all the series names so we can query them in one go.
-        Data manipulators generate queries that are then passed on for execution.
-        The dependency graph goes like:
-        panel --> seriesgroup --> series --> query
+        Returns the compiled execution plan for a viewlist,
+        reusing a cached one if the same viewlist has been seen before.
         """
-        deps = build_dependency_graph(viewlist, self.data_provider)
-        nodes = deps.nodes
+        key = hash_viewlist(viewlist)
 
-        series_deps = [k for k, v in nodes.items() if v['typ']=='series']
-        sent_to_client = set()
+        with self.plan_lock:
+            plan = self.plan_cache.get(key)
+            if plan is not None:
+                self.plan_cache.move_to_end(key)
+                return plan
 
-        if not series_deps:
-            raise RuntimeError("No queries were generated")
+        plan = build_dependency_graph(viewlist, self.data_provider)
 
-        if not networkx.is_directed_acyclic_graph(deps):
-            raise RuntimeError("Circular dependencies found")
+        with self.plan_lock:
+            self.plan_cache[key] = plan
+            while len(self.plan_cache) > self.plan_cache_size:
+                self.plan_cache.popitem(last=False)
 
-        def callback(sim_series, result, currentIndex, maxIndex):
-            t0 = time.time()
-            logging.debug('Callback for {}: {}/{}'.format(sim_series, currentIndex, maxIndex))
+        return plan
 
-            try:
+    def get_page_key(self, token, encoding, viewlist):
+        """
+        Returns the page cache key for a viewlist, or None if the page can't be cached,
+        because it has queries the data provider says aren't deterministic
+        """
+        if self.page_cache is None or not self.is_deterministic(viewlist):
+            return None
 
-                nodes[sim_series]['done'] = True
-                nodes[sim_series]['data'] = result
+        return token, encoding, hash_viewlist(viewlist)
 
-                result_queue.put({'id': 0, 'category': 'status', 'index': currentIndex, 'maxIndex': maxIndex})
+    def is_deterministic(self, viewlist):
+        """
+        Whether a page always comes out the same for a token, because the data provider
+        says all of its queries are deterministic
+        """
+        plan = self.get_plan(viewlist)
+        return all(self.data_provider.is_deterministic(query) for query in plan.queries)
 
-                # This iterates first through all queries, then series, seriesgroups and views
-                for name in networkx.topological_sort(deps):
-                    node = nodes[name]
+    def build_views(self, token, viewlist, result_queue, priority=INTERACTIVE, have=None, timings=None):
+        """
+        Runs the ExecutionPlan for a viewlist (cached by get_plan), with a fresh PlanState for this request.
+        The plan's fetch groups are passed to the data provider as one batch: each fetch may serve
+        several query nodes, which are cut from its result as it completes.
+        Completing a query hands back the nodes that are then ready. Derived nodes, which run a
+        per-series handler once for each query it applies to rather than once per view, are computed
+        a batch per handler outside the lock, and views are built once all their series are in.
+        Each series is sent with a hash of its content. Where the client already holds
+        that content, given by the hashes in have, we send a reference to it instead.
+        The build runs on the shared scheduler, which raises SchedulerFull if it's saturated.
+        The time spent in each stage is recorded in timings, if given.
+        Returns the BuildJob, which can be joined, or cancelled to stop querying and building.
+        """
+        timings = timings or metrics.Timings()
 
-                    if node['typ'] == 'query':
-                        continue
+        with timings.time('plan'):
+            plan = self.get_plan(viewlist)
+        state = plan.start()
 
-                    # Check all dependencies are done
-                    if not all(nodes[n]['done'] for n in deps.predecessors(name)):
-                        continue
+        queries = plan.queries
+        sent_to_client = set()
+        client_hashes = set(have or ())
+        lock = threading.Lock()
 
-                    if node['done']:
-                        continue
+        # Set when the client goes away, after which any outstanding work is dropped
+        cancelled = threading.Event()
 
-                    # Mark this node as done
-                    node['done'] = True
+        if not queries:
+            raise RuntimeError("No queries were generated")
 
-                    # Propagate the data up the graph
-                    if node['typ'] == 'series':
-                        node['data'] = nodes[name[0]]['data']
-                        continue
+        def build_one(name):
+            view = viewlist[name]
+            view_type = view['viewtype']
+            view_tags = view.get('tags', {})
+            view_options = view.get('viewoptions', {})
+            view_generator = self.get_view(view_type)
+            handler_name = view.get('handler', 'raw')
+            derived = plan.node_ids[name] in plan.derived_views
+            if not derived:
+                view_handler = datahandler.get_handler(handler_name)
+
+            data_series = []
+            for n in plan.predecessors[plan.node_ids[name]]:
+                data = state.data[n]
+
+                # failed queries leave either None or a QueryError
+                if data is None or isinstance(data, Exception):
+                    msg = 'There was an error getting data series {}'.format(plan.keys[n][0])
+                    if data is not None:
+                        msg = '{}: {}'.format(msg, data)
+                    logging.error(msg)
+                    result_queue.put(viewtools.build_error(msg, name))
+                    return
+
+                data_series.append((plan.keys[n], data))
+
+            # the handler has already been applied to each series by the derived nodes
+            if not derived:
+                with timings.time('handler', handler=datahandler.handler_label(handler_name)):
+                    data_series = view_handler.process_queries(data_series)
 
-                    # node type is now 'view', which has no dependents
-                    view = viewlist[name]
-                    view_type = view['viewtype']
-                    view_tags = view.get('tags', {})
-                    view_options = view.get('viewoptions', {})
-                    view_generator = self.get_view(view_type)
-                    view_handler = datahandler.get_handler(view.get('handler', 'raw'))
+            with timings.time('downsample', viewtype=view_type):
+                data_series = downsample.downsample_series(data_series, view_options)
 
-                    data_series = []
-                    for n in deps.predecessors(name):
-                        data = nodes[n]['data']
+            view_options = {k: v for k, v in view_options.items() if k not in downsample.options}
+            with timings.time('build_view', viewtype=view_type):
+                view_def = view_generator.build_view(view_type, view_tags, [(k, v) for k, v, _ in data_series],
+                                                     view_options)
 
-                        if data is None:
-                            msg = 'There was an error getting data series {}'.format(n[0])
-                            logging.error(msg)
-                            result_queue.put(viewtools.build_error(msg, name))
-                            return
+            # Hold the lock so no other view can send its graph before data it shares with this one
+            with lock:
+                for series_id, series_data, decimation in data_series:
+                    if series_id in sent_to_client:
+                        continue
+                    sent_to_client.add(series_id)
 
-                        data_series.append((n, data))
+                    with timings.time('hash'):
+                        content_hash = viewtools.hash_series(series_data)
+                    if content_hash in client_hashes:
+                        result_queue.put({'id': name, 'category': 'ref', 'series': series_id, 'hash': content_hash})
+                        continue
+                    client_hashes.add(content_hash)
 
-                    data_series = view_handler.process_queries(data_series)
-                    view_def = view_generator.build_view(view_type, view_tags, data_series, view_options)
+                    msg = {'id': name, 'category': 'data', 'series': series_id, 'data': series_data,
+                           'hash': content_hash}
+                    if decimation is not None:
+                        msg['decimation'] = decimation
+                    result_queue.put(msg)
 
-                    for series_id, series_data in data_series:
-                        if series_id in sent_to_client:
-                            continue
-                        sent_to_client.add(series_id)
-                        result_queue.put({'id': name, 'category': 'data', 'series': series_id, 'data': series_data})
+            result_queue.put({'id': name, 'category': 'graph', 'result': view_def})
 
-                    result_queue.put({'id': name, 'category': 'graph', 'result': view_def})
+        def callback(sim_series, result, currentIndex, maxIndex):
+            if cancelled.is_set():
+                return
 
-                logging.debug('Callback for {} completed in {}'.format(sim_series, time.time()-t0))
+            logging.debug('Callback for {}: {}/{}'.format(sim_series, currentIndex, maxIndex))
 
-            except Exception:
-                msg1 = 'There was an error getting data series for view {}:'
-                msg = viewtools.build_error_message(msg1.format(name))
-                logging.error(msg)
-                result_queue.put(viewtools.build_error(msg, name))
+            result_queue.put({'id': 0, 'category': 'status', 'index': currentIndex, 'maxIndex': maxIndex})
+
+            # Queries complete on several threads at once, so the plan state is only updated under the lock.
+            # Only the views downstream of this query are visited
+            with lock, timings.time('graph'):
+                ready = state.complete(sim_series, result)
+
+            run_ready(ready)
+
+        def derive(nodes):
+            """
+            Runs a per-series handler over the data for its derived nodes, all at once,
+            and returns the nodes that are then ready
+            """
+            handler_name = plan.keys[nodes[0]].handler
+            inputs = [state.data[plan.predecessors[n][0]] for n in nodes]
+
+            # failed queries are passed on as they are, for the views to report
+            good = [(n, data) for n, data in zip(nodes, inputs) if data is not None and not isinstance(data, Exception)]
+            results = dict(zip(nodes, inputs))
+            if good:
+                try:
+                    with timings.time('handler', handler=datahandler.handler_label(handler_name)):
+                        handler = datahandler.get_handler(handler_name)
+                        derived = handler.process_queries([((plan.keys[n].query,), data) for n, data in good])
+                    results.update((n, data) for (n, _), (_, data) in zip(good, derived))
+                except Exception as ex:
+                    logging.exception('Error running handler %s', handler_name)
+                    results.update((n, QueryError('{}: {}'.format(type(ex).__name__, ex))) for n, _ in good)
+
+            ready = []
+            with lock, timings.time('graph'):
+                for n in nodes:
+                    ready.extend(state.resolve(n, results[n]))
+            return state.order(ready)
+
+        def run_ready(ready):
+            # derived nodes ready at the same time are computed together, a batch per handler
+            derived = [n for n in ready if plan.types[n] == 'derived']
+            for _, nodes in groupby(sorted(derived, key=lambda n: plan.keys[n].handler),
+                                    key=lambda n: plan.keys[n].handler):
+                if cancelled.is_set():
+                    return
+                run_ready(derive(list(nodes)))
+
+            for node in ready:
+                if cancelled.is_set():
+                    return
+                if plan.types[node] == 'derived':
+                    continue
+
+                name = plan.keys[node]
+                try:
+                    build_one(name)
+                except Exception:
+                    msg1 = 'There was an error getting data series for view {}:'
+                    msg = viewtools.build_error_message(msg1.format(name))
+                    logging.error(msg)
+                    result_queue.put(viewtools.build_error(msg, name))
+
+        # We query for results on a scheduler worker so we can return results in this one
+        submitted = time.perf_counter()
 
-        # We query for results in a different thread so we can return results in this one
         def worker():
-            self.data_provider.get_view_data(token, series_deps, callback)
-            result_queue.put(None) # Indicates the end of the data
+            timings.observe('queue_wait', time.perf_counter() - submitted)
+            try:
+                self.data_provider.run_queries(token, queries, callback, cancelled, plan.timeouts, timings)
+            except Exception:
+                msg = viewtools.build_error_message('There was an error getting the page data:')
+                logging.error(msg)
+                result_queue.put(viewtools.build_error(msg))
+            finally:
+                result_queue.put(None) # Indicates the end of the data
 
-        worker_thread = threading.Thread(target=worker)
-        worker_thread.start()
-        return worker_thread
+        return self.scheduler.submit(worker, priority, cancelled)
 
     def set_data_provider(self, provider):
         self.data_provider = provider
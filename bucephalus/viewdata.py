@@ -4,10 +4,11 @@ import logging
 import numpy as np
 import pandas as pd
 
+from bucephalus.dataprovider import BaseDataProvider, QueryError, QueryTimeout
 from bucephalus.viewtools import level_value_string_sub, encode_pandas_series, encode_series
 
 
-class ViewDataProvider(object):
+class ViewDataProvider(BaseDataProvider):
     logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s', level=logging.DEBUG)
     """
     This class maps from tags to datasets
@@ -18,6 +19,7 @@ class ViewDataProvider(object):
 
     def __init__(self, config):
         logging.info("Initialising ViewDataProvider with config:".format(config))
+        super(ViewDataProvider, self).__init__(config)
 
         # Default to the latest token retrieved
         self.set_token(self.get_tokens()[0])
@@ -39,8 +41,11 @@ class ViewDataProvider(object):
         # TODO - validate token
         self._token = token
 
-        # Reload the db connection here
-        # connection.reload()
+        # Connections are made per token by connect(), and pooled
+
+    def is_deterministic(self, query):
+        # the random example data is different every time it's queried
+        return query.split('.')[0] not in ('univariate_random', 'random_timeseries', 'random_vol')
 
     def get_single_query_data(self, query):
 
@@ -84,21 +89,6 @@ class ViewDataProvider(object):
 
         raise RuntimeError('No data found for type {}'.format(query))
 
-    def get_view_data(self, token, query_list, callback):
-        """
-        Loads multiple queries from the database, calling callback(name, series) for each one
-        :param query_list: a set of query objects - a string of series name to load,
-        :param callback: a function that will be called as callback(name, series, i, n) once for each series
-        :return: None
-        """
-        n_queries = len(query_list)
-        logging.debug('Getting data for {} queries.'.format(n_queries))
-
-        # This call we should really be making is this one:
-#        self.connection.run_queries([q[0] for q in query_list], callback)
-
-        # But for this example, we'll just iterate through the queries
-        # invoking the callback as we go
-        for i, q in enumerate(query_list):
-            data = self.get_single_query_data(q[0])
-            callback(q[0], data, i+1, n_queries)
+    def run_query(self, conn, token, query):
+        # The example data doesn't need a connection
+        return self.get_single_query_data(query)
@@ -0,0 +1,69 @@
+import logging
+import importlib
+
+from bucephalus.baseviews import BaseViewBuilder, LazyViewProvider
+
+
+DEFAULT_PROVIDERS = [
+    'bucephalus.jsonviews.HighChartsViewBuilder',
+    'bucephalus.mplviews.MPLViewBuilder',
+    'bucephalus.htmlviews.HTMLViewBuilder',
+]
+
+# Packages can add view providers by declaring entry points in this group
+ENTRY_POINT_GROUP = 'bucephalus.view_providers'
+
+
+def import_provider(path):
+    """
+    Imports a view provider class by its import path
+    """
+    module_name, _, class_name = path.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as ex:
+        raise RuntimeError('Could not load view provider {}: {}'.format(path, ex))
+
+
+def get_entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=ENTRY_POINT_GROUP))
+    return list(eps.get(ENTRY_POINT_GROUP, []))
+
+
+def provider_classes(config):
+    """
+    The view provider classes named in VIEW_PROVIDERS, followed by any registered as entry points
+    """
+    ret = [import_provider(path) for path in config.get('VIEW_PROVIDERS') or DEFAULT_PROVIDERS]
+
+    for ep in get_entry_points():
+        try:
+            ret.append(ep.load())
+        except Exception:
+            logging.exception('Could not load view provider entry point %s', ep.name)
+
+    for cls in ret:
+        if not issubclass(cls, BaseViewBuilder):
+            raise RuntimeError('View provider {} is not a BaseViewBuilder'.format(cls.__name__))
+    return ret
+
+
+def create_providers(config):
+    """
+    Creates the view providers, with lazy ones standing in until they're first used
+    """
+    ret = []
+    for cls in provider_classes(config):
+        if cls.lazy:
+            ret.append(LazyViewProvider(cls, config))
+        else:
+            ret.append(cls.from_config(config))
+        logging.debug('Registered view provider %s', cls.__name__)
+    return ret
@@ -1,5 +1,8 @@
+import os
 import sys
 import copy
+import struct
+import hashlib
 import logging
 import traceback
 
@@ -8,6 +11,18 @@ import numpy as np
 import pandas as pd
 
 
+def get_cache_dir(config):
+    """
+    Where the app keeps the files it generates: CACHE_DIR if set, otherwise bucephalus under
+    XDG_CACHE_HOME, or ~/.cache, as the package directory isn't writable once it's installed
+    """
+    path = config.get('CACHE_DIR')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'bucephalus')
+
+
 def parse_tags(tags):
     "Parses tags passed un the url arguments"
     ret = {}
@@ -39,6 +54,69 @@ def dict_merge(dcts):
 
     return ret
 
+def dict_merge_shared(dcts):
+    """
+    Like dict_merge, but only copies the dicts along the merged paths.
+    Untouched subtrees are shared with the inputs, so the result must be treated as read-only
+    """
+    ret = dcts[0]
+    for a in dcts[1:]:
+        ret = dict_merge_shared_impl(ret, a)
+    return ret
+
+def dict_merge_shared_impl(dct, merge_dct):
+    "Inner function for merging dicts without copying them"
+    ret = dict(dct)
+    for k, v in merge_dct.items():
+        if (k in ret
+                and isinstance(ret[k], dict)
+                and isinstance(v, dict)):
+            ret[k] = dict_merge_shared_impl(ret[k], v)
+        else:
+            ret[k] = v
+    return ret
+
+def compile_template(tmpl):
+    """
+    Finds where {{tag}} placeholders occur in a dict or list.
+    Returns a tree of slots, mapping each key or index on the way to a placeholder to its own slots,
+    with True marking the templated strings themselves, or None if there are no placeholders
+    """
+    if isinstance(tmpl, str):
+        return True if '{{' in tmpl else None
+
+    if isinstance(tmpl, list):
+        items = enumerate(tmpl)
+    elif isinstance(tmpl, dict):
+        items = tmpl.items()
+    else:
+        return None
+
+    slots = {}
+    for k, v in items:
+        sub = compile_template(v)
+        if sub is not None:
+            slots[k] = sub
+
+    return slots or None
+
+def render_template(tmpl, slots, tags):
+    """
+    Applies tags to a template compiled with compile_template.
+    Only the containers on the way to a placeholder are copied, everything else is shared with tmpl
+    """
+    if slots is None:
+        return tmpl
+
+    if slots is True:
+        return template_recurse(tmpl, tags)
+
+    ret = copy.copy(tmpl)
+    for k, sub in slots.items():
+        ret[k] = render_template(tmpl[k], sub, tags)
+
+    return ret
+
 def template_recurse(tmpl, tags):
     """
     Recursively applies string templating to a dict or list
@@ -66,7 +144,8 @@ def template_recurse(tmpl, tags):
     return tmpl
 
 def encode_series(dates, data):
-    ret = pd.Series(np.array(data), dates.astype(int)/1000000)
+    # epoch milliseconds, whatever the resolution of the dates
+    ret = pd.Series(np.array(data), dates.values.astype('datetime64[ms]').astype(np.int64))
     return ret.reset_index()
 
 def encode_pandas_series(series):
@@ -76,6 +155,20 @@ def encode_pandas_series(series):
     except:
         return series.values
 
+def hash_series(data):
+    """
+    Returns a content hash of series data
+    """
+    values = data.values if isinstance(data, (pd.Series, pd.DataFrame)) else np.asarray(data)
+    h = hashlib.sha1(str((values.shape, values.dtype.str)).encode('utf-8'))
+
+    if values.dtype.kind in 'biufcmM':
+        h.update(np.ascontiguousarray(values).tobytes())
+    else:
+        h.update(ujson.dumps(values.tolist()).encode('utf-8'))
+
+    return h.hexdigest()
+
 def level_value_string_sub(s, lspec):
     ret = s
 
@@ -87,10 +180,11 @@ def level_value_string_sub(s, lspec):
     return ret
 
 def freeze_tags(tags):
-    return frozenset(sorted(tags.items()))
+    # 1, 1.0 and True are equal, but render differently, so their types are part of the key
+    return frozenset((k, type(v), v) for k, v in tags.items())
 
 def unfreeze_tags(frozen_tags):
-    return dict(frozen_tags)
+    return {k: v for k, _, v in frozen_tags}
 
 def parse_result_series(result):
     """
@@ -121,6 +215,89 @@ def to_json(obj):
         logging.error(msg)
         return ujson.dumps(build_error(msg))
 
+BINARY_MIMETYPE = 'application/x-bucephalus-binary'
+
+def encode_columns(data, float32=False):
+    """
+    Splits series data into packed little-endian columns.
+    The first column of a frame holds the dates, which are sent as int64 where they are whole numbers.
+    Returns (column types, number of rows, payload bytes), or None if the data is not numeric
+    """
+    if isinstance(data, pd.DataFrame):
+        columns = [data.iloc[:, i].values for i in range(data.shape[1])]
+    elif isinstance(data, pd.Series):
+        columns = [data.values]
+    else:
+        values = np.asarray(data)
+        columns = [values] if values.ndim == 1 else list(values.T)
+
+    value_type = '<f4' if float32 else '<f8'
+    types = []
+    buffers = []
+
+    for i, col in enumerate(columns):
+        col = np.asarray(col)
+        if col.dtype.kind not in 'biuf':
+            return None
+
+        if col.dtype.kind in 'biu':
+            dtype = '<i8'
+        elif i == 0 and len(columns) > 1 and np.isfinite(col).all() and (col == np.round(col)).all():
+            dtype = '<i8'
+        else:
+            dtype = value_type
+
+        buffers.append(np.ascontiguousarray(col, dtype=dtype).tobytes())
+        types.append(np.dtype(dtype).name)
+
+    n_rows = len(columns[0]) if columns else 0
+    return types, n_rows, b''.join(buffers)
+
+def build_binary_frame(header, payload=b''):
+    """
+    A binary frame is the header and payload lengths as little-endian uint32s,
+    followed by the json header, then the packed column data
+    """
+    header = header.encode('utf-8')
+    return struct.pack('<II', len(header), len(payload)) + header + payload
+
+def to_binary(obj, float32=False):
+    """
+    Binary counterpart of to_json, used when the client negotiates it.
+    Numeric series data is sent as packed columns, everything else as json in the frame header
+    """
+    try:
+        if 'data' not in obj:
+            return build_binary_frame(ujson.dumps(obj))
+
+        columns = encode_columns(obj['data'], float32)
+        if columns is None:
+            return build_binary_frame(to_json(obj))
+
+        types, n_rows, payload = columns
+        header = {k: v for k, v in obj.items() if k != 'data'}
+        header['columns'] = types
+        header['rows'] = n_rows
+        return build_binary_frame(ujson.dumps(header), payload)
+
+    except Exception:
+        msg = build_error_message('There was an error encoding data for view {}:'.format(obj.get('id')))
+        logging.error(msg)
+        return build_binary_frame(ujson.dumps(build_error(msg)))
+
+def to_json_chunk(obj):
+    """
+    A message in the ;-delimited json stream
+    """
+    return (to_json(obj)+';').encode('utf-8')
+
+# The ways a stream of view messages can be encoded, as (encoder, mimetype)
+stream_encoders = {
+    'json': (to_json_chunk, 'application/json'),
+    'binary': (to_binary, BINARY_MIMETYPE),
+    'binary32': (lambda obj: to_binary(obj, float32=True), BINARY_MIMETYPE),
+}
+
 def build_error_message(msg):
     ex_type, ex, tb = sys.exc_info()
     return "\n".join([msg, str(ex)] + traceback.format_tb(tb))
@@ -0,0 +1,37 @@
+"""
+Builds every page in a token's nav tree ahead of time, and writes the streams out as static files.
+nginx serves these directly (see nginx.conf), and the app only builds pages that aren't there
+"""
+
+import argparse
+import logging
+
+import bucephalus
+from bucephalus.navdata import build_pages
+from bucephalus.pages import precompute_token, page_extensions
+
+if __name__ == '__main__':
+    app = bucephalus.create_app()
+    data_provider, view_defs = bucephalus.data_provider, bucephalus.view_defs
+
+    parser = argparse.ArgumentParser(description='Precomputes the pages for a token',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--token', type=str, required=True,
+        help="Token to precompute the pages of")
+    parser.add_argument('--out', type=str, default=app.config.get('PRECOMPUTE_DIR', 'pages'),
+        help="Directory to write the pages to, under the token")
+    parser.add_argument('--workers', type=int, default=4,
+        help="Number of pages to build at once")
+    parser.add_argument('--encodings', type=str, nargs='+', default=sorted(page_extensions),
+        choices=sorted(page_extensions), help="Stream encodings to write")
+    parser.add_argument('--level', type=int, default=9,
+        help="gzip compression level")
+    params = parser.parse_args()
+
+    try:
+        written, failed = precompute_token(view_defs, build_pages(data_provider, params.token), params.token,
+                                           params.out, params.encodings, params.workers, params.level)
+    finally:
+        data_provider.shutdown()
+
+    logging.info('Precomputed %d pages for %s, %d left to build on request', written, params.token, failed)
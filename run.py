@@ -7,7 +7,7 @@ Created on Wed Oct 11 15:31:58 2017
 
 import argparse
 
-from bucephalus import app
+from bucephalus import create_app
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Bucephalus',
@@ -18,4 +18,5 @@ if __name__ == '__main__':
         help="IP address to listen on")
     params = parser.parse_args()
 
+    app = create_app()
     app.run(host=params.host, port=params.port, threaded=True, debug=True, use_debugger=False, use_reloader=False)
\ No newline at end of file
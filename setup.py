@@ -13,17 +13,19 @@ setup(
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.11',
         'Framework :: Flask',
         'Natural Language :: English',
         'Operating System :: POSIX :: Linux',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content'
     ],
     keywords='data visualisation',
-    python_requires='>=3',
+    python_requires='>=3.7',
     packages=find_packages(),
     include_package_data=True,
-    install_requires=['flask', 'pandas', 'seaborn', 'scipy', 'ujson'],
+    install_requires=['flask<2.1', 'networkx', 'numpy>=1.20', 'pandas>=0.24', 'seaborn', 'scipy', 'ujson'],
     package_data={
         'sample': ['static', 'templates', 'views'],
     }
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='session', autouse=True)
+def cache_dir(tmp_path_factory):
+    """
+    Keeps what the app generates, like the view catalog, out of the user's cache directory
+    """
+    path = str(tmp_path_factory.mktemp('cache'))
+    old = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = path
+    yield path
+    if old is None:
+        del os.environ['XDG_CACHE_HOME']
+    else:
+        os.environ['XDG_CACHE_HOME'] = old
+
+
+@pytest.fixture(scope='session')
+def app():
+    import bucephalus
+    return bucephalus.create_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,73 @@
+import json
+
+from bucephalus.scheduler import BuildScheduler
+from bucephalus.viewtools import BINARY_MIMETYPE
+
+
+def solar_view(*sectors):
+    return {'viewtype': 'basic_col', 'series': [{'label': s, 'query': 'solar.' + s} for s in sectors or ['sales']]}
+
+
+def messages(response):
+    return [json.loads(m) for m in response.get_data().decode('utf-8').split(';')[:-1]]
+
+
+def test_series_are_sent_as_json_unless_binary_is_asked_for(client):
+    views = [solar_view()]
+
+    response = client.post('/views/tok', json=views, headers={'Accept': '*/*'})
+    assert response.mimetype == 'application/json'
+    assert [m['category'] for m in messages(response)] == ['status', 'data', 'graph', 'status']
+
+    response = client.post('/views/tok?encoding=binary', json=views)
+    assert response.mimetype == BINARY_MIMETYPE
+
+    response = client.post('/views/tok', json=views, headers={'Accept': BINARY_MIMETYPE})
+    assert response.mimetype == BINARY_MIMETYPE
+
+
+def test_full_scheduler_returns_503_with_retry_after(app, client, monkeypatch):
+    import bucephalus
+    monkeypatch.setattr(bucephalus.view_defs, 'scheduler', BuildScheduler(1, 0))
+    monkeypatch.setitem(app.config, 'SCHEDULER_RETRY_AFTER', 3)
+
+    views = [{'viewtype': 'basic_col', 'series': [{'label': 'random', 'query': 'univariate_random'}]}]
+    response = client.post('/views/tok', json=views)
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '3'
+    assert [m['category'] for m in messages(response)] == ['error']
+
+
+def test_closing_the_response_cancels_the_build(client, monkeypatch):
+    import bucephalus
+    jobs = []
+    build_views = bucephalus.view_defs.build_views
+
+    def record_job(*args, **kwargs):
+        jobs.append(build_views(*args, **kwargs))
+        return jobs[-1]
+
+    monkeypatch.setattr(bucephalus.view_defs, 'build_views', record_job)
+
+    # random data isn't cached, so the page is built
+    views = [{'viewtype': 'basic_col', 'series': [{'label': 'random', 'query': 'univariate_random'}]}]
+    response = client.post('/views/tok', json=views, buffered=False)
+    next(iter(response.response))
+    assert not jobs[0].cancelled.is_set()
+
+    response.close()
+    assert jobs[0].cancelled.is_set()
+    assert jobs[0].join(5)
+
+
+def test_metrics_endpoint_leaves_the_metrics_module_alone(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert '# TYPE bucephalus_stage_seconds histogram' in response.get_data(as_text=True)
+
+    import bucephalus
+    from bucephalus import metrics
+    assert metrics is bucephalus.metrics
+    assert isinstance(metrics.registry, metrics.Registry)
+    metrics.Timings().observe('test', 0.001)
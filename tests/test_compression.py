@@ -0,0 +1,49 @@
+import zlib
+
+import pytest
+
+from bucephalus import compression
+from bucephalus.compression import StreamCompressor, compress_stream
+
+
+def decompress(encoding, data):
+    if encoding == 'br':
+        return compression.brotli.decompress(data)
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.decompress(data, wbits)
+
+
+def get_series(histogram, **labels):
+    return histogram.series.get(tuple(sorted(labels.items())), [None, 0.0, 0])
+
+
+@pytest.mark.parametrize('encoding', compression.get_encodings())
+def test_stream_round_trip(encoding):
+    chunks = [b'{"id": %d, "data": [1, 2, 3]}\n' % i for i in range(100)]
+    out = list(compress_stream(iter(chunks), StreamCompressor(encoding)))
+
+    assert decompress(encoding, b''.join(out)) == b''.join(chunks)
+    # each message can be decoded as soon as it's sent
+    if encoding != 'br':
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+        assert d.decompress(out[0]) == chunks[0]
+
+
+def test_stream_is_recorded_in_histograms():
+    ratios = get_series(compression.compression_ratio, encoding='deflate')[2]
+    cpu = get_series(compression.compression_cpu_seconds, encoding='deflate')[2]
+
+    compressor = StreamCompressor('deflate')
+    list(compress_stream(iter([b'a' * 10000] * 10), compressor))
+
+    ratio_series = get_series(compression.compression_ratio, encoding='deflate')
+    assert ratio_series[2] == ratios + 1
+    assert get_series(compression.compression_cpu_seconds, encoding='deflate')[2] == cpu + 1
+    assert compressor.ratio() > 64
+    # a ratio that high goes in the +Inf bucket
+    assert ratio_series[0][-1] >= 1
+
+
+def test_unknown_encoding():
+    with pytest.raises(RuntimeError):
+        StreamCompressor('zstd')
@@ -0,0 +1,114 @@
+import sqlite3
+import threading
+
+import pytest
+
+from bucephalus.connectionpool import ConnectionPool, PoolTimeout
+
+
+def make_pool(**kwargs):
+    made = []
+
+    def connect():
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        made.append(conn)
+        return conn
+
+    return ConnectionPool(connect, **kwargs), made
+
+
+def test_connections_are_reused():
+    pool, made = make_pool(max_size=2)
+
+    with pool.connection() as first:
+        assert first.execute('SELECT 1').fetchone() == (1,)
+    with pool.connection() as second:
+        pass
+
+    assert second is first
+    assert len(made) == 1
+    assert pool.stats()['size'] == 1 and pool.stats()['idle'] == 1
+
+
+def test_most_recently_used_is_handed_out_first():
+    pool, _ = make_pool(max_size=2)
+    a, b = pool.acquire(), pool.acquire()
+    pool.release(a)
+    pool.release(b)
+    assert pool.acquire() is b
+
+
+def test_exhausted_pool_times_out():
+    pool, made = make_pool(max_size=1, acquire_timeout=0.05)
+    conn = pool.acquire()
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert len(made) == 1
+
+
+def test_exhausted_pool_waits_for_a_connection():
+    pool, _ = make_pool(max_size=1)
+    conn = pool.acquire()
+    got = []
+
+    waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.05)
+    assert waiter.is_alive()
+
+    pool.release(conn)
+    waiter.join(5)
+    assert got == [conn]
+
+
+def test_failed_connect_frees_its_slot():
+    calls = []
+
+    def connect():
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('unable to open database file')
+        return sqlite3.connect(':memory:')
+
+    pool = ConnectionPool(connect, max_size=1, acquire_timeout=0.05)
+    with pytest.raises(sqlite3.OperationalError):
+        pool.acquire()
+    assert pool.acquire() is not None
+
+
+def test_idle_connections_are_closed():
+    pool, made = make_pool(max_size=2, idle_timeout=0.01)
+    pool.release(pool.acquire())
+
+    threading.Event().wait(0.02)
+    pool.evict_idle()
+    assert pool.stats()['size'] == 0 and pool.stats()['evicted'] == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        made[0].execute('SELECT 1')
+
+
+def test_unhealthy_connections_are_replaced():
+    pool, made = make_pool(max_size=1, check=lambda conn: conn.execute('SELECT 1').fetchone(), check_after=0)
+    conn = pool.acquire()
+    conn.close()
+    pool.release(conn)
+
+    replacement = pool.acquire()
+    assert replacement is not conn
+    assert replacement.execute('SELECT 1').fetchone() == (1,)
+    assert pool.stats()['failed_checks'] == 1 and len(made) == 2
+
+
+def test_closed_pool_refuses_connections():
+    pool, made = make_pool(max_size=1)
+    pool.release(pool.acquire())
+    pool.close()
+
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    with pytest.raises(sqlite3.ProgrammingError):
+        made[0].execute('SELECT 1')
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus import datahandler
+
+
+def timeseries(values, start=0):
+    dates = np.arange(start, start + len(values), dtype=np.int64) * 86400000
+    return pd.DataFrame({0: dates, 1: np.asarray(values, dtype=np.float64)})
+
+
+def test_align_panel_shared_dates():
+    results = [(('a',), timeseries([1., 2., 3.])), (('b',), timeseries([4., np.nan, 6.]))]
+    dates, values, mask = datahandler.align_panel(results)
+    assert len(dates) == 3
+    np.testing.assert_array_equal(values[:, 0], [1., 2., 3.])
+    np.testing.assert_array_equal(mask[:, 1], [True, False, True])
+
+
+def test_align_panel_union_of_dates():
+    results = [(('a',), timeseries([1., 2.])), (('b',), timeseries([3., 4.], start=1))]
+    dates, values, mask = datahandler.align_panel(results)
+    assert len(dates) == 3
+    np.testing.assert_array_equal(mask, [[True, False], [True, True], [False, True]])
+    np.testing.assert_array_equal(values[1], [2., 3.])
+
+
+def test_accumulate_skips_missing_values():
+    values = np.array([[1.], [np.nan], [2.]])
+    _, ret, mask = datahandler.accumulate(None, values, ~np.isnan(values))
+    np.testing.assert_array_equal(ret[[0, 2], 0], [1., 3.])
+    assert np.isnan(ret[1, 0])
+
+
+def test_rolling_vol():
+    data = np.random.RandomState(0).randn(50, 2)
+    _, ret, mask = datahandler.rolling_vol(None, data.copy(), np.ones(data.shape, dtype=bool), '10')
+    assert not mask[:9].any() and mask[9:].all()
+    np.testing.assert_allclose(ret[9:, 0], pd.Series(data[:, 0]).rolling(10).std().values[9:])
+
+
+def test_rolling_vol_with_gaps_windows_each_series():
+    values = np.array([[1.], [np.nan], [2.], [4.]])
+    _, ret, _ = datahandler.rolling_vol(None, values, ~np.isnan(values), '2')
+    np.testing.assert_allclose(ret[[2, 3], 0], [np.std([1., 2.], ddof=1), np.std([2., 4.], ddof=1)])
+
+
+def test_rolling_vol_rejects_short_windows():
+    with pytest.raises(RuntimeError):
+        datahandler.rolling_vol(None, np.ones((3, 1)), np.ones((3, 1), dtype=bool), '1')
+
+
+def test_resample_takes_last_in_period():
+    dates = pd.date_range('2020-01-06', periods=14).values.astype('datetime64[ms]').astype(np.int64)
+    values = np.arange(14, dtype=np.float64)[:, None]
+    new_dates, ret, _ = datahandler.resample(dates, values, np.ones(values.shape, dtype=bool), 'W')
+    assert len(new_dates) == 2
+    np.testing.assert_array_equal(ret[:, 0], [6., 13.])
+
+
+def test_pipeline_on_timeseries():
+    results = [(('a',), timeseries([1., 2., 3.]))]
+    [(key, data)] = datahandler.get_handler('accumulate').process_queries(results)
+    assert key == ('a', 'accumulate')
+    np.testing.assert_array_equal(data.iloc[:, 1].values, [1., 3., 6.])
+
+
+def test_pipeline_keeps_every_category():
+    series = pd.Series([None, None, 7988, 12169, 15112])
+    [(_, data)] = datahandler.get_handler('accumulate').process_queries([(('a',), series)])
+    assert len(data) == len(series)
+    assert data.isnull().tolist() == [True, True, False, False, False]
+    assert data.iloc[-1] == 7988 + 12169 + 15112
+
+
+def test_unknown_kernel():
+    with pytest.raises(RuntimeError):
+        datahandler.get_handler('accumulate|nope')
+
+
+def test_correlation():
+    a = np.random.RandomState(1).randn(100)
+    results = [(('a', 'x'), timeseries(a)), (('b', 'y'), timeseries(2 * a + 1))]
+    [(_, correl)] = datahandler.get_handler('correlation').process_queries(results)
+    np.testing.assert_allclose(correl.values, np.ones((2, 2)))
+
+
+def test_handler_labels_are_bounded():
+    assert datahandler.handler_label('correlation') == 'correlation'
+    assert datahandler.handler_label('rolling_vol:20') == 'rolling_vol'
+    assert datahandler.handler_label('rolling_vol:20|resample:W') == 'pipeline'
+    assert datahandler.handler_label('rolling_vol:21|resample:M') == 'pipeline'
+    assert datahandler.handler_label('nope:1') == 'other'
@@ -0,0 +1,130 @@
+import time
+import threading
+
+from bucephalus.dataprovider import BaseDataProvider, QueryError, QueryTimeout
+
+
+class SlowProvider(BaseDataProvider):
+    """
+    Returns each query's name after sleeping for as long as it says, e.g. q.0.1, keeping track of
+    the order queries start in and how many run at once
+    """
+    def __init__(self, config):
+        super(SlowProvider, self).__init__(config)
+        self.lock = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.max_running = 0
+
+    def run_query(self, conn, token, query):
+        with self.lock:
+            self.started.append(query)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            name, _, delay = query.partition('.')
+            time.sleep(float(delay or 0))
+            if name == 'fail':
+                raise ValueError('no data for {}'.format(query))
+            return query
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def get_provider(**config):
+    config.setdefault('QUERY_CACHE_BYTES', 0)
+    return SlowProvider(config)
+
+
+def run(provider, queries, **kwargs):
+    results = []
+    lock = threading.Lock()
+
+    def callback(query, data, index, n):
+        with lock:
+            results.append((query, data, index, n))
+
+    provider.run_queries('tok', queries, callback, **kwargs)
+    return results
+
+
+def test_in_flight_queries_are_bounded():
+    provider = get_provider(QUERY_POOL_SIZE=8, QUERY_MAX_IN_FLIGHT=3)
+    queries = ['q{}.0.02'.format(i) for i in range(12)]
+    results = run(provider, queries)
+
+    assert sorted(q for q, _, _, _ in results) == sorted(queries)
+    assert provider.max_running == 3
+
+
+def test_queries_start_in_order_and_results_are_counted_in_order():
+    provider = get_provider(QUERY_POOL_SIZE=1, QUERY_MAX_IN_FLIGHT=4)
+    queries = ['q{}.0.005'.format(i) for i in range(6)]
+    results = run(provider, queries)
+
+    assert provider.started == queries
+    assert [q for q, _, _, _ in results] == queries
+    assert [(i, n) for _, _, i, n in results] == [(i, 6) for i in range(1, 7)]
+    assert all(data == q for q, data, _, _ in results)
+
+
+def test_a_failed_query_is_reported_without_stalling_the_others():
+    provider = get_provider(QUERY_POOL_SIZE=2, QUERY_MAX_IN_FLIGHT=2)
+    results = {q: data for q, data, _, _ in run(provider, ['fail.0', 'a.0.01', 'b.0.01', 'c'])}
+
+    assert isinstance(results.pop('fail.0'), QueryError)
+    assert results == {'a.0.01': 'a.0.01', 'b.0.01': 'b.0.01', 'c': 'c'}
+
+
+def test_a_slow_callback_doesnt_hold_up_the_others():
+    provider = get_provider(QUERY_POOL_SIZE=4, QUERY_MAX_IN_FLIGHT=4)
+    reported = threading.Event()
+    blocked = []
+
+    def callback(query, data, index, n):
+        # the first result waits until the other has been reported
+        if query == 'fast':
+            blocked.append(not reported.wait(2))
+        else:
+            reported.set()
+
+    provider.run_queries('tok', ['fast', 'slow.0.05'], callback)
+    assert blocked == [False]
+
+
+def test_a_slow_query_reaches_its_deadline():
+    provider = get_provider(QUERY_POOL_SIZE=2, QUERY_TIMEOUT=5)
+    t0 = time.perf_counter()
+    results = {q: data for q, data, _, _ in run(provider, ['slow.1', 'fast'], timeouts={'slow.1': 0.05})}
+
+    # we don't wait for it to finish
+    assert time.perf_counter() - t0 < 0.5
+    assert isinstance(results['slow.1'], QueryTimeout)
+    assert results['fast'] == 'fast'
+
+
+def test_the_configured_deadline_is_the_default():
+    provider = get_provider(QUERY_TIMEOUT=0.05)
+    results = {q: data for q, data, _, _ in run(provider, ['slow.1', 'fast'])}
+    assert isinstance(results['slow.1'], QueryTimeout)
+    assert results['fast'] == 'fast'
+
+
+def test_cancelling_stops_pending_queries():
+    provider = get_provider(QUERY_POOL_SIZE=1, QUERY_MAX_IN_FLIGHT=1)
+    cancel = threading.Event()
+    reported = []
+
+    def callback(query, data, index, n):
+        reported.append(query)
+        cancel.set()
+
+    queries = ['q{}.0.02'.format(i) for i in range(10)]
+    t0 = time.perf_counter()
+    provider.run_queries('tok', queries, callback, cancel)
+
+    assert time.perf_counter() - t0 < 0.15
+    assert reported == ['q0.0.02']
+    time.sleep(0.05)
+    assert len(provider.started) <= 2
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus import downsample
+
+
+def series(n):
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({0: np.arange(n, dtype=np.int64) * 1000, 1: rng.randn(n).cumsum()})
+
+
+def test_lttb_keeps_the_ends():
+    data = series(1000)
+    idx = downsample.lttb(data[0].values.astype(float), data[1].values, 50)
+    assert len(idx) == 50
+    assert idx[0] == 0 and idx[-1] == 999
+    assert (np.diff(idx) > 0).all()
+
+
+def test_lttb_keeps_a_spike():
+    y = np.zeros(1000)
+    y[437] = 10.
+    idx = downsample.lttb(np.arange(1000, dtype=float), y, 20)
+    assert 437 in idx
+
+
+def test_minmax_keeps_the_extremes():
+    data = series(1000)
+    idx = downsample.minmax(data[0].values.astype(float), data[1].values, 40)
+    assert len(idx) <= 40
+    assert data[1].values.argmax() in idx and data[1].values.argmin() in idx
+
+
+def test_downsample_reports_what_was_done():
+    data, info = downsample.downsample(series(1000), 100)
+    assert len(data) == 100
+    assert info == {'method': 'lttb', 'points': 100, 'original': 1000}
+
+
+def test_short_series_are_untouched():
+    data = series(10)
+    ret, info = downsample.downsample(data, 100)
+    assert ret is data and info is None
+
+
+def test_drops_missing_values():
+    data = series(1000)
+    data.iloc[::2, 1] = np.nan
+    ret, _ = downsample.downsample(data, 100)
+    assert ret[1].notnull().all()
+
+
+@pytest.mark.parametrize('options,expected', [
+    ({}, None),
+    ({'maxPoints': 500}, 500),
+    ({'pixelWidth': 300}, 300),
+    ({'pixelWidth': 300, 'downsample': 'minmax'}, 600),
+    ({'maxPoints': 1}, downsample.MIN_POINTS),
+    ({'pixelWidth': 1}, downsample.MIN_POINTS),
+])
+def test_get_max_points(options, expected):
+    assert downsample.get_max_points(options) == expected
+
+
+@pytest.mark.parametrize('options', [{'maxPoints': 0}, {'pixelWidth': -5}, {'downsample': 'nope'}])
+def test_get_max_points_rejects_bad_options(options):
+    with pytest.raises(RuntimeError):
+        downsample.get_max_points(options)
+
+
+def test_tiny_max_points_still_downsamples():
+    [(key, data, info)] = downsample.downsample_series([(('a',), series(1000))], {'maxPoints': 2})
+    assert len(data) == downsample.MIN_POINTS
+    assert info['points'] == len(data)
+    assert key == ('a', 'lttb:3')
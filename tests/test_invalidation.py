@@ -0,0 +1,75 @@
+import os
+import json
+
+from bucephalus.invalidation import Invalidations
+
+
+def solar_views():
+    return [{'viewtype': 'basic_col', 'series': [{'label': 'sales', 'query': 'solar.sales'}]}]
+
+
+def post(client, token):
+    response = client.post('/views/{}'.format(token), json=solar_views())
+    return json.loads(response.get_data().decode('utf-8').split(';')[-2])
+
+
+def test_invalidations_are_seen_by_other_processes(tmp_path):
+    ours, theirs = Invalidations(str(tmp_path), 0), Invalidations(str(tmp_path), 0)
+
+    # nothing could have been cached before the first look
+    theirs.invalidate('tok')
+    assert not ours.changed('tok')
+
+    theirs.invalidate('tok')
+    assert ours.changed('tok')
+    assert not ours.changed('tok')
+    assert not ours.changed('other')
+
+    # our own invalidations have already been acted on
+    ours.invalidate('tok')
+    assert not ours.changed('tok')
+    assert theirs.changed('tok')
+    assert len(os.listdir(str(tmp_path))) == 1
+
+
+def test_stamps_are_only_read_every_check_interval(tmp_path):
+    ours, theirs = Invalidations(str(tmp_path), 60), Invalidations(str(tmp_path), 60)
+    assert not ours.changed('tok')
+
+    theirs.invalidate('tok')
+    assert not ours.changed('tok')
+
+    ours.check_interval = 0
+    assert ours.changed('tok')
+
+
+def test_pages_invalidated_by_another_worker_are_rebuilt(client, monkeypatch):
+    import bucephalus
+    monkeypatch.setattr(bucephalus.invalidations, 'check_interval', 0)
+
+    assert not post(client, 'inv-other').get('cached')
+    assert post(client, 'inv-other').get('cached')
+
+    Invalidations(bucephalus.invalidations.path).invalidate('inv-other')
+    assert not post(client, 'inv-other').get('cached')
+    assert post(client, 'inv-other').get('cached')
+
+
+def test_invalidate_endpoint(app, client, monkeypatch):
+    import bucephalus
+    other = Invalidations(bucephalus.invalidations.path, 0)
+    assert not other.changed('inv-token')
+
+    assert client.post('/invalidate/inv-token').status_code == 403
+    monkeypatch.setitem(app.config, 'ADMIN_SECRET', 'secret')
+    assert client.post('/invalidate/inv-token', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+    post(client, 'inv-token')
+    response = client.post('/invalidate/inv-token', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    counts = json.loads(response.get_data())
+    assert counts['pages'] == 1 and counts['queries'] >= 1
+
+    assert not post(client, 'inv-token').get('cached')
+    # and the other workers drop theirs
+    assert other.changed('inv-token')
@@ -0,0 +1,188 @@
+import os
+import copy
+import json
+import logging
+
+from collections import namedtuple
+
+from bucephalus.jsonviews import JSONViewBuilder, HighChartsViewBuilder
+from bucephalus.jsonviews import CATALOG_VERSION, get_catalog_path, load_catalog, save_catalog
+from bucephalus.viewtools import compile_template, render_template, template_recurse
+
+
+def write_view(path, name, definition, prototypes=None, mtime=None):
+    body = {'viewDefinition': definition}
+    if prototypes:
+        body['prototypes'] = prototypes
+    file_path = os.path.join(str(path), name + '.json')
+    with open(file_path, 'w') as fh:
+        json.dump(body, fh)
+    if mtime is not None:
+        os.utime(file_path, (mtime, mtime))
+
+
+def test_prototypes_are_merged(tmp_path):
+    write_view(tmp_path, 'base', {'chart': {'type': 'line'}, 'title': 'base'})
+    write_view(tmp_path, 'child', {'title': 'child'}, 'base')
+    builder = JSONViewBuilder(str(tmp_path))
+    assert builder.get_view('child').view_def == {'chart': {'type': 'line'}, 'title': 'child'}
+
+
+def test_removed_prototype_is_not_retried_until_a_file_changes(tmp_path, caplog):
+    write_view(tmp_path, 'base', {'title': 'base'}, mtime=1000)
+    write_view(tmp_path, 'child', {'title': 'child'}, 'base', mtime=1000)
+    builder = JSONViewBuilder(str(tmp_path))
+
+    os.remove(os.path.join(str(tmp_path), 'base.json'))
+    with caplog.at_level(logging.ERROR):
+        assert builder.reload_views() == {'base', 'child'}
+    assert builder.list_views() == []
+    assert len([r for r in caplog.records if 'Error building view' in r.message]) == 1
+
+    caplog.clear()
+    with caplog.at_level(logging.ERROR):
+        assert builder.reload_views() == set()
+    assert not caplog.records
+
+    # putting the prototype back brings the child back with it
+    write_view(tmp_path, 'base', {'title': 'base', 'x': 1}, mtime=2000)
+    builder.reload_views()
+    assert builder.list_views() == ['base', 'child']
+    assert builder.get_view('child').view_def == {'title': 'child', 'x': 1}
+
+
+CatalogEntry = namedtuple('CatalogEntry', ['path', 'mtime', 'typ', 'raw_def', 'prototypes'])
+
+
+def catalog_loads(caplog):
+    return sorted(r.args[0] for r in caplog.records if r.msg == 'Loaded view %s from the catalog')
+
+
+def test_catalog_path_is_in_the_cache_directory(tmp_path, monkeypatch):
+    assert get_catalog_path({}) is None
+    assert get_catalog_path({'VIEW_CATALOG': 'views.json', 'CACHE_DIR': str(tmp_path)}) == \
+        os.path.join(str(tmp_path), 'views.json')
+    assert get_catalog_path({'VIEW_CATALOG': '/srv/views.json', 'CACHE_DIR': str(tmp_path)}) == '/srv/views.json'
+
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert get_catalog_path({'VIEW_CATALOG': 'views.json', 'CACHE_DIR': None}) == \
+        os.path.join(str(tmp_path), 'bucephalus', 'views.json')
+
+    monkeypatch.delenv('XDG_CACHE_HOME')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    assert get_catalog_path({'VIEW_CATALOG': 'views.json'}) == \
+        os.path.join(str(tmp_path), '.cache', 'bucephalus', 'views.json')
+
+
+def test_unchanged_views_are_loaded_from_the_catalog(tmp_path, caplog):
+    views_dir, catalog = tmp_path / 'views', os.path.join(str(tmp_path), 'cache', 'catalog.json')
+    views_dir.mkdir()
+    write_view(views_dir, 'base', {'title': 'base'}, mtime=1000)
+    write_view(views_dir, 'child', {'title': 'child'}, 'base', mtime=1000)
+
+    with caplog.at_level(logging.DEBUG):
+        JSONViewBuilder(str(views_dir), catalog)
+    assert catalog_loads(caplog) == []
+    assert sorted(load_catalog(catalog)) == ['base', 'child']
+
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG):
+        builder = JSONViewBuilder(str(views_dir), catalog)
+    assert catalog_loads(caplog) == ['base', 'child']
+    assert builder.get_view('child').view_def == {'title': 'child'}
+
+    # a file whose mtime doesn't match its entry is parsed again
+    write_view(views_dir, 'base', {'title': 'base', 'x': 1}, mtime=2000)
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG):
+        builder = JSONViewBuilder(str(views_dir), catalog)
+    assert catalog_loads(caplog) == ['child']
+    assert builder.get_view('child').view_def == {'title': 'child', 'x': 1}
+    assert load_catalog(catalog)['base']['mtime'] == 2000
+
+
+def test_catalogs_from_another_version_are_ignored(tmp_path):
+    path = os.path.join(str(tmp_path), 'catalog.json')
+    assert load_catalog(path) == {}
+
+    save_catalog(path, {'a': CatalogEntry('a.json', 1000, 'json', {'title': 'a'}, [])})
+    assert list(load_catalog(path)) == ['a']
+
+    with open(path, 'w') as fh:
+        json.dump({'version': CATALOG_VERSION + 1, 'views': {'a': {}}}, fh)
+    assert load_catalog(path) == {}
+
+    with open(path, 'w') as fh:
+        fh.write('{"version": 1, "vie')
+    assert load_catalog(path) == {}
+
+
+def test_failed_catalog_writes_leave_the_old_one(tmp_path):
+    path = os.path.join(str(tmp_path), 'catalog.json')
+    save_catalog(path, {'a': CatalogEntry('a.json', 1000, 'json', {'title': 'a'}, [])})
+
+    # fails part way through writing
+    save_catalog(path, {'a': CatalogEntry('a.json', 2000, 'json', {'title': object()}, [])})
+    assert os.listdir(str(tmp_path)) == ['catalog.json']
+    assert load_catalog(path)['a']['mtime'] == 1000
+
+
+def test_slot_rendering_matches_a_deep_copy_render():
+    definition = {'title': {'text': '{{name}} in {{year}}'}, 'yAxis': [{'min': '{{min}}'}, {'max': 10}],
+                  'chart': {'type': 'line', 'options': {'a': [1, 2]}}, 'label': 'fixed'}
+    tags = {'{{name}}': 'sales', '{{year}}': 2012, '{{min}}': 0}
+
+    rendered = render_template(definition, compile_template(definition), tags)
+    assert rendered == template_recurse(copy.deepcopy(definition), tags)
+    assert rendered['yAxis'][0]['min'] == 0
+
+    # only the containers on the way to a placeholder are copied
+    assert rendered['chart'] is definition['chart']
+    assert rendered['title'] is not definition['title']
+    assert definition['title']['text'] == '{{name}} in {{year}}'
+
+
+def test_views_without_placeholders_are_shared():
+    definition = {'chart': {'type': 'line'}}
+    assert compile_template(definition) is None
+    assert render_template(definition, None, {'{{x}}': 1}) is definition
+
+
+def test_rendered_views_are_memoized_by_tag_value_and_type(tmp_path):
+    write_view(tmp_path, 'view', {'value': '{{x}}'})
+    view = JSONViewBuilder(str(tmp_path)).get_view('view')
+
+    assert view.render_tags({'x': 1}) is view.render_tags({'x': 1})
+    assert [view.render_tags({'x': v})['value'] for v in (1, True, 1.0)] == [1, True, 1.0]
+    assert [type(view.render_tags({'x': v})['value']) for v in (1, True, 1.0)] == [int, bool, float]
+
+
+def test_memo_is_reset_when_a_view_is_rebuilt(tmp_path):
+    write_view(tmp_path, 'base', {'title': 'base'})
+    write_view(tmp_path, 'child', {'value': '{{x}}'}, 'base')
+    builder = JSONViewBuilder(str(tmp_path))
+    child = builder.get_view('child')
+
+    before = child.render_tags({'x': 1})
+    builder.get_view('base').raw_def = {'title': 'changed'}
+    child.build(force=True)
+
+    after = child.render_tags({'x': 1})
+    assert after is not before
+    assert after == {'title': 'changed', 'value': 1}
+
+
+def test_highcharts_build_view_leaves_the_memoized_view_alone(tmp_path):
+    write_view(tmp_path, 'line', {'chart': {'type': 'line'}, 'title': {'text': '{{name}}'}})
+    builder = HighChartsViewBuilder(str(tmp_path))
+    rendered = builder.get_view('line').render_tags({'name': 'sales'})
+    expected = copy.deepcopy(rendered)
+
+    # the view's own definition takes precedence over the options it's built with
+    ret = builder.build_view('line', {'name': 'sales'}, [(['q', 'label'], None)],
+                             {'chart': {'height': 300}, 'title': {'text': 'other'}})
+    assert ret == {'chart': {'type': 'line', 'height': 300}, 'title': {'text': 'sales'},
+                   'series': [['q', 'label']]}
+
+    assert builder.get_view('line').render_tags({'name': 'sales'}) is rendered
+    assert rendered == expected
@@ -0,0 +1,86 @@
+import os
+import time
+
+import numpy as np
+
+from bucephalus.mplviews import ImageCache, MPLViewBuilder
+
+
+def write_image(path, size, age):
+    with open(path, 'wb') as fh:
+        fh.write(b'\0' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_touch_marks_an_image_as_used(tmp_path):
+    cache = ImageCache(str(tmp_path), 1000, None)
+    path = write_image(os.path.join(str(tmp_path), 'a.png'), 10, 100)
+
+    assert cache.touch(path)
+    assert time.time() - os.stat(path).st_mtime < 10
+    assert not cache.touch(os.path.join(str(tmp_path), 'missing.png'))
+
+
+def test_sweep_evicts_the_least_recently_used_past_max_bytes(tmp_path):
+    cache = ImageCache(str(tmp_path), 250, None)
+    for name, age in [('old', 300), ('middle', 200), ('new', 100)]:
+        write_image(os.path.join(str(tmp_path), name + '.png'), 100, age)
+    write_image(os.path.join(str(tmp_path), 'other.txt'), 1000, 1000)
+
+    cache.sweep(force=True)
+    assert sorted(os.listdir(str(tmp_path))) == ['middle.png', 'new.png', 'other.txt']
+
+
+def test_sweep_evicts_images_past_max_age(tmp_path):
+    cache = ImageCache(str(tmp_path), 1000, 150)
+    write_image(os.path.join(str(tmp_path), 'old.png'), 10, 200)
+    write_image(os.path.join(str(tmp_path), 'new.png'), 10, 100)
+
+    cache.sweep(force=True)
+    assert os.listdir(str(tmp_path)) == ['new.png']
+
+
+def test_sweeps_are_rate_limited(tmp_path):
+    cache = ImageCache(str(tmp_path), 0, None, sweep_interval=60)
+    cache.sweep()
+    path = write_image(os.path.join(str(tmp_path), 'a.png'), 10, 0)
+
+    cache.sweep()
+    assert os.path.exists(path)
+    cache.sweep(force=True)
+    assert not os.path.exists(path)
+
+
+def test_identical_figures_reuse_the_image(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    builder = MPLViewBuilder()
+    data = [(('query', 'label'), np.arange(10.))]
+
+    key = builder.image_key('overview_distribution', {}, data, {})
+    assert key == builder.image_key('overview_distribution', {}, [(('query', 'label'), np.arange(10.))], {})
+    assert key != builder.image_key('overview_distribution', {}, [(('query', 'label'), np.arange(11.))], {})
+    assert key != builder.image_key('overview_distribution', {'a': 1}, data, {})
+    assert key != builder.image_key('overview_distribution', {}, data, {'width': 100})
+
+    path = write_image(os.path.join('img', key + '.png'), 10, 100)
+    assert builder.build_view('overview_distribution', {}, data, {}) == {'result': 'img/{}.png'.format(key)}
+    # it's served from the cache, without starting the render processes
+    assert builder._pool is None
+    assert time.time() - os.stat(path).st_mtime < 10
+
+
+def test_figures_are_rendered_in_the_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    builder = MPLViewBuilder({'MPL_POOL_SIZE': 1})
+    data = [(('query', 'label'), np.random.RandomState(0).randn(100))]
+
+    try:
+        result = builder.build_view('overview_distribution', {}, data, {})['result']
+        assert os.path.getsize(result) > 0
+        with open(result, 'rb') as fh:
+            assert fh.read(8) == b'\x89PNG\r\n\x1a\n'
+        assert builder._pool._mp_context.get_start_method() != 'fork'
+    finally:
+        builder._pool.shutdown()
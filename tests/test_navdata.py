@@ -0,0 +1,104 @@
+import os
+import json
+
+import pytest
+
+from bucephalus import navdata
+from bucephalus.navdata import NavCache
+
+
+class NavProvider(object):
+    """
+    Builds a nav tree per token, from views that can be changed along with the provider's version
+    """
+    def __init__(self):
+        self.version = 1
+        self.views = ['a']
+        self.tokens = ['tok']
+        self.builds = 0
+
+    def get_version(self):
+        return self.version
+
+    def get_tokens(self):
+        return self.tokens
+
+    def build_nav(self, token):
+        self.builds += 1
+        return [{'text': token, 'views': [{'viewtype': v} for v in self.views]}]
+
+
+@pytest.fixture
+def nav_client(app, monkeypatch):
+    import bucephalus
+    provider = NavProvider()
+    monkeypatch.setattr(bucephalus, 'nav_cache', NavCache(provider))
+    return app.test_client(), provider
+
+
+def test_matching_etag_returns_304_without_a_body(nav_client):
+    client, provider = nav_client
+
+    response = client.get('/navdata/tok')
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert json.loads(response.get_data()) == [{'text': 'tok', 'views': [{'viewtype': 'a'}]}]
+
+    response = client.get('/navdata/tok', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+    # the tree was only built once
+    assert provider.builds == 1
+
+
+def test_changed_views_get_a_new_etag(nav_client):
+    client, provider = nav_client
+    etag = client.get('/navdata/tok').headers['ETag']
+
+    provider.views = ['a', 'b']
+    # the cached tree is kept until the provider's version changes
+    assert client.get('/navdata/tok', headers={'If-None-Match': etag}).status_code == 304
+
+    provider.version = 2
+    response = client.get('/navdata/tok', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(json.loads(response.get_data())[0]['views']) == 2
+
+    # tokens have their own trees and ETags
+    assert client.get('/navdata/other').headers['ETag'] != response.headers['ETag']
+
+
+def test_token_list_etag(nav_client):
+    client, provider = nav_client
+
+    response = client.get('/get_tokens')
+    assert json.loads(response.get_data()) == ['tok']
+    assert client.get('/get_tokens', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+    provider.tokens = ['tok', 'new']
+    provider.version = 2
+    response = client.get('/get_tokens', headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 200
+    assert json.loads(response.get_data()) == ['tok', 'new']
+
+
+def test_nav_file_is_reread_when_it_changes(tmp_path, monkeypatch):
+    path = os.path.join(str(tmp_path), 'navdata.json')
+    monkeypatch.setattr(navdata, 'get_nav_path', lambda: path)
+    provider = NavProvider()
+    provider.build_nav = lambda token: None
+    cache = NavCache(provider)
+
+    with open(path, 'w') as fh:
+        json.dump([{'text': 'one'}], fh)
+    body, etag = cache.get_pages('tok')
+    assert cache.get_pages('tok') == (body, etag)
+
+    with open(path, 'w') as fh:
+        json.dump([{'text': 'one'}, {'text': 'two'}], fh)
+    body, new_etag = cache.get_pages('tok')
+    assert new_etag != etag
+    assert len(json.loads(body.decode('utf-8'))) == 2
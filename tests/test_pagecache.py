@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from bucephalus import pagecache
+from bucephalus.pagecache import PageCache, make_ref
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def page(name, size=100):
+    msg = {'id': name, 'category': 'data', 'series': [name], 'hash': 'h' + name}
+    return [(b'x' * size, make_ref(msg)), (b'y' * 10, None)]
+
+
+def key(token, name):
+    return token, 'gzip', name
+
+
+def test_make_ref():
+    msg = {'id': 'v', 'category': 'data', 'series': ['q', 'label'], 'data': [], 'hash': 'abc'}
+    assert make_ref(msg) == {'id': 'v', 'category': 'ref', 'series': ['q', 'label'], 'hash': 'abc'}
+    assert make_ref({'id': 'v', 'category': 'graph', 'result': {}}) is None
+
+
+def test_get_and_put():
+    cache = PageCache(1 << 20)
+    assert cache.get(key('tok', 'a')) is None
+
+    cache.put(key('tok', 'a'), page('a'))
+    assert cache.get(key('tok', 'a')) == page('a')
+    assert cache.stats()['bytes'] == 110
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_put_replaces():
+    cache = PageCache(1 << 20)
+    cache.put(key('tok', 'a'), page('a'))
+    cache.put(key('tok', 'a'), page('a', 200))
+    assert cache.stats()['bytes'] == 210
+
+
+def test_least_recently_used_is_evicted():
+    cache = PageCache(250)
+    cache.put(key('tok', 'a'), page('a'))
+    cache.put(key('tok', 'b'), page('b'))
+    cache.get(key('tok', 'a'))
+    cache.put(key('tok', 'c'), page('c'))
+
+    assert list(cache.entries) == [key('tok', 'a'), key('tok', 'c')]
+    assert cache.get(key('tok', 'b')) is None
+    assert cache.stats()['evictions'] == 1
+
+
+def test_evicted_pages_are_spilled_and_read_back(tmp_path):
+    cache = PageCache(250, spill_dir=str(tmp_path))
+    cache.put(key('tok', 'a'), page('a'))
+    cache.put(key('tok', 'b'), page('b'))
+    cache.put(key('tok', 'c'), page('c'))
+
+    path = cache.get_spill_path(key('tok', 'a'))
+    assert os.path.exists(path)
+
+    # reading it back takes it off disk, and evicts b to make room
+    assert cache.get(key('tok', 'a')) == page('a')
+    assert not os.path.exists(path)
+    assert cache.stats()['spill_hits'] == 1
+    assert list(cache.entries) == [key('tok', 'c'), key('tok', 'a')]
+    assert os.path.exists(cache.get_spill_path(key('tok', 'b')))
+
+
+def test_pages_larger_than_the_cache_go_straight_to_disk(tmp_path):
+    cache = PageCache(50, spill_dir=str(tmp_path))
+    cache.put(key('tok', 'a'), page('a'))
+    assert cache.stats()['entries'] == 0
+    assert cache.get(key('tok', 'a')) == page('a')
+
+
+def test_ttl_applies_in_memory_and_on_disk(monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(pagecache, 'time', clock)
+    cache = PageCache(150, spill_dir=str(tmp_path), ttl=60)
+
+    cache.put(key('tok', 'a'), page('a'))
+    clock.now += 30
+    cache.put(key('tok', 'b'), page('b'))  # spills a
+    assert cache.get(key('tok', 'b')) == page('b')
+
+    clock.now += 30
+    assert cache.get(key('tok', 'a')) is None
+    assert cache.get(key('tok', 'b')) == page('b')
+
+    clock.now += 30
+    assert cache.get(key('tok', 'b')) is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_invalidate_only_drops_the_token(tmp_path):
+    cache = PageCache(250, spill_dir=str(tmp_path))
+    cache.put(key('tok1', 'a'), page('a'))
+    cache.put(key('tok1', 'b'), page('b'))
+    cache.put(key('tok2', 'a'), page('a'))  # spills tok1 a
+
+    assert cache.invalidate('tok1') == 1
+    assert cache.get(key('tok1', 'a')) is None
+    assert cache.get(key('tok1', 'b')) is None
+    assert cache.get(key('tok2', 'a')) == page('a')
+
+
+def test_clear(tmp_path):
+    cache = PageCache(150, spill_dir=str(tmp_path))
+    cache.put(key('tok', 'a'), page('a'))
+    cache.put(key('tok', 'b'), page('b'))
+
+    cache.clear()
+    assert cache.stats()['bytes'] == 0
+    assert os.listdir(str(tmp_path)) == []
+    assert cache.get(key('tok', 'a')) is None
@@ -0,0 +1,73 @@
+import os
+import json
+
+import pytest
+
+from bucephalus import pages
+
+
+def random_page():
+    return {'text': 'Random', 'views': [{'viewtype': 'basic_col',
+                                         'series': [{'label': 'random', 'query': 'univariate_random'}]}]}
+
+
+def solar_page():
+    return {'text': 'Solar', 'views': [{'viewtype': 'basic_col',
+                                        'series': [{'label': 'sales', 'query': 'solar.sales'},
+                                                   {'label': 'other', 'query': 'solar.other'}]}]}
+
+
+@pytest.fixture
+def view_defs(app):
+    import bucephalus
+    return bucephalus.view_defs
+
+
+def test_iter_pages_and_find_page():
+    nav = [{'text': 'Top', 'views': [1], 'nodes': [{'text': 'Empty', 'nodes': [{'text': 'Leaf', 'views': [2]}]}]}]
+
+    assert [(path, page['views']) for path, page in pages.iter_pages(nav)] == [('Top', [1]), ('Top/Empty/Leaf', [2])]
+    assert pages.find_page(nav, 'Top/Empty/Leaf')['views'] == [2]
+    assert pages.find_page(nav, 'Top/Empty') is None
+
+
+def test_is_safe_path():
+    assert pages.is_safe_path('Top/Leaf')
+    assert not pages.is_safe_path('Top/../Leaf')
+    assert not pages.is_safe_path('Top//Leaf')
+
+
+def test_only_deterministic_pages_are_cached(view_defs):
+    assert view_defs.is_deterministic(solar_page()['views'])
+    assert not view_defs.is_deterministic(random_page()['views'])
+    assert not view_defs.is_deterministic(solar_page()['views'] + random_page()['views'])
+
+    assert view_defs.get_page_key('tok', 'json', solar_page()['views']) is not None
+    assert view_defs.get_page_key('tok', 'json', random_page()['views']) is None
+
+
+def test_deterministic_pages_are_replayed_from_the_cache(client):
+    def post(page):
+        response = client.post('/views/cached-token', json=page['views'])
+        return [json.loads(m) for m in response.get_data().decode('utf-8').split(';')[:-1]]
+
+    first, second = post(solar_page()), post(solar_page())
+    assert not first[-1].get('cached') and second[-1].get('cached')
+    assert [m for m in first if m['category'] == 'data'] == [m for m in second if m['category'] == 'data']
+
+    assert not any(m.get('cached') for m in post(random_page()) + post(random_page()))
+
+
+def test_only_deterministic_pages_are_precomputed(view_defs, tmp_path):
+    nav = [solar_page(), dict(random_page(), nodes=[solar_page()])]
+    written, failed = pages.precompute_token(view_defs, nav, 'tok', str(tmp_path), encodings=['json'])
+
+    assert (written, failed) == (2, 1)
+    token_dir = os.path.join(str(tmp_path), 'tok')
+    assert sorted(os.listdir(token_dir)) == ['Random', 'Solar.json', 'Solar.json.gz']
+    # the random page is left for the app to build, but not the page under it
+    assert sorted(os.listdir(os.path.join(token_dir, 'Random'))) == ['Solar.json', 'Solar.json.gz']
+
+    with open(os.path.join(token_dir, 'Solar.json'), 'rb') as fh:
+        categories = [json.loads(m)['category'] for m in fh.read().decode('utf-8').split(';')[:-1]]
+    assert categories.count('data') == 2 and categories.count('graph') == 1
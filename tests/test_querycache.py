@@ -0,0 +1,125 @@
+import threading
+
+import numpy as np
+import pytest
+
+from bucephalus import querycache
+from bucephalus.querycache import QueryCache
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_hit_after_fetch():
+    cache = QueryCache(1 << 20)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return np.arange(10)
+
+    first = cache.get(('tok', 'q'), fetch)
+    second = cache.get(('tok', 'q'), fetch)
+    assert second is first
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_concurrent_requests_share_one_fetch():
+    cache = QueryCache(1 << 20)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return np.arange(10)
+
+    results = [None] * 4
+
+    def run(i):
+        results[i] = cache.get(('tok', 'q'), fetch)
+
+    threads = [threading.Thread(target=run, args=(0,))]
+    threads[0].start()
+    assert started.wait(5)
+
+    threads += [threading.Thread(target=run, args=(i,)) for i in range(1, 4)]
+    for t in threads[1:]:
+        t.start()
+    # wait until the others are queued behind the fetch in flight
+    while cache.stats()['waits'] < 3:
+        threading.Event().wait(0.001)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+
+
+def test_errors_are_raised_and_not_cached():
+    cache = QueryCache(1 << 20)
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        cache.get(('tok', 'q'), fail)
+    assert cache.get(('tok', 'q'), lambda: np.arange(3)).tolist() == [0, 1, 2]
+
+
+def test_failed_queries_are_not_cached():
+    cache = QueryCache(1 << 20)
+    assert cache.get(('tok', 'q'), lambda: None) is None
+    assert cache.get(('tok', 'q'), lambda: np.arange(3)) is not None
+
+
+def test_least_recently_used_is_evicted():
+    item = np.zeros(100)  # 800 bytes
+    cache = QueryCache(2000)
+
+    cache.get(('tok', 'a'), lambda: item.copy())
+    cache.get(('tok', 'b'), lambda: item.copy())
+    cache.get(('tok', 'a'), lambda: pytest.fail('a should be cached'))
+    cache.get(('tok', 'c'), lambda: item.copy())
+
+    assert list(cache.entries) == [('tok', 'a'), ('tok', 'c')]
+    assert cache.stats()['bytes'] == 1600
+    assert cache.stats()['evictions'] == 1
+
+
+def test_results_larger_than_the_cache_are_not_kept():
+    cache = QueryCache(100)
+    cache.get(('tok', 'q'), lambda: np.zeros(100))
+    assert cache.stats()['entries'] == 0
+
+
+def test_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(querycache, 'time', clock)
+    cache = QueryCache(1 << 20, ttl=60)
+
+    cache.get(('tok', 'q'), lambda: np.arange(3))
+    clock.now += 59
+    cache.get(('tok', 'q'), lambda: pytest.fail('should still be cached'))
+    clock.now += 1
+    assert cache.get(('tok', 'q'), lambda: np.arange(5)).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_invalidate_only_drops_the_token():
+    cache = QueryCache(1 << 20)
+    cache.get(('tok1', 'a'), lambda: np.arange(3))
+    cache.get(('tok1', 'b'), lambda: np.arange(3))
+    cache.get(('tok2', 'a'), lambda: np.arange(3))
+
+    assert cache.invalidate('tok1') == 2
+    assert list(cache.entries) == [('tok2', 'a')]
+    assert cache.stats()['bytes'] == cache.entries[('tok2', 'a')][1]
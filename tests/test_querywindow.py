@@ -0,0 +1,106 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus import querywindow
+from bucephalus.querywindow import QueryWindow, parse_query, format_query, apply_window
+
+
+def daily(n=60):
+    dates = pd.date_range('2020-01-01', periods=n).values.astype('datetime64[ms]').astype(np.int64)
+    return pd.DataFrame({0: dates, 1: np.arange(n, dtype=np.float64)})
+
+
+def ts(date):
+    return querywindow.to_timestamp(date)
+
+
+def test_parse_and_format_round_trip():
+    base, window = parse_query('a.b?start=2020-01-01&last=5&freq=W')
+    assert base == 'a.b'
+    assert window == QueryWindow(ts('2020-01-01'), None, 5, 'W')
+    assert parse_query(format_query(base, window)) == (base, window)
+
+
+def test_plain_queries_have_no_window():
+    assert parse_query('a.b') == ('a.b', None)
+    assert format_query('a.b', None) == 'a.b'
+
+
+def test_bad_parameters():
+    with pytest.raises(RuntimeError):
+        parse_query('a?bogus=1')
+    with pytest.raises(RuntimeError):
+        parse_query('a?last=0')
+
+
+def test_series_query_merges_keys():
+    query = querywindow.series_query({'query': 'a?start=2020-01-01', 'last': 3})
+    assert parse_query(query)[1] == QueryWindow(ts('2020-01-01'), None, 3, None)
+
+
+def test_apply_window_cuts_dates_then_last():
+    data = apply_window(daily(), QueryWindow(ts('2020-01-10'), ts('2020-01-20'), 3, None))
+    assert data.iloc[:, 1].tolist() == [17., 18., 19.]
+
+
+def test_apply_window_resamples_to_last_in_period():
+    data = apply_window(daily(), QueryWindow(None, ts('2020-01-12'), None, 'W'))
+    # 2020-01-05 and 2020-01-12 are Sundays
+    assert data.iloc[:, 1].tolist() == [4., 11.]
+
+
+def test_union_of_last_windows_keeps_pushdown():
+    union = querywindow.union_window([QueryWindow(None, None, 5, None), QueryWindow(None, None, 10, None)])
+    assert union == QueryWindow(None, None, 10, None)
+
+
+def test_last_windows_with_other_windows_are_not_merged():
+    assert querywindow.merge_key(QueryWindow(None, None, 5, None)) != \
+        querywindow.merge_key(QueryWindow(ts('2020-01-01'), None, None, None))
+    assert querywindow.merge_key(QueryWindow(None, ts('2020-02-01'), 5, None)) != \
+        querywindow.merge_key(QueryWindow(None, None, 5, None))
+
+
+
+def test_resampled_windows_over_different_dates_are_not_merged():
+    first = QueryWindow(ts('2020-01-08'), ts('2020-01-15'), None, 'W')
+    second = QueryWindow(ts('2020-01-02'), ts('2020-01-22'), None, 'W')
+    assert querywindow.merge_key(first) != querywindow.merge_key(second)
+
+    # 2020-01-15 is mid-week, so cutting it from the resampled union loses the week it ends in
+    union = querywindow.union_window([first, second])
+    cut = apply_window(apply_window(daily(), union), first._replace(freq=None))
+    assert len(cut) != len(apply_window(daily(), first))
+
+
+WINDOWS = [
+    None,
+    QueryWindow(ts('2020-01-03'), ts('2020-01-15'), None, None),
+    QueryWindow(ts('2020-01-10'), None, 4, None),
+    QueryWindow(None, ts('2020-01-20'), None, None),
+    QueryWindow(None, None, 7, None),
+    QueryWindow(None, None, 3, None),
+    QueryWindow(None, ts('2020-01-25'), 2, None),
+    QueryWindow(ts('2020-01-08'), ts('2020-01-22'), None, 'W'),
+    QueryWindow(ts('2020-01-08'), ts('2020-01-22'), 2, 'W'),
+    QueryWindow(ts('2020-01-02'), ts('2020-01-22'), None, 'W'),
+    QueryWindow(None, None, 3, 'W'),
+    QueryWindow(None, None, 5, 'W'),
+]
+
+
+@pytest.mark.parametrize('first,second', list(itertools.combinations(WINDOWS, 2)))
+def test_cutting_merged_windows_matches_fetching_them_alone(first, second):
+    if querywindow.merge_key(first) != querywindow.merge_key(second):
+        return
+
+    data = daily()
+    union = querywindow.union_window([first, second])
+    fetched = apply_window(data, union)
+    for window in (first, second):
+        cut = apply_window(fetched, querywindow.cut_window(window, union))
+        expected = apply_window(data, window)
+        np.testing.assert_array_equal(cut.values, expected.values)
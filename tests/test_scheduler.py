@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from bucephalus.scheduler import BuildScheduler, SchedulerFull, INTERACTIVE, PREFETCH
+
+
+def block_worker(scheduler):
+    """
+    Occupies the scheduler's only worker until the returned event is set
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def func():
+        started.set()
+        release.wait(5)
+
+    job = scheduler.submit(func)
+    assert started.wait(5)
+    return release, job
+
+
+def test_jobs_run_in_priority_order():
+    scheduler = BuildScheduler(1, 10)
+    release, first = block_worker(scheduler)
+
+    ran = []
+    jobs = [scheduler.submit(lambda name=name: ran.append(name), priority)
+            for name, priority in [('prefetch1', PREFETCH), ('interactive1', INTERACTIVE),
+                                   ('prefetch2', PREFETCH), ('interactive2', INTERACTIVE)]]
+    release.set()
+    assert all(job.join(5) for job in jobs)
+
+    # interactive builds go first, and otherwise in the order they came
+    assert ran == ['interactive1', 'interactive2', 'prefetch1', 'prefetch2']
+
+
+def test_full_queue_is_rejected():
+    scheduler = BuildScheduler(1, 2)
+    release, _ = block_worker(scheduler)
+
+    jobs = [scheduler.submit(lambda: None) for _ in range(2)]
+    with pytest.raises(SchedulerFull):
+        scheduler.submit(lambda: None)
+    assert scheduler.stats()['waiting'] == 2
+
+    release.set()
+    assert all(job.join(5) for job in jobs)
+    assert scheduler.submit(lambda: None).join(5)
+
+
+def test_prefetches_are_shed_first():
+    scheduler = BuildScheduler(1, 4, prefetch_share=0.5)
+    release, _ = block_worker(scheduler)
+
+    scheduler.submit(lambda: None, PREFETCH)
+    scheduler.submit(lambda: None, PREFETCH)
+    with pytest.raises(SchedulerFull):
+        scheduler.submit(lambda: None, PREFETCH)
+
+    # interactive builds are still admitted
+    scheduler.submit(lambda: None, INTERACTIVE)
+    scheduler.submit(lambda: None, INTERACTIVE)
+    with pytest.raises(SchedulerFull):
+        scheduler.submit(lambda: None, INTERACTIVE)
+    release.set()
+
+
+def test_cancelled_jobs_dont_start():
+    scheduler = BuildScheduler(1, 10)
+    release, _ = block_worker(scheduler)
+
+    ran = []
+    job = scheduler.submit(lambda: ran.append(1))
+    job.cancel()
+    release.set()
+
+    assert job.join(5)
+    assert ran == []
+
+
+def test_errors_dont_stop_the_worker():
+    scheduler = BuildScheduler(1, 10)
+
+    def fail():
+        raise ValueError('boom')
+
+    assert scheduler.submit(fail).join(5)
+    assert scheduler.submit(lambda: None).join(5)
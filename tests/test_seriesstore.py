@@ -0,0 +1,131 @@
+import os
+import json
+import shutil
+import subprocess
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus.seriesstore import SeriesStore, SeriesStoreWriter, SeriesStoreProvider, build_store, split_series
+
+
+def daily(n, start='2020-01-01'):
+    return pd.date_range(start, periods=n).values.astype('datetime64[ms]').astype(np.int64)
+
+
+def ms(date):
+    return pd.Timestamp(date).value // 1000000
+
+
+def write_store(path, series):
+    writer = SeriesStoreWriter(path)
+    for name, (timestamps, values) in series.items():
+        writer.add(name, timestamps, values)
+    writer.close()
+    return SeriesStore(path)
+
+
+def test_series_round_trip(tmp_path):
+    path = os.path.join(str(tmp_path), 'tok')
+    store = write_store(path, {'a': (daily(10), np.arange(10.)), 'b': (daily(3), [np.nan, 1., 2.]), 'empty': ([], [])})
+
+    assert store.names() == ['a', 'b', 'empty']
+    data = store.get('a')
+    assert list(data.columns) == [0, 1]
+    np.testing.assert_array_equal(data[0].values, daily(10))
+    np.testing.assert_array_equal(data[1].values, np.arange(10.))
+    np.testing.assert_array_equal(store.get('b')[1].values, [np.nan, 1., 2.])
+    assert len(store.get('empty')) == 0
+
+    # reads are views onto the mapped files
+    timestamps, values = store.get_arrays('a')
+    assert np.shares_memory(values, store.values)
+    assert not values.flags.writeable
+
+    with pytest.raises(KeyError):
+        store.get('missing')
+
+
+def test_date_slices(tmp_path):
+    store = write_store(os.path.join(str(tmp_path), 'tok'), {'a': (daily(10), np.arange(10.))})
+
+    assert list(store.get('a', start='2020-01-03', end='2020-01-05')[1]) == [2., 3., 4.]
+    assert list(store.get('a', last=2)[1]) == [8., 9.]
+    assert list(store.get('a', end=ms('2020-01-05'), last=2)[1]) == [3., 4.]
+    assert len(store.get('a', start='2021-01-01')) == 0
+
+
+def test_unsorted_series_are_sorted(tmp_path):
+    store = write_store(os.path.join(str(tmp_path), 'tok'), {'a': (daily(5)[::-1], np.arange(5.))})
+    np.testing.assert_array_equal(store.get('a')[0].values, daily(5))
+    np.testing.assert_array_equal(store.get('a')[1].values, np.arange(5.)[::-1])
+
+
+def test_writer_replaces_a_store(tmp_path):
+    path = os.path.join(str(tmp_path), 'tok')
+    write_store(path, {'a': (daily(5), np.arange(5.))})
+    store = write_store(path, {'b': (daily(2), np.arange(2.))})
+
+    assert store.names() == ['b']
+    assert sorted(os.listdir(str(tmp_path))) == ['tok']
+
+    writer = SeriesStoreWriter(path)
+    writer.add('a', daily(2), [1., 2.])
+    with pytest.raises(RuntimeError):
+        writer.add('a', daily(2), [1., 2.])
+    with pytest.raises(RuntimeError):
+        writer.add('b', daily(2), [1.])
+
+
+def test_split_series():
+    dates = pd.date_range('2020-01-01', periods=3)
+    timestamps, values = split_series(pd.DataFrame({0: dates.values, 1: [1, 2, 3]}))
+    np.testing.assert_array_equal(timestamps, daily(3))
+    assert values.dtype == np.float64
+
+    with pytest.raises(RuntimeError):
+        split_series(pd.Series([1., 2.]))
+
+
+def test_provider_round_trip(tmp_path):
+    source = SeriesStoreProvider({'SERIES_STORE_DIR': str(tmp_path), 'QUERY_CACHE_BYTES': 0})
+    write_store(os.path.join(str(tmp_path), 'source'), {'a': (daily(20), np.arange(20.))})
+
+    # a store built from another provider's results reads back the same
+    build_store(source, 'source', ['a', 'a?last=5'], os.path.join(str(tmp_path), 'copy'))
+    provider = SeriesStoreProvider({'SERIES_STORE_DIR': str(tmp_path), 'QUERY_CACHE_BYTES': 0})
+
+    assert provider.get_tokens() == ['copy', 'source']
+    pd.testing.assert_frame_equal(provider.get_query_data('copy', 'a'), source.get_query_data('source', 'a'))
+    assert list(provider.get_query_data('copy', 'a?last=5')[1]) == [15., 16., 17., 18., 19.]
+    assert list(provider.get_query_data('copy', 'a?start=2020-01-19')[1]) == [18., 19.]
+    assert len(provider.get_query_data('copy', 'a?freq=W&last=2')) == 2
+
+    with pytest.raises(RuntimeError):
+        provider.get_store('missing')
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node to run the client store')
+def test_client_store_evicts_least_recently_used():
+    script = os.path.join(os.path.dirname(__file__), '..', 'bucephalus', 'static', 'js', 'seriesstore.js')
+    scenario = '''
+        SeriesStore.maxPoints = 10;
+        var log = [];
+        SeriesStore.put('a', [[1, 2], [3, 4]]);      // 4 points
+        SeriesStore.put('b', [1, 2, 3]);             // 3 points
+        SeriesStore.get('a');                        // a is now the most recently used
+        SeriesStore.put('c', [[1, 2], [3, 4]]);      // 11 points, so b goes
+        log.push(Array.from(SeriesStore.entries.keys()), SeriesStore.points);
+        SeriesStore.put('big', new Array(11));       // too big to keep at all
+        SeriesStore.put('a', [[1, 2], [3, 4]]);      // already held, only used
+        log.push(Array.from(SeriesStore.entries.keys()), SeriesStore.points);
+        log.push(SeriesStore.get('a'), SeriesStore.get('b') === undefined);
+        log.push(Object.keys(SeriesStore.snapshot()));
+        console.log(JSON.stringify(log));
+    '''
+    with open(script) as fh:
+        source = fh.read()
+    output = subprocess.check_output(['node', '-e', source + scenario], timeout=30)
+
+    assert json.loads(output.decode('utf-8')) == [['a', 'c'], 8, ['c', 'a'], 8, [[1, 2], [3, 4]], True, ['c', 'a']]
@@ -0,0 +1,103 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus.sharedseries import SharedSeries, sweep
+
+
+@pytest.fixture
+def store():
+    store = SharedSeries(1024*1024, prefix='bcptest{}_'.format(os.getpid()))
+    yield store
+    store.close()
+    sweep(store.prefix)
+
+
+def test_string_dates_are_not_shared(store):
+    data = pd.DataFrame({'cat': ['a', 'b'], 'v': [1., 2.]})
+    assert store.put('t', 'q', data) is None
+    assert store.get('t', 'q') is None
+
+
+def test_datetime_frame_round_trips(store):
+    data = pd.DataFrame({'date': pd.date_range('2020-01-01', periods=5), 'value': np.arange(5.)})
+    shared = store.put('t', 'q', data)
+    pd.testing.assert_frame_equal(shared, data)
+    pd.testing.assert_frame_equal(store.get('t', 'q'), data)
+
+
+def test_integer_frame_round_trips(store):
+    data = pd.DataFrame({'index': np.arange(4, dtype=np.int64) * 1000, 0: np.array([1, 2, 3, 4], dtype=np.int32)})
+    pd.testing.assert_frame_equal(store.put('t', 'q', data), data)
+
+
+def test_other_shapes_are_not_shared(store):
+    assert store.put('t', 'q1', pd.Series([1., 2.])) is None
+    assert store.put('t', 'q2', pd.DataFrame({'a': [1, 2], 'b': [1., 2.]}, index=[3, 4])) is None
+    assert store.put('t', 'q3', pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})) is None
+
+
+def test_shared_between_processes(store):
+    data = pd.DataFrame({'date': pd.date_range('2020-01-01', periods=100), 'value': np.random.randn(100)})
+    store.put('t', 'q', data)
+
+    pid = os.fork()
+    if pid == 0:
+        store.after_fork()
+        got = store.get('t', 'q')
+        os._exit(0 if got is not None and got.equals(data) else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+
+
+def test_reads_are_views_onto_the_segment(store):
+    data = pd.DataFrame({'date': np.arange(3), 'value': [1., 2., 3.]})
+    shared = store.put('t', 'q', data)
+    segment = np.frombuffer(store.attached[store.segment_name('t', 'q')[0]].buf, dtype=np.uint8)
+    values = shared.iloc[:, 1].to_numpy()
+    assert np.shares_memory(values, segment)
+    assert not values.flags.writeable
+
+
+def test_invalidate(store):
+    data = pd.DataFrame({'date': np.arange(3), 'value': [1., 2., 3.]})
+    store.put('t', 'q', data)
+    store.put('other', 'q', data)
+    assert store.invalidate('t') == 1
+    assert store.get('t', 'q') is None
+    assert store.get('other', 'q') is not None
+
+
+def test_evicts_past_max_bytes():
+    store = SharedSeries(4096, prefix='bcptest{}e_'.format(os.getpid()))
+    try:
+        data = pd.DataFrame({'date': np.arange(200), 'value': np.ones(200)})
+        for i in range(3):
+            store.put('t', 'q{}'.format(i), data)
+        assert store.stats()['evictions'] == 2
+        assert store.stats()['bytes'] <= 4096
+    finally:
+        store.close()
+        sweep(store.prefix)
+
+
+def test_expires_after_ttl():
+    store = SharedSeries(1024*1024, prefix='bcptest{}t_'.format(os.getpid()), ttl=0.1)
+    try:
+        data = pd.DataFrame({'date': np.arange(3), 'value': [1., 2., 3.]})
+        store.put('t', 'q', data)
+        assert store.get('t', 'q') is not None
+
+        time.sleep(0.2)
+        assert store.get('t', 'q') is None
+        assert store.stats()['created'] == 0
+
+        # the expired segment was unlinked, so it can be replaced
+        new = pd.DataFrame({'date': np.arange(3), 'value': [4., 5., 6.]})
+        pd.testing.assert_frame_equal(store.put('t', 'q', new), new)
+    finally:
+        store.close()
+        sweep(store.prefix)
@@ -0,0 +1,81 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus.dataprovider import QueryError
+from bucephalus.sqliteprovider import SQLiteDataProvider, write_series
+
+
+@pytest.fixture
+def provider(tmp_path):
+    dates = pd.date_range('2020-01-01', periods=30)
+    write_series(os.path.join(str(tmp_path), 'snap.db'),
+                 {'a': (dates, np.arange(30.)), 'b': (dates[:10], np.arange(10.) * 2)})
+    ret = SQLiteDataProvider({'SQLITE_DIR': str(tmp_path), 'QUERY_CACHE_BYTES': 0, 'CONNECTION_POOL_SIZE': 2})
+    yield ret
+    ret.shutdown()
+
+
+def ms(date):
+    return pd.Timestamp(date).value // 1000000
+
+
+def run(provider, queries):
+    results = {}
+    lock = threading.Lock()
+
+    def callback(query, data, index, n):
+        with lock:
+            results[query] = data
+
+    provider.run_queries('snap', queries, callback)
+    return results
+
+
+def test_tokens_are_the_databases(provider):
+    assert provider.get_tokens() == ['snap']
+
+
+def test_query_returns_a_date_value_frame(provider):
+    data = run(provider, ['a'])['a']
+
+    assert list(data.columns) == [0, 1]
+    assert data[0].dtype == np.int64 and data[1].dtype == np.float64
+    assert len(data) == 30
+    assert data[0].iloc[0] == ms('2020-01-01')
+    np.testing.assert_array_equal(data[1].values, np.arange(30.))
+
+
+def test_windows_are_applied_in_the_query(provider):
+    results = run(provider, ['a?start=2020-01-05&end=2020-01-09', 'a?last=3', 'b?last=20&start=2020-01-08'])
+
+    data = results['a?start=2020-01-05&end=2020-01-09']
+    assert list(data[0]) == [ms('2020-01-{:02d}'.format(d)) for d in range(5, 10)]
+    assert list(results['a?last=3'][1]) == [27., 28., 29.]
+    assert list(results['b?last=20&start=2020-01-08'][1]) == [14., 16., 18.]
+
+
+def test_resampled_windows(provider):
+    data = run(provider, ['a?freq=W&last=2'])['a?freq=W&last=2']
+    assert len(data) == 2
+    assert data[1].iloc[-1] == 29.
+
+
+def test_missing_series_and_tokens_fail(provider):
+    assert isinstance(run(provider, ['missing'])['missing'], QueryError)
+
+    with pytest.raises(RuntimeError):
+        provider.get_path('../snap')
+    with pytest.raises(RuntimeError):
+        provider.get_path('other')
+
+
+def test_queries_share_the_token_pool(provider):
+    run(provider, ['a', 'b', 'a?last=3', 'b?last=3'])
+
+    pool = provider.get_connection_pool('snap')
+    assert 1 <= pool.stats()['created'] <= 2
+    assert pool.stats()['size'] == pool.stats()['idle']
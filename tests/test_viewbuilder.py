@@ -0,0 +1,184 @@
+import queue
+
+import networkx
+import numpy as np
+import pandas as pd
+import pytest
+
+from bucephalus import datahandler
+from bucephalus.baseviews import BaseViewBuilder
+from bucephalus.dataprovider import BaseDataProvider
+from bucephalus.viewbuilder import ViewBuilder, ExecutionPlan, DerivedKey, build_dependency_graph
+
+
+class TableViews(BaseViewBuilder):
+    """
+    A second provider, as the view builder expects more than one
+    """
+    def __init__(self):
+        self.views_cache = {'table': self.table}
+
+    def build_view(self, viewname, tags, data, extra):
+        return self.views_cache[viewname](data)
+
+    def table(self, data):
+        return {'result': [[k[0], len(v)] for k, v in data]}
+
+
+class SeriesProvider(BaseDataProvider):
+    """
+    Returns a short timeseries for each query, counting up from its entry in values
+    """
+    values = {'a': 1., 'b': 10., 'c': 100.}
+
+    def run_query(self, conn, token, query):
+        dates = pd.date_range('2020-01-01', periods=3).values.astype('datetime64[ms]').astype(np.int64)
+        return pd.DataFrame({0: dates, 1: self.values[query] + np.arange(3.)})
+
+
+def view(*queries, **kwargs):
+    ret = {'viewtype': 'explanation', 'series': [{'query': q, 'label': q} for q in queries]}
+    ret.update(kwargs)
+    return ret
+
+
+def get_view_builder(**config):
+    config.setdefault('VIEW_PROVIDERS', ['bucephalus.htmlviews.HTMLViewBuilder', __name__ + '.TableViews'])
+    config.setdefault('SCHEDULER_WORKERS', 1)
+    return ViewBuilder(config.pop('data_provider', None), config, watch=False)
+
+
+def test_plan_fetches_each_query_once():
+    plan = build_dependency_graph([view('a', 'b'), view('b'), view()], None)
+    assert plan.queries == ['a', 'b']
+    assert [plan.types[i] for i in plan.roots] == ['view']
+
+    # every node comes after the ones it depends on
+    for node, preds in enumerate(plan.predecessors):
+        assert all(p < node for p in preds)
+
+
+def test_views_are_ready_once_all_their_series_are():
+    plan = build_dependency_graph([view('a', 'b'), view('b'), view()], None)
+    state = plan.start()
+
+    # the view without any series comes out with the first result
+    assert [plan.keys[n] for n in state.complete('b', 'B')] == [1, 2]
+    assert [plan.keys[n] for n in state.complete('a', 'A')] == [0]
+
+    assert [state.data[n] for n in plan.predecessors[plan.node_ids[0]]] in (['A', 'B'], ['B', 'A'])
+    assert state.done[plan.node_ids[0]] and state.done[plan.node_ids[1]]
+
+
+def test_completing_a_query_twice_does_nothing():
+    plan = build_dependency_graph([view('a', 'b')], None)
+    state = plan.start()
+    assert state.complete('a', 'A') == []
+    assert state.complete('a', 'A2') == []
+    assert [plan.keys[n] for n in state.complete('b', 'B')] == [0]
+    assert state.data[plan.node_ids['a']] == 'A'
+
+
+def test_plan_states_are_independent():
+    plan = build_dependency_graph([view('a')], None)
+    first = plan.start()
+    first.complete('a', 'A')
+
+    second = plan.start()
+    assert not any(second.done)
+    assert [plan.keys[n] for n in second.complete('a', 'A')] == [0]
+
+
+def test_derived_nodes_come_before_views():
+    plan = build_dependency_graph([view('a', 'b', handler='accumulate'), view('a')], None)
+    state = plan.start()
+
+    ready = state.complete('a', 'A')
+    assert [plan.keys[n] for n in ready] == [DerivedKey('a', 'accumulate'), 1]
+
+    # the handler's view waits for both of its derived series
+    assert state.resolve(ready[0], 'A+') == []
+    ready = state.complete('b', 'B')
+    assert [plan.keys[n] for n in ready] == [DerivedKey('b', 'accumulate')]
+    assert [plan.keys[n] for n in state.resolve(ready[0], 'B+')] == [0]
+
+    series = [plan.keys[n] for n in plan.predecessors[plan.node_ids[0]]]
+    assert sorted(series) == [('a', 'a', 'accumulate'), ('b', 'b', 'accumulate')]
+    assert plan.node_ids[0] in plan.derived_views and plan.node_ids[1] not in plan.derived_views
+
+
+def test_derived_key_is_not_a_tuple():
+    assert DerivedKey('a', 'accumulate') != ('a', 'accumulate')
+    assert len({DerivedKey('a', 'accumulate'), ('a', 'accumulate')}) == 2
+
+
+def test_cycles_are_rejected():
+    graph = networkx.DiGraph()
+    graph.add_node('a', typ='query')
+    graph.add_node(('a', 'a'), typ='series')
+    graph.add_edge('a', ('a', 'a'))
+    graph.add_edge(('a', 'a'), 'a')
+    with pytest.raises(RuntimeError):
+        ExecutionPlan(graph)
+
+
+def test_plans_are_cached_by_viewlist():
+    builder = get_view_builder()
+    plan = builder.get_plan([view('a', 'b')])
+
+    # the same views posted again, in a different key order
+    same = [{'series': [{'label': 'a', 'query': 'a'}, {'label': 'b', 'query': 'b'}], 'viewtype': 'explanation'}]
+    assert builder.get_plan(same) is plan
+    assert builder.get_plan([view('a')]) is not plan
+
+
+def test_plan_cache_is_bounded():
+    builder = get_view_builder()
+    builder.plan_cache_size = 2
+
+    first = builder.get_plan([view('a')])
+    builder.get_plan([view('b')])
+    builder.get_plan([view('a')])
+    builder.get_plan([view('c')])
+
+    assert len(builder.plan_cache) == 2
+    assert builder.get_plan([view('a')]) is first
+
+
+def test_derived_series_are_built_once_after_their_inputs(monkeypatch):
+    seen = []
+
+    def count_series(dates, values, mask):
+        seen.extend(values[0])
+        return dates, values, mask
+
+    monkeypatch.setitem(datahandler.kernels, 'count_series', count_series)
+    handler = 'count_series|accumulate'
+    provider = SeriesProvider({'QUERY_CACHE_BYTES': 0})
+    builder = get_view_builder(data_provider=provider)
+    viewlist = [view('a', 'b', 'c', handler=handler), view('a', 'b', handler=handler), view('c'), view('c', handler='raw')]
+
+    results = queue.Queue()
+    builder.build_views('tok', viewlist, results).join(5)
+    messages = list(iter(results.get, None))
+    assert not [m for m in messages if m['category'] == 'error']
+
+    # the handler ran once on each query's data, however many views it's in
+    assert sorted(seen) == [1., 10., 100.]
+
+    data = [m for m in messages if m['category'] == 'data']
+    derived = {q: (q, q, handler) for q in 'abc'}
+    assert sorted(m['series'] for m in data) == sorted(list(derived.values()) + [('c', 'c')])
+    for q, key in derived.items():
+        msg, = [m for m in data if m['series'] == key]
+        assert list(msg['data'][1]) == list(np.cumsum(SeriesProvider.values[q] + np.arange(3.)))
+
+    # each view's graph comes after the data for all of its series
+    graphs = [i for i, m in enumerate(messages) if m['category'] == 'graph']
+    assert sorted(messages[i]['id'] for i in graphs) == [0, 1, 2, 3]
+    for i in graphs:
+        name = messages[i]['id']
+        series = [(s['query'], s['label']) + ((handler,) if viewlist[name].get('handler') == handler else ())
+                  for s in viewlist[name]['series']]
+        sent = [j for j, m in enumerate(messages) if m['category'] == 'data' and m['series'] in series]
+        assert len(sent) == len(series) and max(sent) < i
@@ -0,0 +1,92 @@
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+from bucephalus.viewtools import stream_encoders, build_binary_frame, BINARY_MIMETYPE
+
+
+def parse_frame(frame):
+    """
+    Reads a binary frame as the client does, returning its header and columns
+    """
+    header_len, payload_len = struct.unpack_from('<II', frame)
+    assert len(frame) == 8 + header_len + payload_len
+
+    header = json.loads(frame[8:8 + header_len].decode('utf-8'))
+    payload = frame[8 + header_len:]
+
+    columns = []
+    offset = 0
+    for dtype in header.get('columns', []):
+        dtype = np.dtype(dtype).newbyteorder('<')
+        columns.append(np.frombuffer(payload, dtype, header['rows'], offset))
+        offset += header['rows'] * dtype.itemsize
+    assert offset == len(payload)
+    return header, columns
+
+
+def series_message(data):
+    return {'id': 'view', 'category': 'data', 'series': ['query', 'label'], 'hash': 'abc', 'data': data}
+
+
+def timeseries(n=5):
+    dates = np.arange(n, dtype=np.int64) * 86400000 + 1500000000000
+    values = np.linspace(0.1, 1.0, n)
+    values[n // 2] = np.nan
+    return pd.DataFrame({0: dates, 1: values})
+
+
+def test_build_binary_frame():
+    frame = build_binary_frame('{"a": 1}', b'\x01\x02')
+    assert frame == struct.pack('<II', 8, 2) + b'{"a": 1}\x01\x02'
+    assert build_binary_frame('{}') == struct.pack('<II', 2, 0) + b'{}'
+
+
+def test_binary_frame_round_trip():
+    data = timeseries()
+    encode, mimetype = stream_encoders['binary']
+    header, (dates, values) = parse_frame(encode(series_message(data)))
+
+    assert mimetype == BINARY_MIMETYPE
+    assert header == {'id': 'view', 'category': 'data', 'series': ['query', 'label'], 'hash': 'abc',
+                      'columns': ['int64', 'float64'], 'rows': 5}
+    np.testing.assert_array_equal(dates, data[0].values)
+    np.testing.assert_array_equal(values, data[1].values)
+
+
+def test_binary32_frame_round_trip():
+    data = timeseries()
+    header, (dates, values) = parse_frame(stream_encoders['binary32'][0](series_message(data)))
+
+    assert header['columns'] == ['int64', 'float32']
+    np.testing.assert_array_equal(dates, data[0].values)
+    np.testing.assert_array_equal(values, data[1].values.astype(np.float32))
+
+
+def test_whole_float_dates_are_sent_as_int64():
+    data = timeseries().astype({0: np.float64})
+    header, (dates, _) = parse_frame(stream_encoders['binary'][0](series_message(data)))
+    assert header['columns'] == ['int64', 'float64']
+    np.testing.assert_array_equal(dates, data[0].values.astype(np.int64))
+
+
+def test_messages_without_numeric_data_go_in_the_header():
+    msg = {'id': 'view', 'category': 'graph', 'result': {'title': 'x'}}
+    header, columns = parse_frame(stream_encoders['binary'][0](msg))
+    assert header == msg and columns == []
+
+    data = pd.DataFrame({0: ['a', 'b'], 1: [1.0, 2.0]})
+    header, columns = parse_frame(stream_encoders['binary'][0](series_message(data)))
+    assert header['data'] == [['a', 1.0], ['b', 2.0]] and columns == []
+
+
+def test_json_chunks():
+    encode, mimetype = stream_encoders['json']
+    chunk = encode(series_message(timeseries(2)))
+
+    assert mimetype == 'application/json'
+    assert chunk.endswith(b';')
+    msg = json.loads(chunk[:-1].decode('utf-8'))
+    assert msg['data'] == [[1500000000000, 0.1], [1500086400000, None]]
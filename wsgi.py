@@ -2,9 +2,17 @@
 Gunicorn config script
 """
 
+import os
+import multiprocessing
+
+# The app is loaded in the master before it forks the workers, so threading has to be
+# patched for gevent before then, rather than when each worker starts
+from gevent import monkey
+monkey.patch_all()
+
 accesslog='-'
 bind = 'unix:bucephalus.sock'
-workers = 1
+workers = int(os.environ.get('BUCEPHALUS_WORKERS', multiprocessing.cpu_count()))
 threads = 4
 worker_class = 'gevent'
 worker_connections = 1000
@@ -12,3 +20,24 @@ umask = 7
 user = 'nobody'
 group = 'nogroup'
 
+# Views, nav data and execution plans are loaded once, in the master, and shared copy-on-write by the workers
+preload_app = True
+wsgi_app = 'bucephalus:create_app(preload=True)'
+
+
+def post_fork(server, worker):
+    import bucephalus
+    bucephalus.post_fork()
+
+
+def worker_exit(server, worker):
+    import bucephalus
+    bucephalus.worker_exit()
+
+
+def on_exit(server):
+    # unlink any series shared by workers that didn't get to do it themselves
+    import bucephalus
+    from bucephalus.sharedseries import sweep
+    if bucephalus.data_provider is not None and bucephalus.data_provider.shared_series is not None:
+        sweep(bucephalus.data_provider.shared_series.prefix)